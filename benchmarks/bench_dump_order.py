@@ -0,0 +1,105 @@
+"""
+Benchmark of the tables dump order (dbms Migrator.get_tables_dump_order) on
+a synthetic schema of 10000 tables with foreign keys and some FKs cycles.
+
+Run it from the repository root:
+
+    PYTHONPATH=lib python benchmarks/bench_dump_order.py [tables]
+"""
+import random
+import sys
+import time
+
+import sqlalchemy as sa
+
+from migrations import graph
+from migrations.backends import dbms
+
+
+class SchemaReflection(object):
+    """ Stands in for the reflection cache serving the synthetic schema """
+    def __init__(self, meta):
+        self.meta = meta
+
+    def get_table_names(self, engine):
+        return set(self.meta.tables)
+
+    def reflect(self, engine, table_names=None):
+        pass
+
+    def get_table(self, engine, table_name):
+        return self.meta.tables[table_name]
+
+
+def build_schema(tables, max_fks=3, cycles=50, seed=0):
+    """
+    Returns a MetaData with tables tables linked by up to max_fks foreign
+    keys to tables created before them plus cycles (nullable) foreign keys
+    that close a cycle
+    """
+    rnd = random.Random(seed)
+    meta = sa.MetaData()
+    names = ["table_%05d" % i for i in range(tables)]
+    backward = set(rnd.sample(range(1, tables), cycles))
+    for i, name in enumerate(names):
+        columns = [sa.Column("id", sa.Integer, primary_key=True)]
+        parents = set(rnd.sample(range(i), min(i, rnd.randint(0, max_fks))))
+        for j in sorted(parents):
+            columns.append(sa.Column("fk_%s" % j, sa.Integer,
+                                     sa.ForeignKey("%s.id" % names[j]),
+                                     nullable=False))
+        if i in backward:
+            # link to a table created later that links back to this one
+            j = rnd.randint(i + 1, tables - 1) if i < tables - 1 else 0
+            columns.append(sa.Column("fk_cycle", sa.Integer,
+                                     sa.ForeignKey("%s.id" % names[j]),
+                                     nullable=True))
+        sa.Table(name, meta, *columns)
+
+    # make sure every cycle link is closed
+    for i in backward:
+        table = meta.tables[names[i]]
+        target = list(table.c.fk_cycle.foreign_keys)[0].column.table
+        if not any(fk.column.table is table for fk in target.foreign_keys):
+            target.append_column(sa.Column("fk_back_%s" % i, sa.Integer,
+                                           sa.ForeignKey("%s.id" % table.name),
+                                           nullable=False))
+
+    return meta
+
+
+def timed(label, func, *args):
+    started = time.time()
+    result = func(*args)
+    print "%-40s %8.3f s" % (label, time.time() - started)
+    return result
+
+
+def main(tables=10000):
+    meta = timed("building %s tables schema" % tables, build_schema, tables)
+
+    for fk_cycles in ("APPEND", "NULLIFY"):
+        migrator = dbms.Migrator("sqlite://", log_cb=lambda msg: None,
+                                 fk_cycles=fk_cycles)
+        migrator.init_migration(dbms.Migrator("sqlite://"))
+        migrator.reflection = SchemaReflection(meta)
+        order = timed("get_tables_dump_order (%s)" % fk_cycles,
+                      migrator.get_tables_dump_order, None)
+        graph_stats = migrator.stats["tables_graph"]
+        print "    %s tables, %s levels, %s cycles, %s links back-filled" % (
+            len(order), len(graph_stats["levels"]),
+            len(graph_stats.get("cycles", [])),
+            sum(len(links) for links in graph_stats["deferred_fks"].values()))
+
+    # the graph functions alone
+    dependencies = dict(
+        (name, set(fk.column.table.name for fk in table.foreign_keys))
+        for name, table in meta.tables.items()
+    )
+    nodes = sorted(dependencies)
+    timed("graph.get_levels", graph.get_levels, nodes, dependencies)
+    timed("graph.find_cycles", graph.find_cycles, nodes, dependencies)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Benchmark of the foreign keys re-mapping of the dbms destination: the
+records of a fact table with several foreign keys re-mapped a record at a
+time (prepare_record) and a column at a time (prepare_records_fks on a
+columnar paquet).
+
+Run it from the repository root:
+
+    PYTHONPATH=lib python benchmarks/bench_fk_remap.py [records] [fks]
+"""
+import random
+import sys
+import time
+
+from migrations import columnar
+from migrations import pkmaps
+from migrations.backends import dbms
+
+
+def build_paquet(records, fks, keys=100000, seed=0):
+    """
+    Returns (records, fk_mappings) with records dicts of fks foreign keys
+    columns linked to tables of keys re-mapped primary keys
+    """
+    rnd = random.Random(seed)
+    fk_mappings = {}
+    for i in range(fks):
+        pk_map = pkmaps.create_pk_map()
+        pk_map.update((key, key + 1000000) for key in range(1, keys + 1))
+        fk_mappings["fk_%s" % i] = {"pk_map": pk_map}
+
+    rows = []
+    for i in range(records):
+        row = {"id": i + 1, "value": rnd.random()}
+        for column in fk_mappings:
+            row[column] = rnd.randint(1, keys)
+        rows.append(row)
+
+    return rows, fk_mappings
+
+
+def timed(label, func, *args):
+    started = time.time()
+    result = func(*args)
+    print "%-40s %8.3f s" % (label, time.time() - started)
+    return result
+
+
+def main(records=100000, fks=5):
+    rows, fk_mappings = timed("building %s records" % records, build_paquet,
+                              records, fks)
+    keys = sorted(rows[0])
+
+    def by_record():
+        return [dbms.prepare_record(row, fk_mappings) for row in rows]
+
+    def by_column():
+        paquet = columnar.Paquet.from_records(rows, keys)
+        return dbms.prepare_records_fks(paquet, fk_mappings)
+
+    expected = timed("prepare_record (%s fks)" % fks, by_record)
+    paquet = timed("prepare_records_fks (%s fks)" % fks, by_column)
+    assert paquet.to_dicts() == expected
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,8 +1,12 @@
 """
 Migrator Base Classes and Functions
 """
+import threading
+
 from migrations import reporting
 from migrations import loggers
+from migrations import checkpoints
+from migrations import pipeline
 
 class MigratorBase(object):
     """ 
@@ -10,8 +14,13 @@ class MigratorBase(object):
     
     """
     default_options = {
-        "transfer_mode": "FULL",  # Available: FULL, DIFF
-        "compare_mode": "PK",   # Available: FULL, PK
+        "transfer_mode": "FULL",  # FULL, DIFF, DELTA, INCREMENTAL, CAPTURE
+        "compare_mode": "PK",   # Available: FULL, FULL_NO_PK, PK
+        "workers": 1,  # Number of tables migrated at the same time
+        "checkpoint": None,  # Path of the checkpoints file
+        "pipeline_writers": 0,  # Writer threads of the pipelined mode
+        "pipeline_max_paquets": 4,  # Paquets waiting to be written
+        "pipeline_max_bytes": 64 * 1024 * 1024,  # Size of the paquets waiting
         }
 
     def __init__(self, path, log_cb = None, **options):
@@ -47,6 +56,17 @@ class MigratorBase(object):
                         * FULL -> (DEFAULT) Transfer all data without any check
                         * DIFF -> Transfer only data that is not alread into the
                                   the destination
+                        * DELTA -> (dbms backends) Sync the destination with
+                                  range checksums: only the records of the
+                                  primary key ranges that differ are
+                                  inserted, updated or deleted
+                        * INCREMENTAL -> (dbms backends) Transfer only the
+                                  records changed since the last migration
+                                  (watermark column) upserting them
+                        * CAPTURE -> (dbms backends) Apply the changes
+                                  logged by triggers on the source since the
+                                  last migration (inserts, updates and
+                                  deletes)
                                   
         compare_mode ::: string defining the transfer mode. Available modes:
         
@@ -72,19 +92,42 @@ class MigratorBase(object):
                                 
                         * FULL -> When transfer_mode==DIFF checks if the 
                         data is not into the destination DB by checking all the
-                        row values of the row excluding the primary key value. 
-                        This mode is designed for tables with an autoincrement 
-                        pk
-                                NOTE: This method could load really huge datasets
-                                to memory! Be aware of that before using it.
+                        row values of the row (but autoincrement primary keys).
+                        (dbms) Every paquet is loaded into a temporary
+                        staging table and the destination database inserts
+                        the records that are not there yet
                                 
                         * FULL_NO_PK -> When transfer_mode==DIFF checks if the
                         data is not into the destination DB by checking all the
                         row values of the row excluding the primary key value.
                         This mode is designed for tables with an autoincrement
-                        pk
-                                NOTE: This method could load really huge datasets
-                                to memory! Be aware of that before using it.
+                        pk (staged like FULL)
+
+        workers ::: integer defining how many tables can be migrated at the
+                    same time (DEFAULT 1). Tables are started as soon as all
+                    the tables they are linked to (by their foreign keys) are
+                    done. Backends that do not support parallel migrations
+                    ignore this option.
+
+        checkpoint ::: path of a local (SQLite) file where the migration
+                    progress is saved after every paquet (tables already
+                    migrated, last primary key/number of records written and
+                    primary keys mapping). If set, a migration that did not
+                    finish can be resumed (see migrate resume parameter).
+                    DEFAULT None: no checkpoints are saved.
+
+        pipeline_writers ::: number of writer threads of the pipelined mode.
+                    If > 0 the source keeps reading paquets (filling a
+                    bounded queue) while the writer threads dump the paquets
+                    already read into the destination, so source reads and
+                    destination writes overlap. DEFAULT 0: the source waits
+                    for every paquet to be dumped before reading the next one
+
+        pipeline_max_paquets ::: maximum number of paquets waiting in the
+                    pipeline queue (the source blocks when it's full)
+
+        pipeline_max_bytes ::: maximum (estimated) size in bytes of the
+                    paquets waiting in the pipeline queue
 
         """
         self.path = path
@@ -98,6 +141,15 @@ class MigratorBase(object):
             
         # last migration statistics dictionary
         self.stats = {"tables": {}}
+
+        # checkpoints store of the running migration (if any)
+        self.checkpoint = None
+
+        # paquets queue of the running migration in pipelined mode
+        self._pipeline = None
+
+        # lock that protects self.stats when tables are migrated in parallel
+        self._stats_lock = threading.RLock()
         
         # call extra initialization hook
         self.initialize()
@@ -112,7 +164,8 @@ class MigratorBase(object):
         pass
 
 
-    def migrate(self, destination, tables=None, paquet=10000, exclude=None):
+    def migrate(self, destination, tables=None, paquet=10000, exclude=None,
+                workers=None, resume=False):
         """
         Migrates tables data between the source and the destination.
         
@@ -144,14 +197,85 @@ class MigratorBase(object):
                     not be transferred.
                     
                     IF exclude == None no table will be excluded
-        """        
+
+        workers ::: integer that overrides the "workers" option for this
+                    migration only (see the __init__ OPTIONS)
+
+        resume ::: if True the migration continues from the checkpoints saved
+                    by the last migration (requires the "checkpoint" option)
+                    skipping the records already migrated. Otherwise the
+                    checkpoints (if any) are reset
+        """
+        if workers is not None:
+            # the option is restored so the next migrations do not inherit it
+            previous = self.options.get("workers")
+            self.options["workers"] = workers
+            try:
+                return self.migrate(destination, tables, paquet, exclude,
+                                    resume = resume)
+            finally:
+                self.options["workers"] = previous
+
+        if resume and not self.options.get("checkpoint"):
+            raise ValueError("resuming a migration requires the checkpoint "
+                             "option")
+
         self.init_migration(destination)
-        return self._migrate(
-                    destination,
-                    tables = tables, 
-                    paquet = paquet, 
-                    exclude = exclude
-        )
+
+        if self.options.get("checkpoint"):
+            self.checkpoint = checkpoints.CheckpointStore(
+                self.options["checkpoint"]
+            )
+            if not resume:
+                self.checkpoint.reset(tables = tables,
+                                      paquet = paquet,
+                                      exclude = exclude)
+
+            # the destination tells the store when its writes are committed
+            destination.checkpoint = self.checkpoint
+
+        if self.options.get("pipeline_writers"):
+            self._pipeline = pipeline.Pipeline(
+                destination,
+                writers = self.options["pipeline_writers"],
+                max_paquets = self.options.get("pipeline_max_paquets"),
+                max_bytes = self.options.get("pipeline_max_bytes")
+            )
+
+        try:
+            result = self._migrate(
+                        destination,
+                        tables = tables, 
+                        paquet = paquet, 
+                        exclude = exclude
+            )
+            if self._pipeline is not None:
+                # wait for the writers to dump all the paquets read
+                self._pipeline.close()
+
+            destination.complete_migration()
+            self.migration_completed(destination)
+            return result
+
+        finally:
+            if self._pipeline is not None:
+                self._pipeline.abort()
+                self._pipeline = None
+
+            destination.finish_migration()
+
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+                self.checkpoint = None
+                destination.checkpoint = None
+
+
+    def migrate_async(self, executor, destination, **kwargs):
+        """
+        Runs migrate(destination, **kwargs) on executor (see
+        migrations.executors.Executor) and returns its Task
+        """
+        return executor.submit(self.migrate, destination, **kwargs)
 
 
     def _migrate(self, destination, tables=None, paquet=10000, exclude=None):
@@ -161,6 +285,40 @@ class MigratorBase(object):
         raise NotImplementedError
 
 
+    def migration_completed(self, destination):
+        """
+        Called on the source once the destination completed the migration
+        (all the records are written). Overwrite me to define what the source
+        does after a successful migration
+        """
+        pass
+
+
+    def deliver(self, destination, records, table, callback=None):
+        """
+        Delivers records read by the migration source to destination.dump.
+        Backends _migrate implementations must use it instead of calling
+        destination.dump directly so they support the pipelined mode.
+
+        records ::: see dump. If records is None nothing is dumped
+
+        table ::: see dump
+
+        callback ::: function (without arguments) called once the records
+                    (and all the table records delivered before them) have
+                    been dumped. In pipelined mode it's called by a writer
+                    thread
+        """
+        if self._pipeline is not None:
+            self._pipeline.put(records, table, callback)
+            return
+
+        if records is not None:
+            destination.dump(records, table)
+        if callback is not None:
+            callback()
+
+
     def dump(self, records, table):
         """
         Receive a collections of data records to be dumped into the migrator
@@ -175,6 +333,50 @@ class MigratorBase(object):
         return self._dump(records, table)
 
 
+    def flush_table(self, table):
+        """
+        Called (through deliver) by the migration source once a part of the
+        table records (i.e. a primary key range) has been dumped, from the
+        thread that dumped them. Overwrite me to commit the records the
+        current thread keeps uncommitted
+        """
+        pass
+
+
+    def finish_table(self, table):
+        """
+        Called (through deliver) by the migration source once all the table
+        records have been dumped into the destination. Overwrite me to
+        release the resources kept to dump the table records
+        """
+        pass
+
+
+    def complete_migration(self):
+        """
+        Called on the destination once all the records have been migrated
+        (only if the migration did not fail). Overwrite me to do the work
+        that must follow the records load
+        """
+        pass
+
+
+    def finish_migration(self):
+        """
+        Called on the destination when the migration ends (even if it
+        failed). Overwrite me to release the resources kept during the
+        migration
+        """
+        pass
+
+
+    def dump_async(self, executor, records, table):
+        """
+        Runs dump(records, table) on executor and returns its Task
+        """
+        return executor.submit(self.dump, records, table)
+
+
     def _dump(self, paquets, table):
         """
         Overwrite me to define Migrator migration destination behaviour
@@ -191,6 +393,13 @@ class MigratorBase(object):
         )
     
     
+    def compare_async(self, executor, destination, **kwargs):
+        """
+        Runs compare(destination, **kwargs) on executor and returns its Task
+        """
+        return executor.submit(self.compare, destination, **kwargs)
+
+
     def _compare(self, destiantion, tables, paquet=10000, exclude=None):
         raise NotImplementedError
 
@@ -200,6 +409,7 @@ class MigratorBase(object):
         Initializes the migration stats reseting all the statistics and sets
         destination.stats = self.stats
         """
+        destination._stats_lock = self._stats_lock
         destination.stats = self.stats = {
             "transfer_mode": self.options["transfer_mode"],
             "source": self.path,
@@ -222,24 +432,35 @@ class MigratorBase(object):
     
     def get_table_stats(self, table_name):
         """ returns the table migration statistics """
-        if not table_name in self.stats["tables"]:
-            self.stats["tables"][table_name] = get_table_default_stats(table_name)
-
-        return self.stats["tables"][table_name]
-
-    def update_dump_stats(self, tab_stats, records, transfer_mode):
-        if transfer_mode == "DIFF":
-            tab_stats["lst_records_transferred"] += records        
-        tab_stats["records_transferred"] += len(records)
-        self.stats["total_records_transferred"] += len(records)
-        self.stats["total_records_skipped"] += tab_stats["records_skipped"]
-        msg = "%s paquets transferred/skipped %s, %s --- %s / %s" % (
-            tab_stats["name"],
-            tab_stats["records_transferred"],
-            tab_stats["records_skipped"],
-            self.stats["total_records_skipped"],
-            self.stats["total_records_transferred"]
-        )
+        with self._stats_lock:
+            if not table_name in self.stats["tables"]:
+                self.stats["tables"][table_name] = get_table_default_stats(table_name)
+
+            return self.stats["tables"][table_name]
+
+    def update_dump_stats(self, tab_stats, records, transfer_mode,
+                          count=None):
+        """
+        count ::: number of records transferred if records does not hold
+                    them (i.e. records inserted by the destination database
+                    itself). DEFAULT len(records)
+        """
+        if count is None:
+            count = len(records)
+
+        with self._stats_lock:
+            if transfer_mode == "DIFF":
+                tab_stats["lst_records_transferred"] += records
+            tab_stats["records_transferred"] += count
+            self.stats["total_records_transferred"] += count
+            self.stats["total_records_skipped"] += tab_stats["records_skipped"]
+            msg = "%s paquets transferred/skipped %s, %s --- %s / %s" % (
+                tab_stats["name"],
+                tab_stats["records_transferred"],
+                tab_stats["records_skipped"],
+                self.stats["total_records_skipped"],
+                self.stats["total_records_transferred"]
+            )
         self.log_cb(msg)
 
         return tab_stats
@@ -67,12 +67,12 @@ class Migrator(MigratorBase):
                         # Let's check if the records are ready to be dumped (as we
                         # don't want it to be bigger to the paquet size set
                         if len(records) >= paquet:
-                            destination.dump(records, table)
+                            self.deliver(destination, records, table)
                             records = []
     
                     # Finally we have finished looping all the records and just need
                     # to dumpe those left in records
-                    destination.dump(records, table)
+                    self.deliver(destination, records, table)
             except Exception, e:
                 err_msg = u"""Error dumping table [%s] on destination. \
                 Error details: %s"""%(table.name, e.message)
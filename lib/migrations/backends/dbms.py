@@ -1,26 +1,245 @@
-import operator
-import copy
+import os
 import re
+import threading
+import time
 import sqlalchemy as sa
 from sqlalchemy import create_engine, MetaData, Table
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects import mssql
 
+from functools import partial
+
+from migrations import scheduling
+from migrations import reflection
+from migrations import sizing
+from migrations import pipeline
+from migrations import loaders
+from migrations import graph
+from migrations import pkmaps
+from migrations import columnar
+from migrations import existence
+from migrations import capture
+from migrations import checksums
+from migrations import staging
+from migrations import comparison
+from migrations import manifest
+from migrations import watermarks
 from .base import MigratorBase
 
 class Migrator(MigratorBase):
     """ 
     Represent data migration from/to a SQL Database
     """    
-        
+    # DBMS custom options:
+    default_options = dict(MigratorBase.default_options)
+    # number of primary key ranges read and dumped at the same time for
+    # every table (tables with a single column primary key only)
+    default_options["partitions"] = 1
+    # how the primary key ranges are defined. Available:
+    #   MINMAX -> equal ranges between min and max pk (numeric pks only)
+    #   QUANTILES -> ranges with the same number of records
+    default_options["partition_strategy"] = "MINMAX"
+    # read the source records through server side cursors (streaming)
+    default_options["stream_results"] = True
+    # first fetch size of the streamed reads (then doubles up to paquet)
+    default_options["stream_fetch_size"] = 1000
+    # source read strategy. Available: CURSOR, KEYSET (see read_table)
+    default_options["read_mode"] = "CURSOR"
+    # path of the file where the reflected tables are saved between
+    # migrations (warm starts). DEFAULT None: tables are reflected (only
+    # once) during every migration
+    default_options["reflection_cache"] = None
+    # tune the paquet size of every table to transfer a paquet in about
+    # "paquet_target_seconds" without exceeding "paquet_max_bytes" (the
+    # sizes used are saved in the table stats "paquet_sizes")
+    default_options["adaptive_paquet"] = False
+    default_options["paquet_target_seconds"] = 1.0
+    default_options["paquet_max_bytes"] = 32 * 1024 * 1024
+    # destination writes grouped in one explicit transaction every N
+    # paquets, "N records" or "N seconds" (see parse_commit_every).
+    # DEFAULT None: every paquet is committed on its own (autocommit)
+    # SQLite allows a single write transaction at a time: use it with only
+    # one writer (workers, partitions and pipeline_writers) on SQLite
+    default_options["commit_every"] = None
+    # records insert method: AUTO (the fastest one supported by the
+    # destination dialect, with RETURNING for the tables with re-mapped
+    # primary keys), RETURNING (multi rows INSERT ... VALUES ... RETURNING),
+    # COPY (PostgreSQL COPY FROM STDIN, psycopg2),
+    # SQLITE (raw sqlite3 executemany), MULTI_VALUES (multi rows INSERT
+    # ... VALUES) or GENERIC (sqlalchemy executemany)
+    default_options["bulk_loader"] = "AUTO"
+    # if True the tables created on the destination are created without
+    # their indexes and foreign key constraints (kept inline on SQLite)
+    # that are built once all the records have been migrated, up to
+    # "index_workers" at the same time (one at a time on SQLite). The build
+    # times are saved in the table stats "indexes" and "constraints"
+    default_options["deferred_indexes"] = False
+    default_options["index_workers"] = 4
+    # foreign keys cycles between tables: APPEND (the tables in the cycles
+    # are dumped last as they are), NULLIFY (the cycles are broken dropping
+    # nullable foreign keys: the records are dumped with those columns set
+    # to NULL and back-filled at the end of the migration) or RAISE
+    # (graph.CycleError is raised)
+    default_options["fk_cycles"] = "APPEND"
+    # store of the re-mapped primary keys (old pk -> new pk) of every table:
+    # AUTO (compact array for dense integer keys that spills to a SQLite
+    # file in "pk_map_directory" when the keys are sparse or more than
+    # "pk_map_max_memory"), SQLITE (always on disk) or DICT (plain dict)
+    default_options["pk_map_store"] = "AUTO"
+    default_options["pk_map_max_memory"] = 10000000
+    default_options["pk_map_directory"] = None
+    # index of the destination primary keys used by the DIFF transfer mode
+    # (PK compare mode) to skip the records already migrated: AUTO (sorted
+    # array for integer keys, set for small tables and Bloom filter, whose
+    # positives are confirmed by the database, for the others), SORTED_ARRAY,
+    # BLOOM or SET. If "existence_index_directory" is set the indexes are
+    # saved there at the end of the migration and reused by the next runs if
+    # the tables did not change meanwhile. The tables whose primary keys are
+    # re-mapped are looked up through their primary keys maps, kept for the
+    # next runs (and saved in "existence_index_directory", if set)
+    default_options["existence_index"] = "AUTO"
+    default_options["existence_index_error_rate"] = 0.01
+    default_options["existence_index_directory"] = None
+    # DELTA transfer mode: the primary key space of every table is split in
+    # "delta_split" ranges whose checksums are compared between the source
+    # and the destination (by the databases if they have the same dialect
+    # and "delta_server_checksums" is True) and the ranges that differ are
+    # splitted again down to ranges of paquet records whose records are
+    # compared one by one: the missing records are inserted, the changed
+    # ones updated and the extra ones deleted (once all the tables are done,
+    # the tables that link to them first). The primary keys are copied (not
+    # re-mapped) so both sides ranges match
+    default_options["delta_split"] = 16
+    default_options["delta_server_checksums"] = True
+    # how compare (check_last_migration) compares the tables: ROWS (all the
+    # records of both sides are read and merged) or CHECKSUM (the checksums
+    # of primary key ranges are compared, like the DELTA transfer mode does
+    # with "delta_split" and "delta_server_checksums", and only the records
+    # of the ranges that differ are read)
+    default_options["compare_method"] = "ROWS"
+    # path of the file where compare (check_last_migration) writes the
+    # records missing from the destination, the extra ones and the changed
+    # ones (one JSON object per line). DEFAULT None: they are only counted
+    default_options["compare_diff_file"] = None
+    # path of the tables fingerprints manifest (see migrations.manifest).
+    # If set, the source and destination fingerprints (number of records,
+    # max primary key, max "manifest_updated_column" value and, if
+    # "manifest_checksums" is True, the checksum of all the records) of the
+    # migrated tables are saved at the end of every migration and the next
+    # migrations skip the tables whose fingerprints did not change.
+    # "manifest_updated_column" is a column name (used by the tables that
+    # have it) or a dict: table name -> column name
+    default_options["manifest"] = None
+    default_options["manifest_updated_column"] = None
+    default_options["manifest_checksums"] = False
+    # INCREMENTAL transfer mode: only the records whose "watermark_column"
+    # value (a last update timestamp or a monotonic id) is not lower than
+    # the high-water mark of the last migration are read and upserted into
+    # the destination (INSERT OR REPLACE on SQLite, ON CONFLICT on
+    # PostgreSQL, ON DUPLICATE KEY on MySQL, delete + insert on the other
+    # dialects). "watermark_column" is a column name (used by the tables
+    # that have it) or a dict: table name -> column name. The tables
+    # without it use their numeric single column primary key and the ones
+    # without both are transferred (upserted) whole. The marks are kept
+    # by the source Migrator and saved to the "watermarks" file (if any)
+    default_options["watermark_column"] = None
+    default_options["watermarks"] = None
+    # CAPTURE transfer mode: triggers installed on the source tables (SQLite
+    # and PostgreSQL, the first time a table is migrated, when all its
+    # records are transferred) log the keys of the records inserted,
+    # updated and deleted. The next migrations only upsert (or delete) the
+    # destination records of the logged keys and remove the changes applied
+    # from the log (see migrations.capture)
+
     def initialize(self):
         """
         Initializes instance database engine and database cached data
         """
         self.engine = build_engine(self.path)
+
+        # Tables reflected from the database (shared with the destination)
+        self.reflection = reflection.ReflectionCache(
+            self.options.get("reflection_cache")
+        )
         
-        # Dict to save destination data in case of diff dumpings
-        self._db_data = {}        
+        # Dict to save destination data in case of diff dumpings: table
+        # name -> (existence index, records), see migrations.existence
+        self._db_data = {}
+        self._existence = existence.IndexBuilder(
+            self.options.get("existence_index"),
+            self.options.get("existence_index_error_rate") or 0.01,
+            self.options.get("existence_index_directory"),
+            indexes=self._db_data
+        )
+
+        # Locks used to serialize the inserts into the same table
+        self._table_locks = {}
+        self._table_locks_lock = threading.Lock()
+
+        # Tables writer sessions: (table name, thread ident) -> TableWriter
+        self._writers = {}
+        # table name -> statements deferred by create_bare_table
+        self._deferred_ddl = {}
+        # primary keys maps created by get_pk_map (closed by
+        # finish_migration) and the ones of the last migration, kept for the
+        # comparisons (see get_compare_maps) until the next one finishes
+        self._pk_maps = []
+        self._last_pk_maps = []
+        # DIFF transfer mode primary keys maps, kept for the next migrations:
+        # table name -> map (see get_pk_map)
+        self._diff_pk_maps = {}
+        # tables whose records were checked to be found through their DIFF
+        # primary keys maps by the running migration (see get_diff_pk_map)
+        self._diff_checked = set()
+        # tables are created one at a time (see check_table)
+        self._create_lock = threading.RLock()
+        self._creating = set()
+
+        # links dropped by the source to break the tables FKs cycles:
+        # table name -> {column: (linked table, linked column)}
+        self.deferred_fks = {}
+        # table name -> [(pk, column, value)] of the links to back-fill
+        self._backfill = {}
+        # records deleted at the end of a DELTA migration: list of (table,
+        # (lower, upper) primary key range, primary keys or None for the
+        # whole range) in the order they were found
+        self._deletes = []
+        # tables fingerprints manifest of the running migration (see the
+        # "manifest" option)
+        self.manifest = None
+        self._manifest_tables = {}
+        # high-water marks of the INCREMENTAL transfer mode and the ones
+        # reached by the running migration (saved once it's completed)
+        self.watermarks = watermarks.WatermarkStore(
+            self.options.get("watermarks")
+        )
+        self._new_watermarks = {}
+        # last change logged of the tables captured by the running migration
+        # (CAPTURE transfer mode, removed from the log once it's completed)
+        self._captured = {}
+
+
+    def init_migration(self, destination):
+        """
+        see .base.MigratorBase.init_migration. Also shares the reflected
+        tables cache with the destination (if it's a dbms Migrator)
+        """
+        MigratorBase.init_migration(self, destination)
+
+        if not self.options.get("reflection_cache"):
+            # the database schemas may have changed since the last migration
+            self.reflection = reflection.ReflectionCache()
+
+        if isinstance(destination, Migrator):
+            destination.reflection = self.reflection
+
+        # fingerprints of the tables migrated (see migration_completed)
+        self.manifest = None
+        self._manifest_tables = {}
+        self._new_watermarks = {}
+        self._captured = {}
+        if self.options.get("manifest"):
+            self.manifest = manifest.ManifestStore(self.options["manifest"])
 
 
     def _migrate(self, destination, tables=None, paquet=10000, exclude=None):
@@ -32,57 +251,470 @@ class Migrator(MigratorBase):
         if exclude is None:
             exclude = []
 
-        # some boilerplate code to create the source and destinations sessions
-        source = sessionmaker(bind=self.engine)()
-        meta = MetaData()
-
         self.exceptions = []  # We can save the exections for debug reasons
 
         # Now we should have a clear view of what are the links and constraints
         # So we can define the order of the data dumping
         tables_order = self.get_tables_dump_order(tables)
+        dependencies = scheduling.get_tables_dependencies(
+            tables_order,
+            self.stats["tables_graph"]["fks"]
+        )
+
+        # the foreign keys dropped to break the tables cycles are back-filled
+        # by the destination
+        if isinstance(destination, Migrator):
+            destination.deferred_fks = \
+                self.stats["tables_graph"]["deferred_fks"]
+
+        if self._pipeline is not None:
+            # the links that close a cycle must not lock the writers
+            self._pipeline.dependencies = dependencies
 
         # Now we can look over the tables in the right order to avoid having
         # FKs troubles
-        source = sessionmaker(bind=self.engine)()
+        migrate_table = partial(self.migrate_table,
+                                destination,
+                                paquet = paquet,
+                                exclude = exclude)
+
+        workers = self.options.get("workers") or 1
+        if workers > 1:
+            # tables are started as soon as the tables they depend on are done
+            scheduling.run_dependency_graph(tables_order,
+                                            dependencies,
+                                            migrate_table,
+                                            workers)
+        else:
+            for table_name in tables_order:
+                migrate_table(table_name)
+
+        self.reflection.save()
+        return self.exceptions
 
-        for table_name in tables_order:
-            tab_stats = self.get_table_stats(table_name)
 
-            if exclude:
-                exclusions_regex = "(" + ")|(".join(exclude) + ")"
-                matches = re.match(exclusions_regex, table_name)
-                if matches: #table_name in exclude:
-                    msg = "skipped table %s   as requested on %s" % (table_name,
-                                                                     exclude)
-                    self.log_cb(msg)
+    def migrate_table(self, destination, table_name, paquet=10000,
+                      exclude=None):
+        """
+        Transfers all the records of the table named table_name to the
+        destination using a dedicated source connection. It's safe to call it
+        from different threads for different tables at the same time.
+
+        see _migrate for the parameters details
+        """
+        tab_stats = self.get_table_stats(table_name)
+
+        if exclude:
+            exclusions_regex = "(" + ")|(".join(exclude) + ")"
+            matches = re.match(exclusions_regex, table_name)
+            if matches: #table_name in exclude:
+                msg = "skipped table %s   as requested on %s" % (table_name,
+                                                                 exclude)
+                self.log_cb(msg)
+                with self._stats_lock:
                     self.stats["messages"].append(msg)
                     tab_stats["messages"].append(msg)
                     tab_stats["skipped"] = True
                     self.stats["tables"][table_name] = tab_stats
+                return
+
+        if self.checkpoint is not None:
+            # when resuming a migration we need the primary keys mapping of
+            # the records already migrated for the tables that link to them
+            if isinstance(destination, Migrator):
+                pk_map = destination.get_pk_map(table_name)
+            else:
+                pk_map = tab_stats["pk_map"]
+            pk_map.update(self.checkpoint.iter_pk_map(table_name))
+
+            if self.checkpoint.is_done(table_name):
+                msg = "skipped table %s   already migrated (checkpoint)" % (
+                    table_name)
+                self.log_cb(msg)
+                with self._stats_lock:
+                    tab_stats["messages"].append(msg)
+                return
+
+        if self.manifest is not None:
+            fingerprints = self.get_fingerprints(destination, table_name)
+            if self.manifest.is_unchanged(table_name, *fingerprints):
+                msg = "skipped table %s   unchanged since the last " \
+                      "migration (manifest)" % table_name
+                self.log_cb(msg)
+                with self._stats_lock:
+                    self.stats["messages"].append(msg)
+                    tab_stats["messages"].append(msg)
+                    tab_stats["skipped"] = True
+                return
+
+            # the source fingerprint is saved as it was before the transfer
+            # so the records written meanwhile are migrated by the next run
+            with self._stats_lock:
+                self._manifest_tables[table_name] = fingerprints[0]
+
+        self.log_cb("\n\nmigrating %s" % table_name)
+        table = self.reflection.get_table(self.engine, table_name)
+
+        if self.options.get("transfer_mode") == "DELTA":
+            self.delta_table(destination, table, paquet)
+            self.deliver(destination, None, table,
+                         partial(destination.finish_table, table))
+            return
+
+        if self.options.get("transfer_mode") == "INCREMENTAL":
+            self.incremental_table(destination, table, paquet)
+            self.deliver(destination, None, table,
+                         partial(destination.finish_table, table))
+            return
+
+        if self.options.get("transfer_mode") == "CAPTURE":
+            self.capture_table(destination, table, paquet)
+            self.deliver(destination, None, table,
+                         partial(destination.finish_table, table))
+            return
+
+        # Big tables can be split in primary key ranges that are read and
+        # dumped at the same time (each on its own connection)
+        pk_ranges = None
+        if self.checkpoint is not None:
+            pk_ranges = self.checkpoint.get_pk_ranges(table_name)
+
+        if pk_ranges is None:
+            pk_ranges = [(None, None)]
+            partitions = self.options.get("partitions") or 1
+            if partitions > 1:
+                pk_ranges = self.get_pk_ranges(table, partitions)
+
+            if self.checkpoint is not None:
+                self.checkpoint.save_pk_ranges(table_name, pk_ranges)
+
+        if len(pk_ranges) > 1:
+            tab_stats["pk_ranges"] = pk_ranges
+
+        if len(pk_ranges) > 1:
+            self.log_cb("%s splitted in %s primary key ranges" % (
+                table_name, len(pk_ranges)))
+            # the ranges write the primary keys map in any order
+            self.reserve_pk_map(destination, table)
+            scheduling.run_dependency_graph(
+                pk_ranges,
+                {},
+                partial(self.transfer_records, destination, table, paquet),
+                len(pk_ranges)
+            )
+        else:
+            self.transfer_records(destination, table, paquet, pk_ranges[0])
+
+        # the destination can release the table resources
+        self.deliver(destination, None, table,
+                     partial(destination.finish_table, table))
+
+        if self.checkpoint is not None:
+            self.deliver(destination, None, table,
+                         partial(self.checkpoint.table_done, table_name))
+
+
+    def get_fingerprints(self, destination, table_name):
+        """
+        Returns the (source, destination) fingerprints of the table named
+        table_name (see manifest.get_fingerprint). The destination
+        fingerprint is None if it's not a dbms Migrator or it has no such
+        table
+        """
+        table = self.reflection.get_table(self.engine, table_name)
+        conn = self.engine.connect()
+        try:
+            source = manifest.get_fingerprint(
+                conn, table, *self.get_fingerprint_options(table_name))
+        finally:
+            conn.close()
+
+        return source, self.get_destination_fingerprint(destination,
+                                                        table_name)
+
+
+    def get_destination_fingerprint(self, destination, table_name):
+        """ see get_fingerprints. Returns the destination fingerprint """
+        if not isinstance(destination, Migrator) or \
+                not destination.reflection.has_table(destination.engine,
+                                                     table_name):
+            return None
+
+        dest_table = destination.reflection.get_table(destination.engine,
+                                                      table_name)
+        conn = destination.engine.connect()
+        try:
+            return manifest.get_fingerprint(
+                conn, dest_table, *self.get_fingerprint_options(table_name))
+        finally:
+            conn.close()
+
+
+    def get_fingerprint_options(self, table_name):
+        """
+        returns the (updated column, checksum) arguments of the table_name
+        fingerprints (see manifest.get_fingerprint)
+        """
+        updated_column = self.options.get("manifest_updated_column")
+        if isinstance(updated_column, dict):
+            updated_column = updated_column.get(table_name)
+
+        return updated_column, bool(self.options.get("manifest_checksums"))
+
+
+    def migration_completed(self, destination):
+        """
+        see .base.MigratorBase.migration_completed. Saves the high-water
+        marks reached (INCREMENTAL transfer mode), removes the changes
+        applied from the change log (CAPTURE transfer mode) and saves the
+        fingerprints of the tables migrated to the manifest (if any)
+        """
+        if self._captured:
+            changes = capture.get_change_table()
+            conn = self.engine.connect()
+            try:
+                for table_name, last_change in self._captured.items():
+                    capture.delete_changes(conn, changes, table_name,
+                                           last_change)
+            finally:
+                conn.close()
+            self._captured = {}
+
+        if self._new_watermarks:
+            for table_name, value in self._new_watermarks.items():
+                self.watermarks.set(table_name, value)
+            self.watermarks.save()
+            self._new_watermarks = {}
+
+        if self.manifest is None:
+            return
+
+        for table_name, source in self._manifest_tables.items():
+            self.manifest.set(table_name, source,
+                              self.get_destination_fingerprint(destination,
+                                                               table_name))
+        self.manifest.save()
+
+
+    def capture_table(self, destination, table, paquet):
+        """
+        Applies to the destination the changes of the table logged since the
+        last migration (CAPTURE transfer mode): the source records of the
+        changed primary keys are read again, in primary key order and in
+        paquet sized batches, and delivered to the destination (that
+        upserts them) and the destination records whose keys are no longer
+        in the source are deleted.
+
+        The first time the capture triggers are installed and all the
+        records are transferred. Tables that can't be captured (no single
+        column primary key, source dialect or destination not supported)
+        are transferred whole every time
+        """
+        tab_stats = self.get_table_stats(table.name)
+        stats = {"initial": False, "changed": 0, "upserted": 0, "deleted": 0}
+        with self._stats_lock:
+            tab_stats["capture"] = stats
+
+        pk_cols = list(table.primary_key.columns)
+        if len(pk_cols) != 1 or not isinstance(destination, Migrator) or \
+                not capture.supports_capture(self.engine.dialect):
+            self.log_cb("%s changes can't be captured, transferring all the "
+                        "records" % table.name)
+            self.transfer_records(destination, table, paquet)
+            return
+
+        pk_col = pk_cols[0]
+        conn = self.engine.connect()
+        try:
+            if not capture.is_installed(conn, table):
+                # the changes made while the records are read are applied
+                # again by the next migration
+                capture.install(conn, table)
+                self.log_cb("%s changes captured from now on, transferring "
+                            "all the records" % table.name)
+                stats["initial"] = True
+                self.transfer_records(destination, table, paquet)
+                return
+
+            changes = capture.get_change_table()
+            last_change = capture.get_last_change(conn, changes, table.name)
+            if last_change is None:
+                return
+
+            max_params = loaders.MAX_PARAMS.get(self.engine.dialect.name,
+                                                loaders.DEFAULT_MAX_PARAMS)
+            stmt = capture.get_changed_pks(conn, changes, pk_col, table.name,
+                                           last_change)
+            for paquets in self.read_paquets(conn, stmt, paquet):
+                pks = [row["pk"] for row in paquets]
+                records = []
+                for i in range(0, len(pks), max_params):
+                    records.extend(conn.execute(
+                        sa.select([table]).where(
+                            pk_col.in_(pks[i:i + max_params])
+                        ).order_by(pk_col)
+                    ).fetchall())
+
+                found = set(row[pk_col] for row in records)
+                deleted = [pk for pk in pks if pk not in found]
+                if records:
+                    self.deliver(destination, records, table)
+                if deleted:
+                    self.deliver(destination, None, table, partial(
+                        destination.delete_records, table, deleted))
+
+                with self._stats_lock:
+                    stats["changed"] += len(pks)
+                    stats["upserted"] += len(records)
+                    stats["deleted"] += len(deleted)
+        finally:
+            conn.close()
+
+        with self._stats_lock:
+            self._captured[table.name] = last_change
+
+        self.log_cb("%s: %s records changed (%s upserted, %s deleted)" % (
+            table.name, stats["changed"], stats["upserted"], stats["deleted"]))
+
+
+    def get_watermark_column(self, table):
+        """
+        returns the watermark column of table (see the "watermark_column"
+        option) or None
+        """
+        name = self.options.get("watermark_column")
+        if isinstance(name, dict):
+            name = name.get(table.name)
+        if name is not None and name in table.c:
+            return table.c[name]
+
+        pk_cols = list(table.primary_key.columns)
+        if len(pk_cols) == 1 and is_numeric_column(pk_cols[0]):
+            return pk_cols[0]
+
+        return None
+
+
+    def incremental_table(self, destination, table, paquet):
+        """
+        Transfers to the destination (INCREMENTAL transfer mode) the table
+        records whose watermark column value is not lower than the table
+        high-water mark, in watermark order. The records equal to the mark
+        are read again (the destination upserts them) so the records that
+        have the same watermark value as the last one read are not lost.
+        The new mark is saved once the migration is completed
+        """
+        tab_stats = self.get_table_stats(table.name)
+        column = self.get_watermark_column(table)
+        mark = self.watermarks.get(table.name)
+
+        stmt = sa.select([table])
+        if column is None:
+            self.log_cb("%s has no watermark column, transferring all the "
+                        "records" % table.name)
+        else:
+            if mark is not None:
+                stmt = stmt.where(column >= mark)
+            stmt = stmt.order_by(column)
+
+        new_mark = mark
+        records = 0
+        conn = self.engine.connect()
+        try:
+            for paquets in self.read_paquets(conn, stmt, paquet):
+                self.deliver(destination, paquets, table)
+                records += len(paquets)
+                if column is None:
                     continue
 
-            self.log_cb("\n\nmigrating %s" % table_name)
-            table = Table(table_name, meta, autoload=True,
-                          autoload_with=self.engine)
+                values = [row[column] for row in paquets
+                          if row[column] is not None]
+                if values and (new_mark is None or max(values) > new_mark):
+                    new_mark = max(values)
+        finally:
+            conn.close()
+
+        with self._stats_lock:
+            tab_stats["watermark"] = {
+                "column": column.name if column is not None else None,
+                "from": mark,
+                "to": new_mark,
+                "records": records,
+            }
+            if new_mark is not None and new_mark != mark:
+                self._new_watermarks[table.name] = new_mark
+
+
+    def transfer_records(self, destination, table, paquet, pk_range=None):
+        """
+        Transfers the records of table to the destination in paquet sized
+        chunks using a dedicated source connection.
+
+        INPUTS:
+
+        destination ::: Migrator object that receives the records
 
-            # Let's prepare the sql results
-            result = source.execute(sa.select([table]))
+        table ::: sqlalchemy table object reflected from the source database
+
+        paquet ::: maximum number of records dumped at once
+
+        pk_range ::: (lower, upper) tuple that limits the transferred records
+                    to lower <= pk < upper (None means no limit). If None all
+                    the table records are transferred
+        """
+        # progress of the migration being resumed (if any)
+        last_pk, records = None, 0
+        if self.checkpoint is not None:
+            last_pk, records = self.checkpoint.get_progress(table.name,
+                                                            pk_range)
+            if records:
+                self.log_cb("resuming %s after %s records" % (table.name,
+                                                              records))
+
+        # the paquet size may be tuned paquet after paquet (see the
+        # "adaptive_paquet" option)
+        sizer = sizing.PaquetSizer(
+            paquet,
+            target_seconds = self.options.get("paquet_target_seconds"),
+            max_bytes = self.options.get("paquet_max_bytes"),
+            adaptive = self.options.get("adaptive_paquet")
+        )
+        tab_stats = self.get_table_stats(table.name)
+
+        source = self.engine.connect()
+        try:
             self.log_cb('Transferring records')
 
             # Let's start transfering the data dividing it in paquet sized
             # chuncks
-            done = False
-            while not done:
+            paquets_reader = self.read_table(source, table, sizer, pk_range,
+                                             last_pk, records)
+            while True:
+                started = time.time()
+                paquets = next(paquets_reader, None)
+                if paquets is None:
+                    break
+
+                fetched = time.time()
                 try:
-                    # Let's fetch the chunks from the prepared sql select
-                    paquets = result.fetchmany(paquet)
                     self.log_cb("records to transfer: %s" % len(paquets))
 
-                    if len(paquets) == 0:
-                        done = True
-                    else:
-                        destination.dump(paquets, table)
+                    records += len(paquets)
+                    callback = None
+                    if self.checkpoint is not None:
+                        callback = partial(self.save_checkpoint, table,
+                                           pk_range, paquets, records)
+
+                    self.deliver(destination, paquets, table, callback)
+
+                    if sizer.adaptive:
+                        with self._stats_lock:
+                            tab_stats.setdefault("paquet_sizes", []).append(
+                                int(sizer))
+                        sizer.update(len(paquets),
+                                     pipeline.get_records_size(paquets),
+                                     fetched - started,
+                                     time.time() - fetched)
 
                 except Exception, e:
                     err_msg = u"""Error dumping table [%s] on destination. \
@@ -91,180 +723,904 @@ class Migrator(MigratorBase):
                     self.log_cb(err_msg)
                     raise
 
-        del source
-        return self.exceptions
-    
-    
+            self.deliver(destination, None, table,
+                         partial(destination.flush_table, table))
+        finally:
+            source.close()
+
+
+    def delta_table(self, destination, table, paquet):
+        """
+        Synchronizes the destination table with the source table records in
+        DELTA transfer mode: only the primary key ranges whose checksums
+        differ are compared (and transferred) record by record. The ranges
+        are splitted (in "delta_split" ranges) until they have no more than
+        paquet records.
+
+        Tables without a single column primary key (and destinations that
+        are not dbms Migrators) are transferred again if their checksums
+        differ.
+        """
+        tab_stats = self.get_table_stats(table.name)
+        delta = {"ranges": 0, "ranges_equal": 0, "inserted": 0,
+                 "updated": 0, "deleted": 0}
+        with self._stats_lock:
+            tab_stats["delta"] = delta
+
+        if not isinstance(destination, Migrator):
+            self.log_cb("%s: DELTA transfer mode needs a dbms destination, "
+                        "transferring all the records" % table.name)
+            self.transfer_records(destination, table, paquet)
+            return
+
+        dest_table = destination.get_or_create_table(table)
+        if dest_table is None:
+            return
+
+        columns = [col for col in table.columns if col.name in dest_table.c]
+        dest_columns = [dest_table.c[col.name] for col in columns]
+        pk_cols = list(table.primary_key.columns)
+        pk_col = dest_pk_col = None
+        if len(pk_cols) == 1 and pk_cols[0].name in dest_table.c:
+            pk_col = pk_cols[0]
+            dest_pk_col = dest_table.c[pk_col.name]
+
+        server = bool(self.options.get("delta_server_checksums")) and \
+            checksums.use_server_checksums(self.engine.dialect,
+                                           destination.engine.dialect)
+        parts = max(2, self.options.get("delta_split") or 16)
+
+        source = self.engine.connect()
+        dest = destination.engine.connect()
+        try:
+            ranges = [(None, None)]
+            while ranges:
+                lower, upper = ranges.pop()
+                src = checksums.get_checksum(source, table, pk_col, lower,
+                                             upper, columns, server)
+                dst = checksums.get_checksum(dest, dest_table, dest_pk_col,
+                                             lower, upper, dest_columns,
+                                             server)
+                delta["ranges"] += 1
+                if src == dst:
+                    delta["ranges_equal"] += 1
+                    continue
+
+                if pk_col is None:
+                    # the whole table is transferred again
+                    self.log_cb("%s changed, transferring all the records" %
+                                table.name)
+                    self.deliver(destination, None, table, partial(
+                        destination.delete_records, table, deferred=False))
+                    delta["deleted"] += dst.count
+                    delta["inserted"] += src.count
+                    self.transfer_records(destination, table, paquet)
+                    break
+
+                if not dst.count or not src.count:
+                    # nothing to compare: the range records are copied or
+                    # deleted at once
+                    if src.count:
+                        self.transfer_records(destination, table, paquet,
+                                              (lower, upper))
+                        delta["inserted"] += src.count
+                    else:
+                        self.deliver(destination, None, table, partial(
+                            destination.delete_records, table,
+                            pk_range=(lower, upper)))
+                        delta["deleted"] += dst.count
+                    continue
+
+                limits = []
+                if max(src.count, dst.count) > paquet:
+                    limits = self.get_delta_limits(source, table, pk_col,
+                                                   lower, upper, src, dst,
+                                                   parts)
+                if limits:
+                    bounds = [lower] + limits + [upper]
+                    # the ranges are popped in primary key order
+                    ranges.extend(reversed(zip(bounds[:-1], bounds[1:])))
+                else:
+                    self.sync_range(destination, source, dest, table,
+                                    dest_table, columns, dest_columns,
+                                    lower, upper, delta)
+        finally:
+            source.close()
+            dest.close()
+
+        self.log_cb("%s: %s ranges compared (%s equal), %s records inserted,"
+                    " %s updated, %s deleted" % (
+                        table.name, delta["ranges"], delta["ranges_equal"],
+                        delta["inserted"], delta["updated"],
+                        delta["deleted"]))
+
+
+    def get_delta_limits(self, conn, table, pk_col, lower, upper, src, dst,
+                         parts):
+        """
+        Returns the limits that split the lower <= pk < upper range (whose
+        source and destination checksums are src and dst) in parts ranges.
+        Numeric primary keys are splitted in equal ranges between the min
+        and max values of both sides and the other ones at their (source)
+        quantiles
+        """
+        if is_numeric_column(pk_col):
+            min_pk = min(src.min_pk, dst.min_pk)
+            max_pk = max(src.max_pk, dst.max_pk)
+            limits = get_minmax_limits(min_pk, max_pk, parts)
+        else:
+            limits = []
+            for i in range(1, parts):
+                stmt = checksums.where_range(
+                    sa.select([pk_col]).order_by(pk_col).limit(1),
+                    pk_col, lower, upper
+                ).offset(src.count * i / parts)
+                limit = conn.execute(stmt).scalar()
+                if limit is not None and limit not in limits:
+                    limits.append(limit)
+
+        return [limit for limit in limits
+                if (lower is None or limit > lower) and
+                (upper is None or limit < upper)]
+
+
+    def sync_range(self, destination, source, dest, table, dest_table,
+                   columns, dest_columns, lower, upper, delta):
+        """
+        Compares record by record the source and destination records where
+        lower <= pk < upper and delivers to the destination the records to
+        insert, update and delete
+        """
+        pk_col = list(table.primary_key.columns)[0]
+        dest_hashes = checksums.get_row_hashes(
+            dest, dest_table, dest_table.c[pk_col.name], lower, upper,
+            dest_columns
+        )
+
+        stmt = checksums.where_range(
+            sa.select([table]).order_by(pk_col), pk_col, lower, upper
+        )
+        new, changed = [], []
+        for row in source.execute(stmt).fetchall():
+            dest_hash = dest_hashes.pop(row[pk_col], None)
+            if dest_hash is None:
+                new.append(row)
+            elif dest_hash != checksums.hash_row([row[col] for col in columns]):
+                changed.append(row)
+
+        if new:
+            self.deliver(destination, new, table)
+        if changed:
+            self.deliver(destination, None, table, partial(
+                destination.update_records, table, changed))
+        if dest_hashes:
+            self.deliver(destination, None, table, partial(
+                destination.delete_records, table, dest_hashes.keys()))
+
+        with self._stats_lock:
+            delta["inserted"] += len(new)
+            delta["updated"] += len(changed)
+            delta["deleted"] += len(dest_hashes)
+
+
+    def save_checkpoint(self, table, unit, paquets, records):
+        """
+        Saves the progress of the unit (primary key range) of table after
+        paquets have been dumped: the primary key of the last record, the
+        number of records already written and the primary keys mapping of
+        the paquets records
+        """
+        last_pk = None
+        pk_map = []
+        pk_cols = list(table.primary_key.columns)
+        if len(pk_cols) == 1:
+            pk_col = pk_cols[0]
+            last_pk = paquets[-1][pk_col]
+            tab_pk_map = self.get_table_stats(table.name)["pk_map"]
+            old_pks = [row[pk_col] for row in paquets]
+            new_pks = pkmaps.get_many(tab_pk_map, old_pks)
+            pk_map = [(old_pk, new_pks[old_pk])
+                      for old_pk in old_pks if old_pk in new_pks]
+
+        self.checkpoint.save_progress(table.name, unit, last_pk, records,
+                                      pk_map)
+
+
+    def read_table(self, conn, table, paquet, pk_range=None, last_pk=None,
+                   offset=0):
+        """
+        Reads the table records from the source connection conn and yields
+        them in lists of at most paquet records using the source read
+        strategy defined by the "read_mode" option:
+
+            CURSOR -> (DEFAULT) a single select whose records are fetched
+                      from the same (long lived) cursor. See read_paquets
+
+            KEYSET -> one short select per paquet ordered by primary key:
+                      SELECT ... WHERE pk > :last ORDER BY pk LIMIT :paquet
+                      Records are delivered in primary key order. Only
+                      available for tables with a single column primary
+                      key, other tables are read in CURSOR mode
+
+        pk_range ::: (lower, upper) tuple that limits the records read to
+                    lower <= pk < upper (None means no limit)
+
+        last_pk, offset ::: progress of a migration being resumed. Only the
+                    records with a primary key greater than last_pk (tables
+                    with a single column primary key) or after the first
+                    offset records (other tables) are read
+
+        When the migration saves checkpoints the records are always read in
+        a deterministic order (primary key or all columns) so they can be
+        resumed.
+        """
+        lower, upper = pk_range or (None, None)
+        pk_cols = list(table.primary_key.columns)
+
+        if self.options.get("read_mode") == "KEYSET":
+            if len(pk_cols) == 1:
+                return self.read_paquets_keyset(conn, table, pk_cols[0],
+                                                paquet, lower, upper, last_pk)
+
+            self.log_cb("%s has no single column primary key, keyset read "
+                        "mode not available" % table.name)
+
+        stmt = sa.select([table])
+        if lower is not None:
+            stmt = stmt.where(pk_cols[0] >= lower)
+        if upper is not None:
+            stmt = stmt.where(pk_cols[0] < upper)
+
+        if self.checkpoint is not None:
+            # resumable reads need a deterministic records order
+            stmt = stmt.order_by(*(pk_cols or list(table.columns)))
+            if len(pk_cols) == 1 and last_pk is not None:
+                stmt = stmt.where(pk_cols[0] > last_pk)
+            elif offset:
+                stmt = stmt.offset(offset)
+
+        return self.read_paquets(conn, stmt, paquet)
+
+
+    def read_paquets_keyset(self, conn, table, pk_col, paquet, lower=None,
+                            upper=None, last=None):
+        """
+        Yields the table records in lists of at most paquet records ordered
+        by pk_col running a new short query for every paquet (keyset
+        pagination) so no cursor is kept open between paquets.
+
+        lower, upper ::: limit the records read to lower <= pk < upper
+
+        last ::: primary key value of the last record already read. Only
+                    records with a greater primary key are read
+        """
+        while True:
+            limit = int(paquet)
+            stmt = sa.select([table]).order_by(pk_col).limit(limit)
+            if last is not None:
+                stmt = stmt.where(pk_col > last)
+            elif lower is not None:
+                stmt = stmt.where(pk_col >= lower)
+            if upper is not None:
+                stmt = stmt.where(pk_col < upper)
+
+            paquets = conn.execute(stmt).fetchall()
+            if not paquets:
+                break
+
+            yield paquets
+
+            if len(paquets) < limit:
+                break
+
+            last = paquets[-1][pk_col]
+
+
+    def read_paquets(self, conn, stmt, paquet):
+        """
+        Executes the select statement stmt on the source connection conn and
+        yields its records in lists of at most paquet records. paquet can be
+        a migrations.sizing.PaquetSizer, in this case the size of every
+        paquet is read from it.
+
+        If the "stream_results" option is set the records are read through a
+        server side cursor (i.e. psycopg2 named cursors) so only the records
+        being fetched are loaded in memory instead of the whole result set.
+        In this case the fetch size starts at "stream_fetch_size" records and
+        doubles at every fetch until it reaches paquet, so the first records
+        are delivered as soon as possible.
+
+        On dialects without server side cursors support the records are read
+        as usual.
+        """
+        fetch_size = int(paquet)
+        if self.options.get("stream_results"):
+            stmt = stmt.execution_options(stream_results=True)
+            fetch_size = min(fetch_size,
+                             self.options.get("stream_fetch_size") or fetch_size)
+
+        result = conn.execute(stmt)
+        try:
+            while True:
+                paquets = result.fetchmany(fetch_size)
+                if not paquets:
+                    break
+
+                yield paquets
+                fetch_size = min(int(paquet), fetch_size * 2)
+        finally:
+            result.close()
+
+
+    def reserve_pk_map(self, destination, table):
+        """
+        Reserves the destination primary keys map of table (if its primary
+        keys are re-mapped) for the source primary keys range (see
+        pkmaps.PKMap.reserve)
+        """
+        pk_cols = list(table.primary_key.columns)
+        if not isinstance(destination, Migrator) or len(pk_cols) != 1 or \
+                not is_numeric_column(pk_cols[0]) or \
+                not pk_cols[0].autoincrement or \
+                self.options.get("transfer_mode") in COPY_PK_MODES:
+            return
+
+        pk_col = pk_cols[0]
+        conn = self.engine.connect()
+        try:
+            min_pk, max_pk, count = conn.execute(sa.select([
+                sa.func.min(pk_col), sa.func.max(pk_col), sa.func.count()
+            ])).fetchone()
+        finally:
+            conn.close()
+
+        if count:
+            destination.get_pk_map(table.name).reserve(min_pk, max_pk, count)
+
+
+    def get_pk_ranges(self, table, partitions):
+        """
+        Splits the table records in (at most) partitions primary key ranges.
+
+        Tables with a single numeric primary key column are splitted in equal
+        ranges between the min and max primary key values unless the
+        "partition_strategy" option is "QUANTILES". In this case (and for
+        other single column primary keys) the ranges limits are the primary
+        key quantiles so every range has the same number of records.
+
+        OUTPUT:
+
+        list of (lower, upper) tuples where lower <= pk < upper. The first
+        lower and the last upper limits are None. Tables without a single
+        column primary key are not splitted: [(None, None)]
+        """
+        pk_cols = list(table.primary_key.columns)
+        if len(pk_cols) != 1:
+            return [(None, None)]
+
+        pk_col = pk_cols[0]
+        strategy = self.options.get("partition_strategy") or "MINMAX"
+
+        conn = self.engine.connect()
+        try:
+            if is_numeric_column(pk_col) and strategy == "MINMAX":
+                min_pk, max_pk = conn.execute(
+                    sa.select([sa.func.min(pk_col), sa.func.max(pk_col)])
+                ).fetchone()
+                limits = get_minmax_limits(min_pk, max_pk, partitions)
+
+            else:
+                total = conn.execute(
+                    sa.select([sa.func.count()]).select_from(table)
+                ).scalar()
+                limits = []
+                for i in range(1, partitions):
+                    stmt = sa.select([pk_col]).order_by(pk_col).limit(1)
+                    stmt = stmt.offset(total * i / partitions)
+                    limit = conn.execute(stmt).scalar()
+                    if limit is not None and limit not in limits:
+                        limits.append(limit)
+        finally:
+            conn.close()
+
+        limits = [None] + limits + [None]
+        return zip(limits[:-1], limits[1:])
+
+
     def _compare(self, destination, tables=None, paquet=10000, exclude=None):
-        
+        """
+        Compares the source tables records with the destination ones (see
+        comparison.compare_tables): both sides are read sorted by primary key
+        in paquet sized batches and merged. With the CHECKSUM
+        "compare_method" only the records of the primary key ranges whose
+        checksums differ are read (see compare_checksums). The differences
+        are written to the "compare_diff_file" file (if any).
+
+        The re-mapped primary and foreign keys are compared through the
+        primary keys maps of the last migration (see get_compare_maps). The
+        tables whose keys were re-mapped by a migration whose map is not
+        available can't be compared by key: only their number of records
+        and checksums are (see comparison.compare_checksums_only).
+
+        Returns a dict that maps every table compared to its summary (also
+        saved in the table stats "compare")
+        """
         # If not tables specified we grab all tables from the source
         if not tables:
-            tables = self.engine.table_names()
+            tables = [name for name in self.engine.table_names()
+                      if name != capture.CHANGE_TABLE]
             
         if exclude is None:
             exclude = []
 
-        # some boilerplate code to create the source and destinations sessions
-        source = sessionmaker(bind=self.engine)()
-        meta = MetaData()
-
-        # Now we should have a clear view of what are the links and constraints
-        # So we can define the order of the data dumping
-        tables_order = self.get_tables_dump_order(tables)
+        method = (self.options.get("compare_method") or "ROWS").upper()
+        if method not in ("ROWS", "CHECKSUM"):
+            raise ValueError("unknown compare method: %s" % method)
 
-        
         out = {}  # output dictionary
 
+        diff_writer = comparison.DiffWriter(
+            self.options.get("compare_diff_file")
+        )
         conn = self.engine.connect()
-        for table_name in tables_order:
-            #tab_stats = self.get_table_stats(table_name)
-            out[table_name] = []
-            
-            if exclude:
-                exclusions_regex = "(" + ")|(".join(exclude) + ")"
-                matches = re.match(exclusions_regex, table_name)
-                if matches: #table_name in exclude:
-                    msg = "skipped table %s   as requested on %s" % (table_name,
-                                                                     exclude)
-                    self.log_cb(msg)
-                    continue
-
-            #self.log_cb("\n\nmigrating %s" % table_name)
-            table = Table(table_name, meta, autoload=True,
-                          autoload_with=self.engine)
-            
-            fk_mappings = self.get_table_fks_mapping(table
-                                                     )
-            # Let's prepare the sql results
-            result = conn.execute(sa.select([table]))
-            self.log_cb('checking records %s' % table.name)
-
-            # Let's start transfering the data dividing it in paquet sized
-            # chuncks
-            done = False
-            records_checked = 0
-            while not done:
+        dest_conn = destination.engine.connect()
+        try:
+            for table_name in tables:
+                if exclude:
+                    exclusions_regex = "(" + ")|(".join(exclude) + ")"
+                    matches = re.match(exclusions_regex, table_name)
+                    if matches: #table_name in exclude:
+                        msg = "skipped table %s   as requested on %s" % (
+                            table_name, exclude)
+                        self.log_cb(msg)
+                        continue
+
+                table = self.reflection.get_table(self.engine, table_name)
+                self.log_cb('checking records %s' % table.name)
                 try:
-                    # Let's fetch the chunks from the prepared sql select
-                    paquets = result.fetchmany(paquet)
-                    self.log_cb("records to check: %s" % len(paquets))
-                    out[table_name] = skip_records_full_in_memory(paquets, table,conn)
-                    records_checked += len(paquets)
-                    self.log_cb("checked: %s" % records_checked)
-                    #destination.dump(paquets, table)
-                    if len(paquets) == 0:
-                        done = True
-
+                    dest_table = None
+                    if destination.reflection.has_table(destination.engine,
+                                                        table_name):
+                        dest_table = destination.reflection.get_table(
+                            destination.engine, table_name
+                        )
+                    key_maps = {}
+                    if dest_table is not None:
+                        key_maps = self.get_compare_maps(conn, table,
+                                                         dest_table)
+                    if key_maps is None:
+                        msg = "%s records can't be compared by key: its " \
+                            "keys were re-mapped" % table_name
+                        self.log_cb(msg)
+                        summary = comparison.compare_checksums_only(
+                            conn, table, dest_conn, dest_table,
+                            self.get_remapped_columns(dest_table)
+                        )
+                    elif method == "CHECKSUM":
+                        summary = self.compare_checksums(
+                            destination, conn, table, dest_conn, dest_table,
+                            diff_writer, paquet, key_maps
+                        )
+                    else:
+                        summary = comparison.compare_tables(
+                            conn, table, dest_conn, dest_table, diff_writer,
+                            paquet, key_maps=key_maps
+                        )
                 except Exception, e:
-                    err_msg = u"""Error dumping table [%s] on destination. \
-                    Error details: %s"""%(table.name, e.message)
+                    err_msg = u"""Error comparing table [%s] with destination. \
+                    Error details: %s"""%(table.name, e)
                     self.exceptions.append(err_msg)
                     self.log_cb(err_msg)
                     raise
 
-        del source
-        conn.close()
+                out[table_name] = summary
+                self.get_table_stats(table_name)["compare"] = summary
+                self.log_cb("%s: %s records checked, %s missing, %s extra, %s "
+                            "changed" % (table_name, summary["source"],
+                                         summary["missing"], summary["extra"],
+                                         summary["changed"]))
+        finally:
+            diff_writer.close()
+            dest_conn.close()
+            conn.close()
+
         return out
             
         
         
+    def get_remapped_columns(self, dest_table):
+        """
+        Returns the dict of the dest_table columns whose values are
+        re-mapped by the migrations: the autoincrement primary key and the
+        foreign keys linking to one (column name -> name of the table whose
+        primary keys map maps them). Empty for the transfer modes that copy
+        the primary keys
+        """
+        transfer_mode = self.options.get(
+            "transfer_mode", self.default_options.get("transfer_mode")
+        )
+        if transfer_mode in COPY_PK_MODES:
+            return {}
+
+        columns = {}
+        pk_cols = list(dest_table.primary_key.columns)
+        if len(pk_cols) == 1 and is_autoincrement_pk(pk_cols[0]):
+            columns[pk_cols[0].name] = dest_table.name
+        for fk in dest_table.foreign_keys:
+            if len(fk.column.table.primary_key.columns) == 1 and \
+                    is_autoincrement_pk(fk.column):
+                columns[fk.parent.name] = fk.column.table.name
+
+        return columns
+
+
+    def get_compare_maps(self, conn, table, dest_table):
+        """
+        Returns the dict of the table columns whose values were re-mapped by
+        the last migration (see get_remapped_columns): column name ->
+        primary keys map (see comparison.compare_tables). The maps that
+        don't change any key are left out. Returns None if a column of table
+        has values but its map is not available (the records can't be
+        compared by key)
+        """
+        key_maps = {}
+        changed = {}  # table name -> True if its map changes keys
+        for name, table_name in self.get_remapped_columns(dest_table).items():
+            if name not in table.c:
+                continue
+
+            pk_map = self.stats["tables"].get(table_name, {}).get("pk_map")
+            if not pk_map:
+                column = table.c[name]
+                if conn.execute(sa.select([column]).where(
+                        column != None).limit(1)).first() is not None:
+                    return None
+                continue
+
+            if table_name not in changed:
+                changed[table_name] = any(old != new
+                                          for old, new in pk_map.items())
+            if changed[table_name]:
+                key_maps[name] = pk_map
+
+        return key_maps
+
+
+    def compare_checksums(self, destination, conn, table, dest_conn,
+                          dest_table, diff_writer, paquet, key_maps=None):
+        """
+        Compares the table records with the destination ones (CHECKSUM
+        compare method): the checksums (see migrations.checksums) of the
+        whole table are compared first and the ones of smaller primary key
+        ranges ("delta_split" ranges) when they differ, down to ranges of
+        paquet records whose records are compared one by one (see
+        comparison.compare_tables). The records of the equal ranges are
+        never read.
+
+        Tables without a single column primary key are compared record by
+        record if their checksums differ, like the tables whose keys were
+        re-mapped (key_maps, see comparison.compare_tables): their primary
+        key ranges don't match.
+
+        Returns the comparison summary, with the number of "ranges"
+        compared and "ranges_equal"
+        """
+        summary = comparison.new_summary()
+        summary.update(ranges=0, ranges_equal=0)
+        if dest_table is None:
+            return comparison.add_summary(summary, comparison.compare_tables(
+                conn, table, dest_conn, None, diff_writer, paquet))
+        if key_maps:
+            return comparison.add_summary(summary, comparison.compare_tables(
+                conn, table, dest_conn, dest_table, diff_writer, paquet,
+                key_maps=key_maps))
+
+        columns = [col for col in table.columns if col.name in dest_table.c]
+        dest_columns = [dest_table.c[col.name] for col in columns]
+        pk_cols = list(table.primary_key.columns)
+        pk_col = dest_pk_col = None
+        if len(pk_cols) == 1 and pk_cols[0].name in dest_table.c:
+            pk_col = pk_cols[0]
+            dest_pk_col = dest_table.c[pk_col.name]
+
+        server = bool(self.options.get("delta_server_checksums")) and \
+            checksums.use_server_checksums(self.engine.dialect,
+                                           destination.engine.dialect)
+        parts = max(2, self.options.get("delta_split") or 16)
+
+        ranges = [(None, None)]
+        while ranges:
+            lower, upper = ranges.pop()
+            src = checksums.get_checksum(conn, table, pk_col, lower, upper,
+                                         columns, server)
+            dst = checksums.get_checksum(dest_conn, dest_table, dest_pk_col,
+                                         lower, upper, dest_columns, server)
+            summary["ranges"] += 1
+            if src == dst:
+                summary["ranges_equal"] += 1
+                summary["source"] += src.count
+                summary["destination"] += dst.count
+                summary["equal"] += src.count
+                continue
+
+            limits = []
+            if pk_col is not None and src.count and dst.count and \
+                    max(src.count, dst.count) > paquet:
+                limits = self.get_delta_limits(conn, table, pk_col, lower,
+                                               upper, src, dst, parts)
+            if limits:
+                bounds = [lower] + limits + [upper]
+                # the ranges are popped in primary key order
+                ranges.extend(reversed(zip(bounds[:-1], bounds[1:])))
+            else:
+                pk_range = (lower, upper) if pk_col is not None else None
+                comparison.add_summary(summary, comparison.compare_tables(
+                    conn, table, dest_conn, dest_table, diff_writer, paquet,
+                    pk_range))
+
+        return summary
+
+
     def _dump(self, records, table):
         """ Dumps all the records into the table on the instance binded
         DB all in one block
         
         see .base.MigratorBase.dump for further details
         """
-        meta = MetaData()
+        writer = self.get_table_writer(table)
+        if writer is not None and records:
+            writer.write(records)
+
+        self.stats["tables"][table.name] = self.get_table_stats(table.name)
+
+
+    def get_table_writer(self, table):
+        """
+        Returns the TableWriter session that dumps records into table from
+        the current thread. The session is opened (and the table created if
+        needed) on the first call and reused until the table is finished (see
+        finish_table). Returns None if the table could not be created
+        """
+        key = (table.name, threading.current_thread().ident)
+        with self._table_locks_lock:
+            writer = self._writers.get(key)
+
+        if writer is None:
+            # First let's be sure that we have the table on our database
+            self.check_table(table)
+            if not self.reflection.has_table(self.engine, table.name):
+                return None
+
+            writer = TableWriter(
+                self,
+                self.reflection.get_table(self.engine, table.name)
+            )
+            with self._table_locks_lock:
+                self._writers[key] = writer
+
+        return writer
 
-        # First let's be sure that we have the table on our database
+
+    def get_or_create_table(self, table):
+        """
+        Returns the destination table with the table (source table) name
+        creating it if needed or None if it could not be created
+        """
         self.check_table(table)
-        tab_stats = self.get_table_stats(table.name)
-        
-        if table.exists(self.engine) and records:
-            table = Table(table.name, meta, autoload=True, autoload_with=self.engine)
+        if not self.reflection.has_table(self.engine, table.name):
+            return None
 
-            dest = self.engine.connect()
+        return self.reflection.get_table(self.engine, table.name)
 
-            pk = table.primary_key
-            pk_col = None
-            if pk is not None and len(pk.columns):
-                pk_col = list(pk.columns)[0]
 
-            # Let's check the trasfer mode and clean some data if needed
-            transfer_mode = self.options.get(
-                "transfer_mode", self.default_options.get("transfer_mode")
-            )
+    def update_records(self, table, records):
+        """
+        Updates the destination records (found by primary key) with the
+        values of records (DELTA transfer mode)
+        """
+        writer = self.get_table_writer(table)
+        if writer is not None and records:
+            writer.update(records)
 
 
-            # ----------------------------------------------------------------
-            # We need to check if this tables has foreign keys that point to
-            # other tables that have had their PKs re-mapped!
-            # If this is the case we need to re-map the rows kf keys to the new
-            # ones
-            fk_mappings = self.get_table_fks_mapping(table)
-            
+    def delete_records(self, table, pks=None, pk_range=None, deferred=True):
+        """
+        Deletes the destination records with the pks primary keys or (if pks
+        is None) the records in the pk_range (lower, upper) primary keys
+        range (the whole table if None). The deferred deletes are executed
+        by complete_migration, the tables that link to the table first, so
+        the destination foreign keys are not broken meanwhile
+        """
+        if deferred:
+            with self._table_locks_lock:
+                self._deletes.append((table, pk_range, pks))
+            return
 
-            # in case of a "DIFF" transfer mode we need to take only the records
-            # that are not in the destination            
-            records = self.prepare_records(
-                records,
-                table,
-                pk_col,
-                tab_stats,
-                fk_mappings,
-                dest
-            )
-            
+        writer = self.get_table_writer(table)
+        if writer is not None:
+            writer.delete(pks, pk_range)
 
-            # ----------------------------------------------------------------
-            # we need to check if this tables has a autoincrement numerical
-            # primary key and in this case pop it from the paquets I'm dumping
-            # then I have to re-map the old keys with the new ones after the
-            # insert statement
-            records_id = []
-
-            if is_numeric_column(pk_col) and pk_col.autoincrement:
-                _records = []
-                for row in records:
-                    if row:
-                        row = dict(row)
-                        records_id.append(row.pop(pk_col.name))
-                        _records.append(clean_record(table, row))
-            else:
-                _records = [clean_record(table, paq) for paq in records if paq]
 
+    def delete_deferred_records(self):
+        """ executes the deletes deferred by delete_records """
+        with self._table_locks_lock:
+            deletes, self._deletes = self._deletes, []
 
-            if _records:
-                try:
-                    res = dest.execute(table.insert(), _records)
-                except sa.exc.IntegrityError, e:
-                    # In this case the table primary key was marked as autoincrement but
-                    # not on the server side.... So we can try to insert with the old
-                    # values
-                    if "%s.%s may not be NULL"%(table.name, pk_col.name) in e.message:
-                        res = dest.execute(table.insert(), records)
-                    self.log_cb("UNHANDLED ERROR %s: %s" %(e, e.message))
+        if not deletes:
+            return
 
-                if is_numeric_column(pk_col) and pk_col.autoincrement:
-                    pk_map = tab_stats["pk_map"]
-                    try:
-                        last_ids = res.last_inserted_ids()
-                    except AttributeError:
-                        # SQLite may not help sometimes... :(
-                        # So let's try to get the last inserted ids directly from
-                        # the database
-                        stmnt = sa.select([pk_col]).limit(len(_records)).order_by(pk_col.desc())
-                        last_ids = reversed(dest.execute(stmnt).fetchall())
-                        for i, last_id in enumerate(last_ids):
-                            pk_map[records_id[i]] = last_id[0]
+        # the tables are dumped after the tables they link to so their
+        # records are deleted in the opposite order
+        order = []
+        for table, pk_range, pks in deletes:
+            if table not in order:
+                order.append(table)
 
-                    tab_stats["pk_map"] = pk_map
+        for table in reversed(order):
+            for _table, pk_range, pks in deletes:
+                if _table is table:
+                    self.delete_records(table, pks, pk_range, deferred=False)
+            # commits the deletes
+            self.flush_table(table)
 
-            tab_stats = self.update_dump_stats(tab_stats, _records, transfer_mode)
 
-            dest.close()
+    def flush_table(self, table):
+        """
+        see .base.MigratorBase.flush_table. Closes (committing its open
+        transaction) the table writer session of the current thread
+        """
+        key = (table.name, threading.current_thread().ident)
+        with self._table_locks_lock:
+            writer = self._writers.pop(key, None)
 
-        self.stats["tables"][table.name] = tab_stats
+        if writer is not None:
+            writer.close()
+
+
+    def finish_table(self, table):
+        """
+        see .base.MigratorBase.finish_table. Closes the table writer sessions
+        and reseeds the primary key sequence of the transfer modes that copy
+        the primary keys (see reseed_table)
+        """
+        with self._table_locks_lock:
+            writers = [key for key in self._writers if key[0] == table.name]
+            writers = [self._writers.pop(key) for key in writers]
+
+        for writer in writers:
+            writer.close()
+
+        transfer_mode = self.options.get(
+            "transfer_mode", self.default_options.get("transfer_mode")
+        )
+        if transfer_mode in COPY_PK_MODES:
+            self.reseed_table(table)
+
+
+    def reseed_table(self, table):
+        """
+        Moves the sequence that generates the primary keys of table (if any)
+        past its biggest primary key, so the records inserted later by the
+        applications don't get the keys copied from the source. Only
+        PostgreSQL needs it: the SQLite, MySQL and SQL Server autoincrement
+        columns follow the keys inserted explicitly
+        """
+        pk_cols = list(table.primary_key.columns)
+        if self.engine.dialect.name != "postgresql" or len(pk_cols) != 1 or \
+                not is_autoincrement_pk(pk_cols[0]):
+            return
+
+        conn = self.engine.connect()
+        try:
+            sequence = loaders.get_pk_sequence(conn, table, pk_cols[0])
+            if sequence is None:
+                return
+
+            # the sequence is never moved back
+            preparer = conn.dialect.identifier_preparer
+            conn.execute(sa.text(
+                "SELECT setval(:sequence, GREATEST(MAX(%s), "
+                "nextval(:sequence))) FROM %s" % (
+                    preparer.quote_identifier(pk_cols[0].name),
+                    preparer.format_table(table))
+            ), sequence=sequence)
+        finally:
+            conn.close()
+
+
+    def finish_migration(self):
+        """
+        see .base.MigratorBase.finish_migration. Closes all the writer
+        sessions still open (only left open if the migration failed) and
+        the primary keys maps of the previous migration
+        """
+        with self._table_locks_lock:
+            writers, self._writers = self._writers.values(), {}
+            pk_maps, self._pk_maps = self._pk_maps, []
+            pk_maps, self._last_pk_maps = self._last_pk_maps, pk_maps
+            self._diff_checked = set()
+
+        for pk_map in pk_maps:
+            pk_map.close()
+
+        for writer in writers:
+            try:
+                writer.close()
+            except Exception, e:
+                # the records of the session are lost but the checkpoints
+                # (if any) were not saved either so they'll be migrated again
+                self.log_cb("error closing %s session: %s" % (
+                    writer.table.name, e))
+
+
+    def get_pk_map(self, table_name):
+        """
+        Returns the primary keys map (see migrations.pkmaps) of table_name
+        creating it (as set by the "pk_map_store" option) on the first call.
+        The DIFF transfer mode maps are kept for the next migrations (in a
+        SQLite file of the "existence_index_directory" directory, if set):
+        the source records they map were already migrated
+        """
+        tab_stats = self.get_table_stats(table_name)
+        diff = self.options.get(
+            "transfer_mode", self.default_options.get("transfer_mode")
+        ) == "DIFF"
+        directory = self.options.get("existence_index_directory")
+        with self._table_locks_lock:
+            pk_map = tab_stats["pk_map"]
+            if not isinstance(pk_map, pkmaps.PKMap):
+                saved = pk_map
+                pk_map = self._diff_pk_maps.get(table_name) if diff else None
+                if pk_map is None and diff and directory is not None:
+                    pk_map = pkmaps.SQLitePKMap(
+                        os.path.join(directory, "%s.pkmap" % table_name))
+                elif pk_map is None:
+                    pk_map = pkmaps.create_pk_map(
+                        self.options.get("pk_map_store"),
+                        self.options.get("pk_map_max_memory"),
+                        self.options.get("pk_map_directory")
+                    )
+                pk_map.update(saved)
+                tab_stats["pk_map"] = pk_map
+                if diff:
+                    self._diff_pk_maps[table_name] = pk_map
+                else:
+                    self._pk_maps.append(pk_map)
+
+        return pk_map
+
+
+    def get_diff_pk_map(self, table, pk_col, conn):
+        """
+        Returns the DIFF primary keys map of table (see get_pk_map). Raises
+        ValueError if table has records but the map is empty: the primary
+        keys were re-mapped by a migration whose map was not kept, so the
+        records can't be compared by primary key
+        """
+        pk_map = self.get_pk_map(table.name)
+        with self._table_locks_lock:
+            checked = table.name in self._diff_checked
+            self._diff_checked.add(table.name)
+
+        if not checked and not len(pk_map) and conn.execute(
+                sa.select([pk_col]).limit(1)).first() is not None:
+            raise ValueError(
+                "%s records can't be compared by primary key: its primary "
+                "keys are re-mapped and the primary keys map of the "
+                "migrations that wrote them is not available (see the "
+                "existence_index_directory option)" % table.name
+            )
+
+        return pk_map
+
+
+    def get_table_lock(self, table_name):
+        """ returns the lock that serializes the inserts into table_name """
+        with self._table_locks_lock:
+            if table_name not in self._table_locks:
+                self._table_locks[table_name] = threading.Lock()
+
+            return self._table_locks[table_name]
 
 
     def get_tables_dump_order(self, tables):
@@ -284,7 +1640,6 @@ class Migrator(MigratorBase):
         list of the table names (strings) in a safe order
         """
         source = sessionmaker(bind=self.engine)()
-        meta = MetaData()
 
         # graph that stores tables dependencies information
         autoincrement_tables = {}  # Tables witu an autoincremental pk
@@ -297,7 +1652,12 @@ class Migrator(MigratorBase):
 
         # If not tables specified we grab all tables from the source
         if not tables:
-            tables = self.engine.table_names()
+            tables = sorted(name for name in
+                            self.reflection.get_table_names(self.engine)
+                            if name != capture.CHANGE_TABLE)
+
+        # reflect all the tables at once
+        self.reflection.reflect(self.engine, tables)
 
         # First we need to loop over the tables to check tables links and
         # relations
@@ -306,10 +1666,7 @@ class Migrator(MigratorBase):
             self.log_cb(u'Processing %s'%table_name)
             self.log_cb(u'Pulling schema from source server')
 
-            table = Table(table_name,
-                          meta,
-                          autoload=True,
-                          autoload_with=self.engine)
+            table = self.reflection.get_table(self.engine, table_name)
 
             # We first need to check the table PKs to track auto-incremental
             # keys and deal with them..
@@ -330,6 +1687,8 @@ class Migrator(MigratorBase):
                 tab_links = fks_links.get(fk.column.table.name, {})
                 tab_links_rev = tables_fks.get(table.name, {})
                 for column in fk.constraint.columns:
+                    # reflected tables constraints columns are names
+                    column = getattr(column, "name", column)
                     tab_links[fk.column.name] = (table.name, column)
                     tab_links_rev[column] = (fk.column.table.name, fk.column.name)
 
@@ -338,87 +1697,84 @@ class Migrator(MigratorBase):
 
 
 
-        tables_order = [] # Precedence list of tables
-
-        # Now let's add all the tables that have no links to others
-        tables_w_links = set(fks_links.keys()).union(
-            set(tables_fks)
-        )
-
-        # and the tables that are linked by others by have no FKs
-        first_order_tables = list(set(fks_links.keys()).difference(
-            set(tables_fks)))
-
-
-        tables_order += first_order_tables
-        tables_order += list(set(tables).difference(tables_w_links))
-
-        fks_links = dict([(k, fks_links[k]) for k in \
-                          list(set(fks_links.keys()).difference(
-                              set(first_order_tables)))])
-
-        # Now there's the tricky part. We need to define a order to inser the
-        # tables with FKs. We need to care about their order because they could
-        # have constraings among them
-
-        # So first we take the tables that are missing
-        missing_tables = list(set(fks_links))
-
         # Let's add the tables dependencies information to the globals
         # stats
-        self.stats["tables_graph"]["fks_rev"] = copy.deepcopy(fks_links)
-        self.stats["tables_graph"]["fks"] = copy.deepcopy(tables_fks)
+        self.stats["tables_graph"]["fks_rev"] = dict(
+            (name, dict(links)) for name, links in fks_links.items())
+        self.stats["tables_graph"]["fks"] = dict(
+            (name, dict(links)) for name, links in tables_fks.items())
+
+        # Now there's the tricky part. We need to define a order to insert
+        # the tables with FKs: every table goes after the tables it links to
+        # (see migrations.graph)
+        dependencies = {}
+        breakable = {}
+        for table_name, tab_links in tables_fks.items():
+            dependencies[table_name] = set(
+                lnk_table for lnk_table, lnk_column in tab_links.values()
+            )
+            breakable[table_name] = self.get_nullable_links(table_name)
+
+        levels, left = graph.get_levels(tables, dependencies)
+        deferred_fks = {}
+        if left:
+            cycles = graph.find_cycles(left, dependencies)
+            self.stats["tables_graph"]["cycles"] = cycles
+            fk_cycles = self.options.get("fk_cycles")
+            if fk_cycles == "RAISE":
+                raise graph.CycleError(cycles)
+
+            elif fk_cycles == "NULLIFY":
+                try:
+                    dependencies, dropped = graph.break_cycles(
+                        tables, dependencies, breakable
+                    )
+                except graph.CycleError, e:
+                    self.exceptions.append(e.message)
+                    self.log_cb(e.message)
+                else:
+                    for table_name, lnk_table in dropped:
+                        self.log_cb(u"%s links to %s will be back-filled" % (
+                            table_name, lnk_table))
+                        for column, constr in tables_fks[table_name].items():
+                            if constr[0] == lnk_table:
+                                deferred_fks.setdefault(table_name, {})[
+                                    column] = constr
 
-        # We take only those that have no links with tables that were not
-        # dumped yet
-        while missing_tables:
-            # Let's check the next table on the queue
-            table = missing_tables.pop()
+                    levels, left = graph.get_levels(tables, dependencies)
 
-            if table in tables_order:
-                continue
+            # the tables left are dumped last (in the FKs cycles the links
+            # to tables not dumped yet may be violated)
+            if left:
+                levels.append(left)
 
-            # check if still have "connections"
-            if table not in tables_fks:
-                # No connections, we can include the table
-                tables_order.append(table)
-            else:
-                # Oh no.. still connected. We need to check if the link that
-                # were locking this tables were resolved or still open
-                tab_links = tables_fks[table]
+        self.stats["tables_graph"]["levels"] = levels
+        self.stats["tables_graph"]["deferred_fks"] = deferred_fks
 
-                if not tab_links:
-                    # ooops... seems that there are no more links locking this
-                    # table. We can add it...
-                    tables_order.append(table)
+        tables_order = [table_name for level in levels
+                        for table_name in level]
 
-                else:
-                    # Let's check if we have dumped the information that this
-                    # tables was waiting to be released
-                    for column, constr in tables_fks[table].items():
-                        lnk_table = constr[0] # 0 = TABLE, 1 = COLUMN
-                        if lnk_table in tables_order or lnk_table==table:
-                            tab_links.pop(column)
-
-                    if not tab_links:
-                        # If all the constraints were removed we can add table
-                        tables_order.append(table)
-                    else:
-                        # Still have constraints. Let's just update the global
-                        # table information
-                        tables_fks[table] = tab_links
+        del source
+        return tables_order
 
-                        # So we need to put the table back in the queue of tables
-                        # locked
-                        missing_tables = [table] + missing_tables
 
-        for tab in tables_fks:
-            if tab not in tables_order:
-                tables_order.append(tab)
+    def get_nullable_links(self, table_name):
+        """
+        Returns the set of the tables that table_name links to only through
+        nullable foreign keys (the links that can be back-filled once all
+        the tables are migrated, see the "fk_cycles" option)
+        """
+        table = self.reflection.get_table(self.engine, table_name)
+        if len(table.primary_key.columns) != 1:
+            # the back-filled records are found by their primary key
+            return set()
+
+        links = {}
+        for fk in table.foreign_keys:
+            nullable = links.get(fk.column.table.name, True)
+            links[fk.column.table.name] = nullable and fk.parent.nullable
 
-        del source
-        #tables_order.reverse()
-        return tables_order
+        return set(name for name, nullable in links.items() if nullable)
 
 
     def check_table(self, table):
@@ -437,26 +1793,192 @@ class Migrator(MigratorBase):
         """
         # We need to check if the tables exists and if not we create it
         try:
-            if not table.exists(self.engine):
-                for col in table.columns:
-                    # We need to do little type convertions to handle SQL Server
-                    # specific types
-                    if isinstance(col.type, sa.types.NullType):
-                        col.type = sa.Text()
+            with self._create_lock:
+                if not self.reflection.has_table(self.engine, table.name):
+                    # the tables it links to are created first (they may not
+                    # exist yet if they are in a FKs cycle with this table)
+                    self._creating.add(table.name)
+                    try:
+                        for fk in table.foreign_keys:
+                            parent = fk.column.table
+                            if parent.name not in self._creating:
+                                self.check_table(parent)
+                    finally:
+                        self._creating.discard(table.name)
+
+                    for col in table.columns:
+                        # We need to do little type convertions to handle SQL Server
+                        # specific types
+                        if isinstance(col.type, sa.types.NullType):
+                            col.type = sa.Text()
                     
-                    if isinstance(col.type, (mssql.base.BIT)):
-                        col.type = sa.Boolean()
+                        if isinstance(col.type, (mssql.base.BIT)):
+                            col.type = sa.Boolean()
                     
 
-                self.log_cb("creating table %s"%table.name)
-                table.create(self.engine)
-                self.log_cb("created table %s"%table.name)
+                    self.log_cb("creating table %s"%table.name)
+                    if self.options.get("deferred_indexes"):
+                        self.create_bare_table(table)
+                    else:
+                        table.create(self.engine)
+                    self.reflection.invalidate(self.engine, table.name)
+                    self.log_cb("created table %s"%table.name)
 
         except Exception, e:
             return u"""Error creating table [%s] on destination.
             Error details: %s""" % (table.name, e.message)
         
         
+    def create_bare_table(self, table):
+        """
+        Creates table without its indexes and foreign key constraints. The
+        statements that create them are kept (and saved in the checkpoints
+        if any) to be executed by complete_migration
+        """
+        dialect = self.engine.dialect
+        statements = []
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            statements.append((
+                index.name,
+                "index",
+                unicode(sa.schema.CreateIndex(index).compile(dialect=dialect))
+            ))
+
+        # CREATE TABLE never creates the indexes but it does create the
+        # foreign key constraints. SQLite can't add constraints to existing
+        # tables so they are only deferred on the other databases
+        bare = table
+        if dialect.supports_alter:
+            bare = table.tometadata(MetaData())
+            for fkc in [c for c in bare.constraints
+                        if isinstance(c, sa.ForeignKeyConstraint)]:
+                bare.constraints.remove(fkc)
+
+            for fkc in [c for c in table.constraints
+                        if isinstance(c, sa.ForeignKeyConstraint)]:
+                name = fkc.name or "%s_%s_fkey" % (table.name,
+                                                   "_".join(fkc.columns))
+                statements.append((
+                    name,
+                    "constraint",
+                    unicode(sa.schema.AddConstraint(fkc).compile(
+                        dialect=dialect))
+                ))
+
+        self.engine.execute(sa.schema.CreateTable(bare))
+        with self._table_locks_lock:
+            self._deferred_ddl[table.name] = statements
+        if self.checkpoint is not None:
+            self.checkpoint.save_deferred_ddl(table.name, statements)
+
+
+    def complete_migration(self):
+        """
+        see .base.MigratorBase.complete_migration. Builds the indexes and
+        foreign key constraints deferred by create_bare_table: first all the
+        indexes (in parallel) and then the constraints. The records deleted
+        by a DELTA migration are deleted first
+        """
+        self.delete_deferred_records()
+        self.backfill_fks()
+
+        if self.checkpoint is not None:
+            # includes the statements deferred by the resumed migrations
+            deferred = self.checkpoint.get_deferred_ddl()
+        else:
+            deferred = self._deferred_ddl
+
+        workers = self.options.get("index_workers") or 1
+        if self.engine.dialect.name == "sqlite":
+            workers = 1
+
+        for kind in ("index", "constraint"):
+            nodes = [(table_name, name, statement)
+                     for table_name, statements in sorted(deferred.items())
+                     for name, _kind, statement in statements
+                     if _kind == kind]
+            if nodes:
+                scheduling.run_dependency_graph(
+                    nodes, {}, partial(self.execute_deferred_ddl, kind),
+                    workers
+                )
+
+        self._deferred_ddl = {}
+
+        # the DIFF existence indexes (if any) are saved for the next runs
+        self._existence.save()
+
+
+    def backfill_fks(self):
+        """
+        Sets the foreign keys values that were dumped as NULL to break the
+        tables FKs cycles (see the "fk_cycles" option) with batched UPDATE
+        statements. The number of records updated is saved in the table
+        stats "backfilled"
+        """
+        with self._table_locks_lock:
+            backfill, self._backfill = self._backfill, {}
+
+        for table_name, rows in sorted(backfill.items()):
+            table = self.reflection.get_table(self.engine, table_name)
+            pk_col = list(table.primary_key.columns)[0]
+            tab_stats = self.get_table_stats(table_name)
+            self.log_cb(u"back-filling %s links of %s" % (len(rows),
+                                                          table_name))
+
+            new_pks = pkmaps.get_many(tab_stats.get("pk_map", {}),
+                                      [pk for pk, column, value in rows])
+            links = self.deferred_fks.get(table_name, {})
+            params = {}
+            for column, (lnk_table, lnk_column) in links.items():
+                lnk_stats = self.stats["tables"].get(lnk_table, {})
+                values = [value for pk, _column, value in rows
+                          if _column == column]
+                new_values = pkmaps.get_many(lnk_stats.get("pk_map", {}),
+                                             values)
+                params[column] = [
+                    {"_pk": new_pks.get(pk, pk),
+                     "_value": new_values.get(value, value)}
+                    for pk, _column, value in rows if _column == column
+                ]
+
+            conn = self.engine.connect()
+            try:
+                for column, values in sorted(params.items()):
+                    stmt = table.update().where(
+                        pk_col == sa.bindparam("_pk")
+                    ).values({column: sa.bindparam("_value")})
+                    for i in range(0, len(values), BACKFILL_BATCH):
+                        with conn.begin():
+                            conn.execute(stmt, values[i:i + BACKFILL_BATCH])
+            finally:
+                conn.close()
+
+            with self._stats_lock:
+                tab_stats["backfilled"] = len(rows)
+
+
+    def execute_deferred_ddl(self, kind, node):
+        """
+        Executes a statement deferred by create_bare_table and saves its
+        execution time in the table stats. node is a (table name, index or
+        constraint name, statement) tuple
+        """
+        table_name, name, statement = node
+        self.log_cb("creating %s %s" % (kind, name))
+        started = time.time()
+        self.engine.execute(statement)
+        seconds = time.time() - started
+
+        tab_stats = self.get_table_stats(table_name)
+        key = "indexes" if kind == "index" else "constraints"
+        with self._stats_lock:
+            tab_stats.setdefault(key, {})[name] = seconds
+
+        if self.checkpoint is not None:
+            self.checkpoint.deferred_ddl_done(table_name, name)
+
+
     def get_table_fks_mapping(self, table):
         # ----------------------------------------------------------------
         # We need to check if this table has foreign keys that point to
@@ -474,22 +1996,17 @@ class Migrator(MigratorBase):
     
     
     def get_db_data(self, table, pk_col, transfer_mode, conn):
+        """
+        Returns the existence index (see migrations.existence) of the primary
+        keys already in the destination table. It's built (or loaded) on the
+        first call and kept until the end of the migration
+        """
         # We define a set of pks that we want the migrator to skip from the
         # dump. To do that we need the data in the db
-        db_data = set()
-        if transfer_mode == "DIFF":
-            # We have to pre-check data in the destination database to dump
-            # only data that is not already there
-            db_data = self._db_data.get(table.name, None)
-            if db_data is None:
-                # Let's repleace the dict entirely so we don't overload memory
-                # with huge tables that were already dumped in memory..
-                db_data = conn.execute(sa.select([pk_col])).fetchall()
-                db_data = set(d[0] for d in db_data)
-
-                self._db_data = {table.name: db_data}
+        if transfer_mode != "DIFF":
+            return existence.SetIndex()
 
-        return db_data        
+        return self._existence.get(conn, table, pk_col)
 
 
     def prepare_records(self, records, table, pk_col, tab_stats, 
@@ -499,175 +2016,719 @@ class Migrator(MigratorBase):
         records that are already in the database (db_data) and remapping the
         foreign keys that were mapped to a new id (because the primary key they
         point to is an autoincremental identity column
-        
-        TODO: BETTER DOCUMENT ME PLEASE
+
+        Returns the records as a columnar.Paquet of the table columns
         """
         transfer_mode = self.options.get(
                         "transfer_mode", self.default_options.get("transfer_mode")
                     )
 
-        if transfer_mode =="DIFF":
-            compare_mode = self.options.get(
-                        "compare_mode", self.default_options.get("compare_mode")
-                    )
+        compare_mode = self.options.get(
+                    "compare_mode", self.default_options.get("compare_mode")
+                )
+        # the FULL compare modes are computed by the destination database
+        # while inserting the records (see TableWriter.write_staged)
+        if transfer_mode =="DIFF" and compare_mode not in STAGED_COMPARE_MODES:
+            # the source primary keys of the re-mapped tables are looked up
+            # through their map
+            pk_map = None
+            if compare_mode in PK_COMPARE_MODES and is_autoincrement_pk(pk_col):
+                pk_map = self.get_diff_pk_map(table, pk_col, conn)
             records = skip_records(
                 records,
                 table, pk_col,
                 compare_mode,
                 transfer_mode,
                 tab_stats,
-                conn
+                conn,
+                self._existence,
+                pk_map
             )
-        else:
-            records = [prepare_record(record, fk_mappings) for record in records] 
 
-        return records
+        paquet = columnar.Paquet.from_records(
+            records, [col.name for col in table.columns]
+        )
+        return prepare_records_fks(paquet, fk_mappings)
     
+class TableWriter(object):
+    """
+    Table scoped writer session of the dbms destination. It's opened once
+    per table (and thread) and keeps the destination connection, the
+    compiled insert statement, the primary key and autoincrement metadata and
+    the foreign keys mappings so dumping a paquet only costs the insert.
+    """
+    def __init__(self, migrator, table):
+        """
+        migrator ::: dbms Migrator (destination) that owns the session
+
+        table ::: sqlalchemy table reflected from the destination database
+        """
+        self.migrator = migrator
+        self.table = table
+        self.tab_stats = migrator.get_table_stats(table.name)
+
+        # the compiled statements are cached for the session lifetime
+        self.conn = migrator.engine.connect().execution_options(
+            compiled_cache = {}
+        )
+        self.insert = table.insert()
+
+        pk = table.primary_key
+        self.pk_col = None
+        if pk is not None and len(pk.columns):
+            self.pk_col = list(pk.columns)[0]
+
+        # Let's check the trasfer mode and clean some data if needed
+        self.transfer_mode = migrator.options.get(
+            "transfer_mode", migrator.default_options.get("transfer_mode")
+        )
+
+        # autoincrement numerical primary keys are not copied: they are
+        # re-mapped to the new values generated by the destination (but in
+        # DELTA mode where both sides primary keys must match)
+        self.remap_pk = bool(is_numeric_column(self.pk_col) and
+                             self.pk_col.autoincrement and
+                             self.transfer_mode not in COPY_PK_MODES)
+        if self.remap_pk:
+            self.pk_map = migrator.get_pk_map(table.name)
+
+        # inserted columns (see clean_record)
+        self.insert_keys = [col.name for col in table.columns
+                            if self.transfer_mode in COPY_PK_MODES or
+                            not is_autoincrement_pk(col)]
+
+        # ----------------------------------------------------------------
+        # We need to check if this tables has foreign keys that point to
+        # other tables that have had their PKs re-mapped!
+        # If this is the case we need to re-map the rows kf keys to the new
+        # ones
+        self.fk_mappings = migrator.get_table_fks_mapping(table)
+
+        # links dumped as NULL and back-filled at the end of the migration
+        self.deferred_fks = migrator.deferred_fks.get(table.name, {})
+        for column in self.deferred_fks:
+            self.fk_mappings.pop(column, None)
+
+        # dialect specific bulk loader (see the "bulk_loader" option)
+        self.loader = loaders.get_loader(
+            self.conn, table, migrator.options.get("bulk_loader"),
+            returning = self.remap_pk
+        )
+        self.tab_stats["loader"] = self.loader.name
+
+        # the FULL compare modes stage the paquets in a temporary table and
+        # insert the staged records that are not in the table yet
+        self.staging = None
+        compare_mode = migrator.options.get(
+            "compare_mode", migrator.default_options.get("compare_mode")
+        )
+        if self.transfer_mode == "DIFF" and \
+                compare_mode in STAGED_COMPARE_MODES:
+            self.compare_keys = get_compare_keys(
+                table, compare_mode, self.deferred_fks
+            )
+            self.staging = staging.StagingTable(
+                self.conn, table, migrator.options.get("bulk_loader")
+            )
+
+        # INCREMENTAL and CAPTURE transfer modes: the records are upserted
+        # with the dialect statement (if any)
+        self.upsert = None
+        if self.transfer_mode in UPSERT_MODES:
+            self.upsert = loaders.get_upsert_statement(self.conn, table,
+                                                       self.insert_keys)
+
+        # explicit transactions that group many paquets (see the
+        # "commit_every" option). None means autocommit
+        self.commit_every = parse_commit_every(
+            migrator.options.get("commit_every")
+        )
+        self.transaction = None
+        self._tx_paquets = 0
+        self._tx_records = 0
+        self._tx_started = None
+
+
+    def close(self):
+        """ commits the open transaction (if any) and closes the session """
+        try:
+            self.commit()
+            if self.staging is not None:
+                self.staging.drop()
+        finally:
+            self.conn.close()
+
+
+    def begin(self):
+        """ opens a new transaction if the session groups paquets """
+        if self.commit_every is None or self.transaction is not None:
+            return
+
+        self.transaction = self.conn.begin()
+        self._tx_paquets = 0
+        self._tx_records = 0
+        self._tx_started = time.time()
+
+        # the migration progress is saved only when the records are committed
+        if self.migrator.checkpoint is not None:
+            self.migrator.checkpoint.begin(self.table.name)
+
+
+    def commit(self):
+        """ commits the open transaction (if any) """
+        if self.transaction is None:
+            return
+
+        started = time.time()
+        self.transaction.commit()
+        self.transaction = None
+        seconds = time.time() - started
+
+        with self.migrator._stats_lock:
+            self.tab_stats["commits"] = self.tab_stats.get("commits", 0) + 1
+            self.tab_stats["commit_seconds"] = \
+                self.tab_stats.get("commit_seconds", 0) + seconds
+
+        if self.migrator.checkpoint is not None:
+            self.migrator.checkpoint.commit(self.table.name)
+
+
+    def rollback(self):
+        """ rolls back the open transaction (if any) """
+        if self.transaction is None:
+            return
+
+        self.transaction.rollback()
+        self.transaction = None
+
+        msg = "%s rolled back to the last commit (%s records lost)" % (
+            self.table.name, self._tx_records)
+        self.migrator.log_cb(msg)
+        with self.migrator._stats_lock:
+            self.tab_stats["rollbacks"] = self.tab_stats.get("rollbacks", 0) + 1
+            self.tab_stats["messages"].append(msg)
+
+        if self.migrator.checkpoint is not None:
+            self.migrator.checkpoint.rollback(self.table.name)
+
+
+    def is_commit_due(self):
+        """ returns True if the open transaction must be committed """
+        amount, unit = self.commit_every
+        if unit == "paquets":
+            return self._tx_paquets >= amount
+        elif unit == "records":
+            return self._tx_records >= amount
+        else:
+            return time.time() - self._tx_started >= amount
+
+
+    def write(self, records):
+        """ inserts the records into the session table """
+        # the transaction is committed before the next paquet so the
+        # migration progress of the last paquet is committed with it
+        if self.transaction is not None and self.is_commit_due():
+            self.commit()
+
+        self.begin()
+        try:
+            written = self._write(records)
+        except Exception:
+            self.rollback()
+            raise
+
+        self._tx_paquets += 1
+        self._tx_records += written
+
+
+    def update(self, records):
+        """
+        Updates the session table records (found by primary key) with the
+        records values
+        """
+        pk_col = self.pk_col
+        keys = [key for key in self.insert_keys if key != pk_col.name]
+        if not keys:
+            return
+
+        paquet = self.migrator.prepare_records(
+            records, self.table, pk_col, self.tab_stats, self.fk_mappings,
+            self.conn
+        )
+        params = self.get_update_params(paquet, keys)
+
+        self.begin()
+        try:
+            self.conn.execute(self.get_update_statement(keys), params)
+        except Exception:
+            self.rollback()
+            raise
+
+        with self.migrator._stats_lock:
+            self.tab_stats["records_updated"] = \
+                self.tab_stats.get("records_updated", 0) + len(params)
+
+
+    def get_update_statement(self, keys):
+        """
+        returns the statement that updates the keys columns of a record
+        found by primary key (see get_update_params)
+        """
+        # the bound parameters names must not be the columns names
+        columns = self.table.c
+        return self.table.update().where(
+            self.pk_col == sa.bindparam("_pk", type_=self.pk_col.type)
+        ).values(dict(
+            (key, sa.bindparam("_%s" % key, type_=columns[key].type))
+            for key in keys
+        ))
+
+
+    def get_update_params(self, records, keys):
+        """ returns the parameters of get_update_statement for records """
+        pk_name = self.pk_col.name
+        return [dict([("_pk", record[pk_name])] +
+                     [("_%s" % key, record[key]) for key in keys])
+                for record in records]
+
+
+    def get_existing_pks(self, pks):
+        """ returns the set of the primary keys of pks in the session table """
+        max_params = loaders.MAX_PARAMS.get(self.conn.dialect.name,
+                                            loaders.DEFAULT_MAX_PARAMS)
+        found = set()
+        for i in range(0, len(pks), max_params):
+            found.update(row[0] for row in self.conn.execute(
+                sa.select([self.pk_col]).where(
+                    self.pk_col.in_(pks[i:i + max_params]))))
+
+        return found
+
+
+    def delete(self, pks=None, pk_range=None):
+        """
+        Deletes the session table records with the pks primary keys or (if
+        pks is None) the records in the pk_range (lower, upper) range (the
+        whole table if None)
+        """
+        pk_col = self.pk_col
+        self.begin()
+        try:
+            if pks is None:
+                lower, upper = pk_range or (None, None)
+                self.conn.execute(checksums.where_range(
+                    self.table.delete(), pk_col, lower, upper))
+            else:
+                pks = list(pks)
+                max_params = loaders.MAX_PARAMS.get(
+                    self.conn.dialect.name, loaders.DEFAULT_MAX_PARAMS)
+                for i in range(0, len(pks), max_params):
+                    self.conn.execute(self.table.delete().where(
+                        pk_col.in_(pks[i:i + max_params])))
+        except Exception:
+            self.rollback()
+            raise
+
+
+    def defer_fks(self, paquet):
+        """
+        Sets the deferred links of paquet (columnar.Paquet) to NULL. The
+        values are kept to be back-filled by the migrator
+        """
+        backfill = []
+        pks = paquet[self.pk_col.name]
+        for column in self.deferred_fks:
+            if column not in paquet:
+                continue
+
+            backfill.extend((pk, column, value)
+                            for pk, value in zip(pks, paquet[column])
+                            if value is not None)
+            paquet[column] = [None] * len(paquet)
+
+        with self.migrator._table_locks_lock:
+            self.migrator._backfill.setdefault(self.table.name, []).extend(
+                backfill)
+
+        return paquet
+
+
+    def _write(self, records):
+        migrator = self.migrator
+        table = self.table
+        pk_col = self.pk_col
+        tab_stats = self.tab_stats
+
+        # in case of a "DIFF" transfer mode we need to take only the records
+        # that are not in the destination. The records are kept as columns
+        # from here to the insert
+        paquet = migrator.prepare_records(
+            records,
+            table,
+            pk_col,
+            tab_stats,
+            self.fk_mappings,
+            self.conn
+        )
+
+        if self.deferred_fks:
+            paquet = self.defer_fks(paquet)
+
+        if self.staging is not None:
+            return self.write_staged(paquet)
+
+        if self.transfer_mode in UPSERT_MODES:
+            return self.write_upsert(paquet)
+
+        # ----------------------------------------------------------------
+        # we need to check if this tables has a autoincrement numerical
+        # primary key and in this case pop it from the paquets I'm dumping
+        # then I have to re-map the old keys with the new ones after the
+        # insert statement
+        records_id = []
+        if self.remap_pk:
+            records_id = paquet[pk_col.name]
+
+        _records = paquet.project(self.insert_keys)
+
+        if _records and self.remap_pk and self.loader.returns_ids:
+            # the insert returns the new primary keys: no lock or extra
+            # query needed
+            new_ids = self.loader.load_paquet(_records)
+            self.pk_map.set_many(zip(records_id, new_ids))
+
+        elif _records:
+            # the new primary keys are read back from the destination
+            # table so no other thread can insert into the same table
+            # meanwhile (i.e. when migrating partitioned tables)
+            if self.remap_pk:
+                migrator.get_table_lock(table.name).acquire()
+            try:
+                try:
+                    self.loader.load_paquet(_records)
+                except sa.exc.IntegrityError, e:
+                    # In this case the table primary key was marked as autoincrement but
+                    # not on the server side.... So we can try to insert with the old
+                    # values
+                    if "%s.%s may not be NULL"%(table.name, pk_col.name) in e.message:
+                        self.conn.execute(self.insert, paquet.to_dicts())
+                    migrator.log_cb("UNHANDLED ERROR %s: %s" %(e, e.message))
+
+                if self.remap_pk:
+                    # the bulk loaders do not return the inserted ids so
+                    # let's get the last inserted ids directly from the
+                    # database
+                    stmnt = sa.select([pk_col]).limit(len(_records)).order_by(pk_col.desc())
+                    last_ids = reversed(self.conn.execute(stmnt).fetchall())
+                    self.pk_map.set_many(
+                        zip(records_id, [last_id[0] for last_id in last_ids])
+                    )
+            finally:
+                if self.remap_pk:
+                    migrator.get_table_lock(table.name).release()
+
+        if self.transfer_mode == "DIFF" and _records and pk_col is not None:
+            # the next paquets (and runs) skip the records just inserted
+            keys = paquet[pk_col.name]
+            if self.remap_pk:
+                keys = pkmaps.get_many(self.pk_map, keys).values()
+            migrator._existence.add(table, keys)
+
+        migrator.update_dump_stats(tab_stats, _records, self.transfer_mode)
+        return len(_records)
+
+
+    def write_upsert(self, paquet):
+        """
+        Inserts the records of paquet (columnar.Paquet) replacing the records
+        with the same primary keys (INCREMENTAL and CAPTURE transfer modes).
+        Without an upsert statement the records with the same primary keys
+        are updated and the other ones inserted (in the same transaction).
+        Tables without primary key only get the records inserted. Returns
+        the number of records written
+        """
+        if not len(paquet):
+            return 0
+
+        _records = paquet.project(self.insert_keys)
+        if self.upsert is not None:
+            self.conn.execute(self.upsert, [
+                dict(("p%s" % i, value) for i, value in enumerate(row))
+                for row in _records.rows()
+            ])
+        elif self.pk_col is None or len(self.table.primary_key.columns) > 1:
+            self.loader.load_paquet(_records)
+        else:
+            # the existing records are not deleted (it would run the ON
+            # DELETE actions of the tables that link to them). Nested in the
+            # session transaction (if any)
+            pk_name = self.pk_col.name
+            keys = [key for key in self.insert_keys if key != pk_name]
+            transaction = self.conn.begin()
+            try:
+                existing = self.get_existing_pks(list(paquet[pk_name]))
+                records = _records.to_dicts()
+                updated = [record for record in records
+                           if record[pk_name] in existing]
+                if updated and keys:
+                    self.conn.execute(self.get_update_statement(keys),
+                                      self.get_update_params(updated, keys))
+                inserted = [record for record in records
+                            if record[pk_name] not in existing]
+                if inserted:
+                    self.loader.load_paquet(columnar.Paquet.from_records(
+                        inserted, self.insert_keys))
+            except Exception:
+                transaction.rollback()
+                raise
+            transaction.commit()
+
+        self.migrator.update_dump_stats(self.tab_stats, _records,
+                                        self.transfer_mode)
+        return len(_records)
+
+
+    def write_staged(self, paquet):
+        """
+        Inserts the records of paquet (columnar.Paquet) that are not in the
+        table yet (FULL compare modes): the paquet is loaded into the staging
+        table and the destination database inserts the missing records with
+        a single statement. Returns the number of records inserted
+        """
+        if not len(paquet):
+            return 0
+
+        self.staging.load(paquet)
+        inserted = self.staging.insert_missing(self.insert_keys,
+                                               self.compare_keys)
+        if self.remap_pk:
+            # the records already there are mapped to their primary key too
+            self.pk_map.set_many(self.staging.get_pk_pairs(
+                self.pk_col.name, self.compare_keys))
+
+        with self.migrator._stats_lock:
+            self.tab_stats["records_skipped"] += len(paquet) - inserted
+        self.migrator.update_dump_stats(self.tab_stats, [],
+                                        self.transfer_mode, inserted)
+        return inserted
+
+
+# records updated at once when back-filling foreign keys
+BACKFILL_BATCH = 1000
+
+
+def parse_commit_every(value):
+    """
+    Parses the "commit_every" option value. It can be a number of paquets
+    (i.e. 10) or a string with a number and a unit: paquets, records (or
+    rows) or seconds (i.e. "50000 records", "30 seconds").
+
+    Returns a (amount, unit) tuple or None if value is None
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, (int, long, float)):
+        return value, "paquets"
+
+    amount, unit = value.split()
+    unit = unit.lower()
+    if unit == "rows":
+        unit = "records"
+    if unit not in ("paquets", "records", "seconds"):
+        raise ValueError("invalid commit_every unit: %s" % unit)
+
+    return float(amount), unit
+
+
+# transfer modes that copy the primary keys (autoincrement ones too)
+COPY_PK_MODES = ("DELTA", "INCREMENTAL", "CAPTURE")
+# transfer modes whose records replace the destination records with the
+# same primary keys
+UPSERT_MODES = ("INCREMENTAL", "CAPTURE")
+# compare modes of the DIFF transfer mode that check the primary keys only
+PK_COMPARE_MODES = ("PK", "PK_IN_CACHE", "CACHED_PK")
+# compare modes of the DIFF transfer mode that check all the columns values
+# (computed by the destination database, see staging)
+STAGED_COMPARE_MODES = ("FULL", "FULL_NO_PK")
+
+
+def get_compare_keys(table, compare_mode, excluded=()):
+    """
+    Returns the names of the table columns whose values are compared by the
+    compare_mode (FULL or FULL_NO_PK) compare mode. The autoincrement
+    primary keys (see clean_record), the primary keys (FULL_NO_PK) and the
+    excluded columns are not compared
+    """
+    keys = [col.name for col in table.columns
+            if not is_autoincrement_pk(col) and col.name not in excluded and
+            not (compare_mode == "FULL_NO_PK" and col.primary_key)]
+
+    # tables with only excluded columns compare all of them
+    return keys or [col.name for col in table.columns]
+
+
+def prepare_records_fks(paquet, fk_mappings):
+    """
+    Re-maps the foreign keys of paquet (columnar.Paquet) to the new primary
+    keys of the tables they link to, a column at a time: every column values
+    are looked up in the primary keys map at once. Returns paquet
+    """
+    for column, mapping in fk_mappings.items():
+        # the linked table may not be dumped yet (FKs cycles)
+        pk_map = mapping.get("pk_map")
+        if pk_map is None or (isinstance(pk_map, dict) and not pk_map):
+            continue
+
+        paquet.remap(column, pk_map)
+
+    return paquet
+
+
 def prepare_record(record, fk_mappings):
     record = dict(record)
     
     for column, mapping in fk_mappings.items():
         value = record[column]
-        record[column] = mapping["pk_map"].get(value, value)    
+        # the linked table may not be dumped yet (FKs cycles)
+        record[column] = mapping.get("pk_map", {}).get(value, value)
     
     return record
 
 def skip_records(records, table, pk_col, compare_mode, transfer_mode, 
-                 tab_stats, conn):
+                 tab_stats, conn, existence_index=None, pk_map=None):
     """
     Skip all the records that are already present in table.
     
     Different compare modes will be applied depending on the option["compare_mode"]
+
+    existence_index ::: existence.IndexBuilder of the destination primary
+                keys (PK compare modes)
+
+    pk_map ::: primary keys map (source pk -> destination pk) of the table
+                if its primary keys are re-mapped (PK compare modes)
     """
-    if compare_mode == "PK_IN_CACHE":     
+    if compare_mode in PK_COMPARE_MODES:
         records = skip_records_pk(records, 
                                   table,
                                   pk_col, 
                                   transfer_mode,
                                   tab_stats,
-                                  conn)
+                                  conn,
+                                  existence_index,
+                                  pk_map)
             
-    elif compare_mode == "FULL":
-        records = skip_records_full(records, table,  conn)
-        
-    elif compare_mode == "FULL_NO_PK":
-        records = skip_records_full_no_pk(records, table, pk_col)
-        
+    elif compare_mode in STAGED_COMPARE_MODES:
+        records = [record for record in records if record]
+        if compare_mode == "FULL":
+            out = skip_records_full(records, table, conn)
+        else:
+            out = skip_records_full_no_pk(records, table, pk_col, conn)
+        tab_stats["records_skipped"] += len(records) - len(out)
+        records = out
+
     else:
-        records = [prepare_record(record) for record in records]  
+        records = [record for record in records if record]
     return records
     
-def skip_records_pk(records, table, pk_col, transfer_mode, tab_stats, conn):
+def skip_records_pk(records, table, pk_col, transfer_mode, tab_stats, conn,
+                    existence_index=None, pk_map=None):
     """
     checks if the data is not into the destination DB by checking only the
-    primary key (FAST CHECK)
-    
-    record ::: data record that needs to be checked if is already present in db_data
+    primary key (FAST CHECK). The primary keys of the whole paquet are
+    looked up in the destination existence index at once
     
-    
-    """
-    db_data = self.get_db_data(table, pk_col, transfer_mode, conn)
-    for i, record in enumerate(records):
-        if pk_col is not None and getattr(record, pk_col.name) in db_data:
-            # if the record pk value is one of those we have to skip
-            # we replace it with an empty dict so we can remove it later                    
-            records[i] = {}
-            tab_stats["records_skipped"] += 1
-        else:
-            # otherwise we can simply prepare the record dictionary
-            records[i] = prepare_record(record) 
-    return records
+    records ::: data records that need to be checked if are already present
+                in the destination table
 
+    existence_index ::: existence.IndexBuilder of the destination primary
+                keys (a new one, reading the keys from conn, if None)
 
-def skip_records_full_in_memory(records, table, conn):
-    """
-    When transfer_mode==DIFF checks if the data is not into the destination
-    DB by checking all the column values of the row. Return only the records
-    that are not in the "conn" database already.
-    
-    see skip_record_pk definition for input parameters details
+    pk_map ::: primary keys map (source pk -> destination pk) of the table
+                if its primary keys are re-mapped: the records are looked up
+                by their mapped keys (the records not in the map are not
+                in the destination table)
     """
-    
-    output = []
-    
-    stmt = table.select()
-    temp_res = conn.execute(stmt).fetchall()
-    columns = [col.name for col in table.c]
-    
-    dest_rows = set([tuple(row)  for row in temp_res])
-    recs_set = set([tuple(row)  for row in records])
-    
-    diff_set = recs_set.difference(dest_rows)
-    print "GOT", 
-    print "checking", len(diff_set)
-    
-    ## first let's get a "clean" record without autoincremet columns
-    #for i, record in enumerate(records):
-        #if i%1000 == 0:
-            #print ".", i       
-        #cleaned_record = clean_record(table, record)
-        
-        #row = tuple([row[col] for row in temp_res])
-        #if not row in dest_rows:
-            #output.append(record)
-            
-    return diff_set
+    records = [record for record in records if record]
+    if pk_col is None or not records:
+        return records
+
+    if existence_index is None:
+        existence_index = existence.IndexBuilder()
+
+    keys = [record[pk_col.name] for record in records]
+    if pk_map is not None:
+        mapped = pkmaps.get_many(pk_map, keys)
+        keys = [mapped.get(key) for key in keys]
+    found = existence_index.contains_many(
+        conn, table, pk_col, [key for key in keys if key is not None])
+    if not found:
+        return records
+
+    # the records whose pk is already there are skipped
+    out = [record for record, key in zip(records, keys) if key not in found]
+    tab_stats["records_skipped"] += len(records) - len(out)
+    return out
 
 
 def skip_records_full(records, table, conn, exclude_pk = False):
     """
     When transfer_mode==DIFF checks if the data is not into the destination
     DB by checking all the column values of the row. Return only the records
-    that are not in the "conn" database already.
+    (as dicts) that are not in the "conn" database already.
+
+    The records are loaded into a staging table and compared by the
+    database with a single query (see staging.StagingTable)
     
+    exclude_pk ::: if True the primary key values are not compared (see
+                skip_records_full_no_pk)
+
     see skip_record_pk definition for input parameters details
     """
-    
-    output = []
-    # first let's get a "clean" record without autoincremet columns
-    for i, record in enumerate(records):
-        if i%1000 == 0:
-            print ".", i       
-        cleaned_record = clean_record(table, record)
-    
-        # build che where clause
-        pairs = [getattr(table.c, colname)==value for colname, value in cleaned_record.items()]
-        clause = reduce(operator.and_, pairs)
-        
-        # build the select statment
-        stmt = table.select(clause)
-        result = conn.execute(stmt).fetchall()
-        print "COMPARING...", cleaned_record, "---", result
-        if len(result) == 1:
-            pass #output.append(record)
-        elif len(result) > 1:
-            # TODO: Not really sure if it should be considered as an error
-            pass
-            #raise NotImplementedError()
-        else:
-            output.append(record)
+    records = [record for record in records if record]
+    if not records:
+        return records
 
-    return output
+    keys = get_compare_keys(table, "FULL_NO_PK" if exclude_pk else "FULL")
+    staging_table = staging.StagingTable(conn, table)
+    try:
+        staging_table.load(columnar.Paquet.from_records(
+            records, [col.name for col in table.columns]
+        ))
+        return staging_table.select_missing(keys)
+    finally:
+        staging_table.drop()
 
 
-def skip_records_full_no_pk(records, table, pk_col, db_data):
+def skip_records_full_no_pk(records, table, pk_col, conn):
     """
     When transfer_mode==DIFF checks if the data is not into the destination DB
     by checking all the row values of the row excluding the primary key value. 
     This mode is designed for tables with an autoincrement pk.
     """
-    pass
+    return skip_records_full(records, table, conn, exclude_pk=True)
 
 
-def check_record_in_db(record, table, engine):
-    dest = engine.connect() # connect to db
-    stmt = [ getattr(table.c, col) == val for col, val in record.keys() ]
-    
-    res = dest.execute(table.select, _records)    
-    
-    dest.close()
-
 # METHODS
+def get_minmax_limits(min_pk, max_pk, partitions):
+    """
+    Returns the (partitions - 1) limits that split the [min_pk, max_pk] range
+    in equal sized ranges. Returns an empty list if the range is empty or too
+    small to be splitted
+    """
+    if min_pk is None or max_pk is None:
+        return []
+
+    limits = []
+    for i in range(1, partitions):
+        # integer primary keys use the integer division on purpose
+        limit = min_pk + (max_pk - min_pk + 1) * i / partitions
+        if min_pk < limit <= max_pk and limit not in limits:
+            limits.append(limit)
+
+    return limits
+
+
 def mssql_creator_factory(connstr):
     """ pyodbc connection factory to handle mssql connection as
     default pyodbc-sqlalchemy is bogus and does not handle some data
@@ -762,6 +2823,15 @@ def is_numeric_column(column):
     return column is not None and isinstance(column.type, col_types)
 
 
+def is_autoincrement_pk(column):
+    """
+    check if the column is an autoincrement numerical primary key column
+    (that is not copied, see clean_record)
+    """
+    return bool(is_numeric_column(column) and column.autoincrement and
+                column.primary_key)
+
+
 def clean_record(table, row):
     """ Standard record cleaning function. It simply drops autoincremental
     primary key columns from row. The useful scenario where to use this
@@ -783,7 +2853,7 @@ def clean_record(table, row):
     
     out = {}
     for col in table.columns:
-        if is_numeric_column(col) and col.autoincrement and col.primary_key:
+        if is_autoincrement_pk(col):
             pass  # exclude the column
         
         else:
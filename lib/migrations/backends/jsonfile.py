@@ -78,7 +78,7 @@ class Migrator(MigratorBase):
 
                         # Finally we have finished looping all the records and just need
                         # to dumpe those left in records
-                        destination.dump(records, table)
+                        self.deliver(destination, records, table)
                     else:
                         print "NO RECORDS"
             except Exception, e:
@@ -0,0 +1,194 @@
+"""
+Trigger based change capture of the CAPTURE transfer mode.
+
+Triggers installed on the source tables log the primary key of every
+record inserted, updated or deleted into a change table (one change per
+record written, the old and new keys of the updates that change the primary
+key). Every migration drains the change log: the source records of the
+logged keys are read again (the records that no longer exist were deleted)
+and the changes applied are removed from the log, so keeping a destination
+in sync costs work proportional to the number of changes and not to the
+size of the tables.
+
+Only SQLite and PostgreSQL (9.3+) sources and tables with a single column
+primary key are supported.
+"""
+import sqlalchemy as sa
+
+
+CHANGE_TABLE = "migrations_changes"
+TRIGGER_PREFIX = "migrations_capture_"
+# kinds of changes logged
+INSERT = "I"
+UPDATE = "U"
+DELETE = "D"
+
+# PostgreSQL trigger function: the name of the primary key column is its
+# argument
+PG_FUNCTION = """
+CREATE OR REPLACE FUNCTION migrations_capture() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO migrations_changes (table_name, operation, pk)
+        VALUES (TG_TABLE_NAME, SUBSTR(TG_OP, 1, 1),
+                row_to_json(NEW) ->> TG_ARGV[0]);
+    END IF;
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND
+            (row_to_json(OLD) ->> TG_ARGV[0]) IS DISTINCT FROM
+            (row_to_json(NEW) ->> TG_ARGV[0])) THEN
+        INSERT INTO migrations_changes (table_name, operation, pk)
+        VALUES (TG_TABLE_NAME, 'D', row_to_json(OLD) ->> TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def supports_capture(dialect):
+    """ returns True if the changes of the dialect databases can be logged """
+    return dialect.name in ("sqlite", "postgresql")
+
+
+def get_change_table(metadata=None):
+    """ returns the change log table (sqlalchemy Table) """
+    if metadata is None:
+        metadata = sa.MetaData()
+
+    table = sa.Table(
+        CHANGE_TABLE, metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("table_name", sa.String(128), nullable=False),
+        sa.Column("operation", sa.String(1), nullable=False),
+        sa.Column("pk", sa.Text),
+    )
+    sa.Index("%s_table" % CHANGE_TABLE, table.c.table_name, table.c.id)
+    return table
+
+
+def get_trigger_name(table_name):
+    """ returns the name of the capture trigger of table_name """
+    return "%s%s" % (TRIGGER_PREFIX, table_name)
+
+
+def is_installed(conn, table):
+    """ returns True if the changes of table are logged """
+    name = get_trigger_name(table.name)
+    if conn.dialect.name == "sqlite":
+        stmt = sa.text("SELECT name FROM sqlite_master WHERE type = 'trigger'"
+                       " AND name = :name")
+        name += "_insert"
+    else:
+        stmt = sa.text("SELECT tgname FROM pg_trigger WHERE tgname = :name")
+
+    return conn.execute(stmt, name=name).first() is not None
+
+
+def install(conn, table):
+    """
+    Creates the change table (if needed) and the triggers that log the
+    changes of table (sqlalchemy Table with a single column primary key)
+    """
+    dialect = conn.dialect
+    if not supports_capture(dialect):
+        raise ValueError("%s databases changes can't be captured" %
+                         dialect.name)
+
+    pk_cols = list(table.primary_key.columns)
+    if len(pk_cols) != 1:
+        raise ValueError("%s has no single column primary key" % table.name)
+
+    get_change_table().create(conn, checkfirst=True)
+
+    preparer = dialect.identifier_preparer
+    trigger = get_trigger_name(table.name)
+    pk = preparer.quote_identifier(pk_cols[0].name)
+    if dialect.name == "postgresql":
+        conn.execute(PG_FUNCTION)
+        conn.execute("DROP TRIGGER IF EXISTS %s ON %s" % (
+            preparer.quote_identifier(trigger), preparer.format_table(table)))
+        conn.execute(
+            "CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s "
+            "FOR EACH ROW EXECUTE PROCEDURE migrations_capture('%s')" % (
+                preparer.quote_identifier(trigger),
+                preparer.format_table(table),
+                pk_cols[0].name.replace("'", "''"))
+        )
+        return
+
+    # SQLite: one trigger per operation
+    log = "INSERT INTO %s (table_name, operation, pk) SELECT '%s', " % (
+        CHANGE_TABLE, table.name.replace("'", "''"))
+    statements = {
+        "insert": [log + "'%s', NEW.%s" % (INSERT, pk)],
+        "update": [log + "'%s', NEW.%s" % (UPDATE, pk),
+                   log + "'%s', OLD.%s WHERE OLD.%s IS NOT NEW.%s" % (
+                       DELETE, pk, pk, pk)],
+        "delete": [log + "'%s', OLD.%s" % (DELETE, pk)],
+    }
+    for operation, body in sorted(statements.items()):
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s BEGIN %s; END" % (
+                preparer.quote_identifier("%s_%s" % (trigger, operation)),
+                operation.upper(), preparer.format_table(table),
+                "; ".join(body))
+        )
+
+
+def uninstall(conn, table):
+    """ drops the triggers that log the changes of table """
+    preparer = conn.dialect.identifier_preparer
+    trigger = get_trigger_name(table.name)
+    if conn.dialect.name == "postgresql":
+        conn.execute("DROP TRIGGER IF EXISTS %s ON %s" % (
+            preparer.quote_identifier(trigger), preparer.format_table(table)))
+        return
+
+    for operation in ("delete", "insert", "update"):
+        conn.execute("DROP TRIGGER IF EXISTS %s" % preparer.quote_identifier(
+            "%s_%s" % (trigger, operation)))
+
+
+def get_last_change(conn, changes, table_name):
+    """
+    returns the id of the last change of table_name logged in the changes
+    table (None if there is none)
+    """
+    return conn.execute(
+        sa.select([sa.func.max(changes.c.id)]).where(
+            changes.c.table_name == table_name)
+    ).scalar()
+
+
+def get_changed_pks(conn, changes, pk_col, table_name, last_change):
+    """
+    returns the select of the distinct primary keys (pk_col values) of the
+    table_name changes logged up to last_change, in primary key order
+    """
+    pk = get_pk_expression(conn.dialect, changes, pk_col)
+    return sa.select([pk.label("pk")]).where(sa.and_(
+        changes.c.table_name == table_name,
+        changes.c.id <= last_change,
+    )).distinct().order_by(pk)
+
+
+def get_pk_expression(dialect, changes, pk_col):
+    """
+    returns the pk column of the changes table as a pk_col value (the keys
+    are logged as text)
+    """
+    if dialect.name == "sqlite" and not isinstance(
+            pk_col.type, (sa.Integer, sa.Numeric, sa.Float)):
+        # the SQLite columns values are not converted by their types: the
+        # other values are stored (and compared) as text
+        return sa.type_coerce(changes.c.pk, pk_col.type)
+
+    return sa.cast(changes.c.pk, pk_col.type)
+
+
+def delete_changes(conn, changes, table_name, last_change):
+    """ removes the table_name changes logged up to last_change """
+    conn.execute(changes.delete().where(sa.and_(
+        changes.c.table_name == table_name,
+        changes.c.id <= last_change,
+    )))
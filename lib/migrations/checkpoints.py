@@ -0,0 +1,334 @@
+"""
+Checkpoints store used to resume migrations that did not finish.
+
+The store is a local SQLite file that records the arguments of the
+migration, the tables already migrated, the progress (last primary key or
+number of records written) of every table part (primary key range), the
+primary keys mapping (old pk -> new pk) of the tables with autoincrement
+primary keys and the indexes and constraints statements deferred to the end
+of the migration.
+"""
+import json
+import sqlite3
+import threading
+import cPickle as pickle
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS migration (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS tables (
+        name TEXT PRIMARY KEY,
+        done INTEGER DEFAULT 0,
+        pk_ranges BLOB
+    )""",
+    """CREATE TABLE IF NOT EXISTS progress (
+        table_name TEXT,
+        unit TEXT,
+        last_pk BLOB,
+        records INTEGER,
+        PRIMARY KEY (table_name, unit)
+    )""",
+    """CREATE TABLE IF NOT EXISTS pk_map (
+        table_name TEXT,
+        old_pk,
+        new_pk,
+        PRIMARY KEY (table_name, old_pk)
+    )""",
+    """CREATE TABLE IF NOT EXISTS deferred_ddl (
+        table_name TEXT,
+        name TEXT,
+        kind TEXT,
+        statement TEXT,
+        PRIMARY KEY (table_name, name)
+    )""",
+]
+
+
+class CheckpointStore(object):
+    """
+    Represent a migration checkpoints file. It's safe to use the same store
+    from different threads.
+    """
+    def __init__(self, path):
+        """
+        path ::: path of the SQLite checkpoints file. It's created if it
+                does not exist yet
+        """
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # (table name, thread ident) -> progress saved while a destination
+        # transaction is open (see begin)
+        self._deferred = {}
+        with self._lock:
+            for stmt in SCHEMA:
+                self._conn.execute(stmt)
+            self._conn.commit()
+
+
+    def close(self):
+        """ closes the checkpoints file """
+        with self._lock:
+            self._conn.close()
+
+
+    def reset(self, **migration_args):
+        """
+        Removes all the checkpoints and saves migration_args (the arguments
+        of the new migration) so the migration can be resumed later
+        """
+        with self._lock:
+            for table_name in ["migration", "tables", "progress", "pk_map",
+                               "deferred_ddl"]:
+                self._conn.execute("DELETE FROM %s" % table_name)
+
+            self._conn.execute(
+                "INSERT INTO migration (key, value) VALUES (?, ?)",
+                ("args", json.dumps(migration_args))
+            )
+            self._conn.commit()
+
+
+    def get_migration_args(self):
+        """
+        Returns the arguments of the migration the checkpoints belong to or
+        None if no migration was saved
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM migration WHERE key = 'args'"
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return dict((str(k), v) for k, v in json.loads(row[0]).items())
+
+
+    def is_done(self, table_name):
+        """ returns True if all table_name records were migrated """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT done FROM tables WHERE name = ?", (table_name,)
+            ).fetchone()
+
+        return bool(row and row[0])
+
+
+    def table_done(self, table_name):
+        """ marks all table_name records as migrated """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO tables (name) VALUES (?)", (table_name,)
+            )
+            self._conn.execute(
+                "UPDATE tables SET done = 1 WHERE name = ?", (table_name,)
+            )
+            self._conn.commit()
+
+
+    def get_pk_ranges(self, table_name):
+        """
+        Returns the primary key ranges table_name was splitted in or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT pk_ranges FROM tables WHERE name = ?", (table_name,)
+            ).fetchone()
+
+        if row is None or row[0] is None:
+            return None
+
+        return pickle.loads(str(row[0]))
+
+
+    def save_pk_ranges(self, table_name, pk_ranges):
+        """ saves the primary key ranges table_name was splitted in """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO tables (name) VALUES (?)", (table_name,)
+            )
+            self._conn.execute(
+                "UPDATE tables SET pk_ranges = ? WHERE name = ?",
+                (sqlite3.Binary(pickle.dumps(pk_ranges, 2)), table_name)
+            )
+            self._conn.commit()
+
+
+    def get_progress(self, table_name, unit):
+        """
+        Returns a (last_pk, records) tuple with the primary key of the last
+        record written and the number of records written for the unit (i.e.
+        a primary key range) of table_name. Returns (None, 0) if nothing was
+        written yet
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_pk, records FROM progress "
+                "WHERE table_name = ? AND unit = ?",
+                (table_name, unicode(unit))
+            ).fetchone()
+
+        if row is None:
+            return None, 0
+
+        return pickle.loads(str(row[0])), row[1]
+
+
+    def begin(self, table_name):
+        """
+        Called by the destination when it opens a transaction to write
+        table_name records from the current thread. Until commit (or
+        rollback) is called the progress saved by the current thread for
+        table_name is kept in memory
+        """
+        key = (table_name, threading.current_thread().ident)
+        with self._lock:
+            self._deferred.setdefault(key, [])
+
+
+    def commit(self, table_name):
+        """
+        Called by the destination once the transaction opened with begin has
+        been committed: saves the progress kept in memory
+        """
+        key = (table_name, threading.current_thread().ident)
+        with self._lock:
+            for args in self._deferred.pop(key, []):
+                self._save_progress(*args)
+            self._conn.commit()
+
+
+    def rollback(self, table_name):
+        """
+        Called by the destination when the transaction opened with begin has
+        been rolled back: discards the progress kept in memory
+        """
+        key = (table_name, threading.current_thread().ident)
+        with self._lock:
+            self._deferred.pop(key, None)
+
+
+    def save_progress(self, table_name, unit, last_pk, records, pk_map=None):
+        """
+        Saves the progress of the unit of table_name after a paquet was
+        written.
+
+        last_pk ::: primary key of the last record written (if any)
+
+        records ::: total number of records of the unit already written
+
+        pk_map ::: sequence of (old_pk, new_pk) of the records of the
+                    paquet if the table primary keys are remapped
+
+        If a destination transaction is open (see begin) the progress is
+        saved when the transaction is committed.
+        """
+        key = (table_name, threading.current_thread().ident)
+        with self._lock:
+            if key in self._deferred:
+                self._deferred[key].append(
+                    (table_name, unit, last_pk, records, pk_map)
+                )
+                return
+
+            self._save_progress(table_name, unit, last_pk, records, pk_map)
+            self._conn.commit()
+
+
+    def _save_progress(self, table_name, unit, last_pk, records, pk_map):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO progress "
+                "(table_name, unit, last_pk, records) VALUES (?, ?, ?, ?)",
+                (table_name,
+                 unicode(unit),
+                 sqlite3.Binary(pickle.dumps(last_pk, 2)),
+                 records)
+            )
+            if pk_map:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO pk_map (table_name, old_pk, new_pk) "
+                    "VALUES (?, ?, ?)",
+                    [(table_name, old, new) for old, new in pk_map]
+                )
+
+
+    def iter_pk_map(self, table_name, batch=10000):
+        """
+        Returns an iterator of the saved (old_pk, new_pk) pairs of
+        table_name (read in batches so the mapping is never fully loaded)
+        """
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, old_pk, new_pk FROM pk_map "
+                    "WHERE table_name = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (table_name, last, batch)
+                ).fetchall()
+
+            if not rows:
+                return
+
+            for rowid, old_pk, new_pk in rows:
+                yield old_pk, new_pk
+            last = rows[-1][0]
+
+
+    def get_pk_map(self, table_name):
+        """ returns the saved primary keys mapping of table_name """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT old_pk, new_pk FROM pk_map WHERE table_name = ?",
+                (table_name,)
+            ).fetchall()
+
+        return dict(rows)
+
+
+    def save_deferred_ddl(self, table_name, statements):
+        """
+        Saves the statements (sequence of (name, kind, statement) tuples)
+        that create the indexes and constraints of table_name deferred to the
+        end of the migration
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deferred_ddl "
+                "(table_name, name, kind, statement) VALUES (?, ?, ?, ?)",
+                [(table_name, name, kind, statement)
+                 for name, kind, statement in statements]
+            )
+            self._conn.commit()
+
+
+    def get_deferred_ddl(self):
+        """
+        Returns the deferred statements not executed yet as a dict of table
+        name -> list of (name, kind, statement)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT table_name, name, kind, statement FROM deferred_ddl "
+                "ORDER BY table_name, name"
+            ).fetchall()
+
+        out = {}
+        for table_name, name, kind, statement in rows:
+            out.setdefault(table_name, []).append((name, kind, statement))
+
+        return out
+
+
+    def deferred_ddl_done(self, table_name, name):
+        """ removes the deferred statement name of table_name once executed """
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM deferred_ddl WHERE table_name = ? AND name = ?",
+                (table_name, name)
+            )
+            self._conn.commit()
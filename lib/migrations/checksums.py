@@ -0,0 +1,226 @@
+"""
+Checksums of table records (whole tables or primary key ranges) used to find
+the records that differ between the source and the destination without
+moving them.
+
+A range checksum is the number of records, the min/max primary key values
+and the sum (modulo 2 ** 64) of the records hashes, so it does not depend on
+the records order. It's computed by the database itself on the dialects that
+can hash the records (server side) and by reading and hashing the records
+otherwise (client side). Server side checksums hash the records as the
+database renders them so they can only be compared between databases of the
+same dialect: use_server_checksums tells when both sides can use them.
+"""
+import datetime
+import decimal
+import hashlib
+import struct
+from collections import namedtuple
+
+import sqlalchemy as sa
+
+
+MODULUS = 2 ** 64
+# records read at once by the client side checksums
+BATCH_SIZE = 10000
+# separator of the normalized values of a record
+SEPARATOR = "\x1f"
+NULL = "\\N"
+
+
+class Checksum(namedtuple("Checksum", "count min_pk max_pk digest")):
+    """ checksum of a records range (see get_checksum) """
+
+
+def normalize(value):
+    """
+    Returns value as a string that does not depend on the database (or
+    driver) that returned it
+    """
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return str(int(value))
+        return str(value.normalize())
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    return str(value)
+
+
+def hash_row(values):
+    """ returns the (64 bits) hash of a record values """
+    text = SEPARATOR.join(normalize(value) for value in values)
+    return struct.unpack("<Q", hashlib.md5(text).digest()[:8])[0]
+
+
+class SQLiteChecksum(object):
+    """ SQLite aggregate function that sums the records hashes """
+    def __init__(self):
+        self.digest = 0
+
+    def step(self, *values):
+        self.digest = (self.digest + hash_row(values)) % MODULUS
+
+    def finalize(self):
+        # SQLite integers are signed 64 bits
+        return str(self.digest)
+
+
+def get_server_expression(conn, columns):
+    """
+    Returns the sql expression that computes the records hashes sum of the
+    columns on the conn database or None if the dialect can't
+    """
+    name = conn.dialect.name
+    preparer = conn.dialect.identifier_preparer
+    quoted = [preparer.quote_identifier(col.name) for col in columns]
+
+    if name == "sqlite":
+        conn.connection.create_aggregate("migrations_checksum", -1,
+                                         SQLiteChecksum)
+        return "migrations_checksum(%s)" % ", ".join(quoted)
+
+    if name == "postgresql":
+        return ("COALESCE(SUM(('x' || SUBSTR(MD5(CAST(ROW(%s) AS TEXT)), "
+                "1, 16))::BIT(64)::BIGINT), 0)" % ", ".join(quoted))
+
+    if name == "mysql":
+        values = ", ".join("COALESCE(%s, '\\\\N')" % col for col in quoted)
+        return ("COALESCE(SUM(CAST(CONV(SUBSTRING(MD5(CONCAT_WS('|', %s)), "
+                "1, 15), 16, 10) AS UNSIGNED)), 0)" % values)
+
+    if name == "mssql":
+        return "COALESCE(CHECKSUM_AGG(BINARY_CHECKSUM(%s)), 0)" % \
+            ", ".join(quoted)
+
+    return None
+
+
+def supports_server_checksums(dialect):
+    """ returns True if the dialect database can compute the checksums """
+    return dialect.name in ("sqlite", "postgresql", "mysql", "mssql")
+
+
+def use_server_checksums(dialect, other_dialect):
+    """
+    returns True if the checksums of two databases (dialects) can be
+    computed server side and compared
+    """
+    return dialect.name == other_dialect.name and \
+        supports_server_checksums(dialect)
+
+
+def where_range(stmt, pk_col, lower=None, upper=None):
+    """ returns stmt limited to the records where lower <= pk < upper """
+    if lower is not None:
+        stmt = stmt.where(pk_col >= lower)
+    if upper is not None:
+        stmt = stmt.where(pk_col < upper)
+
+    return stmt
+
+
+def get_checksum(conn, table, pk_col, lower=None, upper=None, columns=None,
+                 server=True):
+    """
+    Returns the Checksum of the table records where lower <= pk < upper.
+
+    pk_col ::: primary key column of table. If None the checksum is of the
+                whole table (min_pk and max_pk are None)
+
+    columns ::: columns of table hashed (all the table columns if None)
+
+    server ::: if True (and the dialect supports it) the checksum is
+                computed by the database
+    """
+    if columns is None:
+        columns = list(table.columns)
+    if pk_col is None:
+        lower = upper = None
+
+    expression = None
+    if server and supports_server_checksums(conn.dialect):
+        expression = get_server_expression(conn, columns)
+
+    if expression is None:
+        return get_client_checksum(conn, table, pk_col, lower, upper, columns)
+
+    aggregates = [sa.func.count()]
+    if pk_col is not None:
+        aggregates += [sa.func.min(pk_col), sa.func.max(pk_col)]
+    aggregates.append(sa.literal_column(expression))
+
+    stmt = where_range(sa.select(aggregates).select_from(table), pk_col,
+                       lower, upper)
+    row = list(conn.execute(stmt).fetchone())
+    if pk_col is None:
+        row[1:1] = [None, None]
+
+    count, min_pk, max_pk, digest = row
+    return Checksum(count, min_pk, max_pk, int(digest or 0) % MODULUS)
+
+
+def get_client_checksum(conn, table, pk_col, lower=None, upper=None,
+                        columns=None):
+    """ see get_checksum. Reads and hashes the records """
+    if columns is None:
+        columns = list(table.columns)
+
+    count, min_pk, max_pk, digest = 0, None, None, 0
+    stmt = where_range(sa.select(get_select(columns, pk_col)), pk_col, lower,
+                       upper)
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    try:
+        while True:
+            rows = result.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+
+            for row in rows:
+                digest += hash_row([row[col] for col in columns])
+                if pk_col is not None:
+                    pk = row[pk_col]
+                    if min_pk is None or pk < min_pk:
+                        min_pk = pk
+                    if max_pk is None or pk > max_pk:
+                        max_pk = pk
+            count += len(rows)
+    finally:
+        result.close()
+
+    return Checksum(count, min_pk, max_pk, digest % MODULUS)
+
+
+def get_row_hashes(conn, table, pk_col, lower=None, upper=None,
+                   columns=None):
+    """
+    Returns a dict that maps the primary key of the table records where
+    lower <= pk < upper to their hash (see hash_row)
+    """
+    if columns is None:
+        columns = list(table.columns)
+
+    stmt = where_range(sa.select(get_select(columns, pk_col)), pk_col, lower,
+                       upper)
+    return dict((row[pk_col], hash_row([row[col] for col in columns]))
+                for row in conn.execute(stmt))
+
+
+def get_select(columns, pk_col=None):
+    """ returns the columns to select to hash columns (and read pk_col) """
+    if pk_col is None or any(col is pk_col for col in columns):
+        return list(columns)
+
+    return [pk_col] + list(columns)
@@ -0,0 +1,97 @@
+"""
+Columnar paquets: the records of a paquet kept as one list of values per
+column instead of one dict per record.
+
+The dbms destination transforms the paquets a whole column at a time (i.e.
+the foreign keys of a column are re-mapped with a single primary keys map
+lookup) and the rows are only built, as plain tuples, right before the
+insert.
+"""
+from migrations import pkmaps
+
+
+class Paquet(object):
+    """
+    Records of a paquet as columns: keys is the list of the columns names
+    and columns the dict that maps every key to the list of its values (one
+    value per record)
+    """
+    def __init__(self, keys, columns, size=None):
+        self.keys = list(keys)
+        self.columns = columns
+        if size is None:
+            size = len(columns[self.keys[0]]) if self.keys else 0
+        self.size = size
+
+
+    @classmethod
+    def from_records(cls, records, keys):
+        """
+        Returns the Paquet with the values of keys of records (dicts or
+        sqlalchemy rows). Empty records are skipped
+        """
+        records = [record for record in records if record]
+        columns = dict((key, [record[key] for record in records])
+                       for key in keys)
+        return cls(keys, columns, len(records))
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+
+    def __setitem__(self, key, values):
+        if key not in self.columns:
+            self.keys.append(key)
+        self.columns[key] = values
+
+
+    def __contains__(self, key):
+        return key in self.columns
+
+
+    def __iter__(self):
+        """ iterates the records as dicts """
+        keys = self.keys
+        for row in self.rows():
+            yield dict(zip(keys, row))
+
+
+    def project(self, keys):
+        """ returns a Paquet with the keys columns only (values shared) """
+        return Paquet(keys, dict((key, self.columns[key]) for key in keys),
+                      self.size)
+
+
+    def rows(self, keys=None):
+        """ returns the records as a list of tuples of the keys values """
+        if keys is None:
+            keys = self.keys
+        if not keys:
+            return [()] * self.size
+
+        return zip(*[self.columns[key] for key in keys])
+
+
+    def to_dicts(self):
+        """ returns the records as a list of dicts """
+        return list(self)
+
+
+    def remap(self, key, pk_map):
+        """
+        Replaces the key column values with the new values in pk_map (a
+        PKMap or a dict) looking them up all at once. The values that are
+        not in pk_map are kept
+        """
+        values = self.columns[key]
+        new_values = pkmaps.get_many(
+            pk_map, set(value for value in values if value is not None)
+        )
+        if new_values:
+            get = new_values.get
+            self.columns[key] = [get(value, value) for value in values]
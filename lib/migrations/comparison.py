@@ -0,0 +1,388 @@
+"""
+Streaming comparison of a source and a destination table.
+
+Both tables are read ordered by primary key (in batches, through server
+side cursors where supported) and merge-joined, so comparing two tables
+costs one sorted read of every side whatever their size and the memory used
+does not depend on it. The records missing from the destination, the extra
+destination records and the records whose values differ are written, as
+JSON lines, to a diff file (see DiffWriter) and counted.
+
+The string primary keys are sorted with the binary collation of the
+dialects that have one so both sides are sorted the same way (code points
+order). ComparisonError is raised if a side is not sorted as expected.
+
+The columns whose values were re-mapped by the migration (autoincrement
+primary keys and the foreign keys linking to them) are compared through
+their primary keys maps: the source values are mapped and, as the mapped
+primary keys are not sorted, the destination records are looked up by key
+in batches instead of merged.
+"""
+import datetime
+import decimal
+import itertools
+import json
+
+import sqlalchemy as sa
+
+from migrations import checksums
+from migrations import loaders
+from migrations import pkmaps
+
+
+# records read at once from every side
+BATCH_SIZE = 10000
+# collations that sort the strings by code point
+BINARY_COLLATIONS = {
+    "postgresql": '"C"',
+    "mssql": "Latin1_General_BIN2",
+}
+# kinds of differences
+MISSING = "missing"  # source records that are not in the destination
+EXTRA = "extra"  # destination records that are not in the source
+CHANGED = "changed"  # records whose values differ
+
+
+class ComparisonError(Exception):
+    """ Raised when the tables records can't be merged """
+
+
+class DiffWriter(object):
+    """
+    Writes the differences found, one JSON object per line, to the path file
+    (nowhere if path is None)
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._fp = open(path, "w") if path is not None else None
+
+
+    def write(self, table_name, kind, key, source=None, destination=None):
+        """
+        Writes a difference of the kind kind (MISSING, EXTRA or CHANGED) of
+        the record with the key primary key. source and destination are the
+        record values (dicts) on every side (None if missing)
+        """
+        if self._fp is None:
+            return
+
+        line = {"table": table_name, "type": kind, "pk": key}
+        if source is not None:
+            line["source"] = source
+        if destination is not None:
+            line["destination"] = destination
+        self._fp.write(json.dumps(line, default=to_json) + "\n")
+
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def new_summary():
+    """ returns an empty comparison summary (see compare_tables) """
+    return {"source": 0, "destination": 0, "equal": 0, MISSING: 0, EXTRA: 0,
+            CHANGED: 0}
+
+
+def add_summary(summary, other):
+    """ adds the counts of the other summary to summary. Returns summary """
+    for key, value in other.items():
+        summary[key] = summary.get(key, 0) + value
+
+    return summary
+
+
+def compare_tables(source_conn, source_table, dest_conn, dest_table,
+                   diff_writer=None, batch_size=BATCH_SIZE, pk_range=None,
+                   key_maps=None):
+    """
+    Compares the records of source_table (read through source_conn) and
+    dest_table (read through dest_conn) matching them by primary key (all
+    the columns for tables without primary key). Only the columns of both
+    tables are compared. If dest_table is None (the destination has no such
+    table) all the source records are missing.
+
+    diff_writer ::: DiffWriter where the differences are written
+
+    pk_range ::: (lower, upper) range of the (single column) primary key of
+                the records compared (lower <= pk < upper, None means no
+                limit). All the records if None
+
+    key_maps ::: dict of the source columns whose values were re-mapped by
+                the migration: column name -> primary keys map (source value
+                -> destination value, see migrations.pkmaps). If the primary
+                key is re-mapped the extra destination records are counted
+                but not written to diff_writer (and pk_range is ignored)
+
+    Returns the summary dict: number of "source" and "destination" records
+    and number of "equal", "missing", "extra" and "changed" records
+    """
+    if dest_table is None:
+        dest_names = set(col.name for col in source_table.columns)
+    else:
+        dest_names = set(col.name for col in dest_table.columns)
+    names = [col.name for col in source_table.columns
+             if col.name in dest_names]
+    key_names = [col.name for col in source_table.primary_key.columns
+                 if col.name in dest_names]
+    if not key_names or \
+            len(key_names) != len(source_table.primary_key.columns):
+        key_names = names
+
+    key_maps = dict((name, pk_map) for name, pk_map in (key_maps or {}).items()
+                    if name in names)
+    lookup = len(key_names) == 1 and key_names[0] in key_maps
+    if lookup:
+        pk_range = None
+
+    summary = new_summary()
+    source_rows = iter_rows(source_conn, source_table, names, key_names,
+                            batch_size, pk_range)
+    if key_maps:
+        source_rows = map_rows(source_rows, names, key_names, key_maps,
+                               batch_size)
+    if dest_table is None:
+        triplets = merge_join(source_rows, iter([]))
+    elif lookup:
+        triplets = lookup_join(source_rows, dest_conn, dest_table, names,
+                               key_names[0], batch_size)
+    else:
+        triplets = merge_join(source_rows, iter_rows(
+            dest_conn, dest_table, names, key_names, batch_size, pk_range))
+
+    for key, source, dest in triplets:
+        if source is not None:
+            summary["source"] += 1
+        if dest is not None:
+            summary["destination"] += 1
+
+        if dest is None:
+            kind = MISSING
+        elif source is None:
+            kind = EXTRA
+        elif normalize_row(source) == normalize_row(dest):
+            summary["equal"] += 1
+            continue
+        else:
+            kind = CHANGED
+
+        summary[kind] += 1
+        if diff_writer is not None:
+            diff_writer.write(
+                source_table.name, kind, key,
+                dict(zip(names, source)) if source is not None else None,
+                dict(zip(names, dest)) if dest is not None else None
+            )
+
+    if lookup and dest_table is not None:
+        # the destination records not found by key
+        count = dest_conn.execute(
+            sa.select([sa.func.count()]).select_from(dest_table)).scalar()
+        summary[EXTRA] += count - summary["destination"]
+        summary["destination"] = count
+
+    return summary
+
+
+def compare_checksums_only(source_conn, source_table, dest_conn, dest_table,
+                           excluded=()):
+    """
+    Compares the number of records and the checksum (see
+    migrations.checksums) of the columns of both tables but the excluded
+    ones, for the tables whose records can't be matched by key (i.e. their
+    primary keys were re-mapped by a migration whose map is not available).
+
+    Returns the summary (see compare_tables) with "comparable" False: all the
+    records are "equal" if the checksums are, otherwise only the number of
+    "missing" or "extra" records is known
+    """
+    names = [col.name for col in source_table.columns
+             if col.name in dest_table.c and col.name not in excluded]
+    server = checksums.use_server_checksums(source_conn.dialect,
+                                            dest_conn.dialect)
+    src = checksums.get_checksum(
+        source_conn, source_table, None,
+        columns=[source_table.c[name] for name in names], server=server)
+    dst = checksums.get_checksum(
+        dest_conn, dest_table, None,
+        columns=[dest_table.c[name] for name in names], server=server)
+
+    summary = new_summary()
+    summary.update(source=src.count, destination=dst.count, comparable=False)
+    if src == dst:
+        summary["equal"] = src.count
+    else:
+        summary[MISSING] = max(0, src.count - dst.count)
+        summary[EXTRA] = max(0, dst.count - src.count)
+
+    return summary
+
+
+def iter_rows(conn, table, names, key_names, batch_size=BATCH_SIZE,
+              pk_range=None):
+    """
+    iterates the (key, values) pairs of the table records sorted by key
+    (the values of the key_names columns, a tuple if there are many).
+    values is the tuple of the names columns values. pk_range limits the
+    records read (see compare_tables)
+    """
+    columns = [table.c[name] for name in names]
+    key_columns = [table.c[name] for name in key_names]
+    stmt = sa.select(columns).order_by(
+        *[get_order_by(conn.dialect, col) for col in key_columns])
+    if pk_range is not None:
+        stmt = checksums.where_range(stmt, key_columns[0], *pk_range)
+
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                values = tuple(row[col] for col in columns)
+                if len(key_columns) == 1:
+                    key = row[key_columns[0]]
+                else:
+                    key = tuple(row[col] for col in key_columns)
+                yield key, values
+    finally:
+        result.close()
+
+
+def map_rows(pairs, names, key_names, key_maps, batch_size=BATCH_SIZE):
+    """
+    iterates the (key, values) pairs of pairs (see iter_rows) with the
+    values of the key_maps columns mapped (see compare_tables), batch_size
+    pairs at a time. The values that are not in their map are left as they
+    are but the records whose re-mapped key is not in its map get a None
+    key (they were not migrated)
+    """
+    positions = [(names.index(name), pk_map)
+                 for name, pk_map in key_maps.items()]
+    key_position = None
+    if len(key_names) == 1 and key_names[0] in key_maps:
+        key_position = names.index(key_names[0])
+
+    pairs = iter(pairs)
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            return
+
+        rows = [list(values) for key, values in batch]
+        keys = [key for key, values in batch]
+        for position, pk_map in positions:
+            mapped = pkmaps.get_many(pk_map, [
+                row[position] for row in rows if row[position] is not None])
+            if position == key_position:
+                keys = [mapped.get(key) for key in keys]
+            for row in rows:
+                row[position] = mapped.get(row[position], row[position])
+
+        for key, row in zip(keys, rows):
+            yield key, tuple(row)
+
+
+def lookup_join(source, conn, table, names, key_name,
+                batch_size=BATCH_SIZE):
+    """
+    Looks the destination records of the (key, values) pairs of source up
+    in table (through conn) by the key_name column, batch_size records at a
+    time. Yields the (key, source values, destination values) triplets
+    (the destination values are None if the key is None or not in table)
+    """
+    columns = [table.c[name] for name in names]
+    key_col = table.c[key_name]
+    max_params = loaders.MAX_PARAMS.get(conn.dialect.name,
+                                        loaders.DEFAULT_MAX_PARAMS)
+    source = iter(source)
+    while True:
+        batch = list(itertools.islice(source, batch_size))
+        if not batch:
+            return
+
+        keys = [key for key, values in batch if key is not None]
+        found = {}
+        for i in range(0, len(keys), max_params):
+            stmt = sa.select(columns).where(
+                key_col.in_(keys[i:i + max_params]))
+            for row in conn.execute(stmt):
+                found[row[key_col]] = tuple(row[col] for col in columns)
+
+        for key, values in batch:
+            yield key, values, found.get(key) if key is not None else None
+
+
+def get_order_by(dialect, column):
+    """
+    returns the order by expression of column that sorts its values like
+    python does (strings by code point and NULL values first)
+    """
+    expr = column
+    collation = BINARY_COLLATIONS.get(dialect.name)
+    if collation is not None and isinstance(column.type, sa.String):
+        expr = sa.collate(column, collation)
+
+    if column.nullable and dialect.name in ("postgresql", "oracle"):
+        # NULL values are sorted last by default
+        expr = expr.asc().nullsfirst()
+
+    return expr
+
+
+def merge_join(source, destination):
+    """
+    Merges the (key, values) iterables source and destination (sorted by
+    key). Yields the (key, source values, destination values) triplets
+    (values are None when the key is missing from a side)
+    """
+    source = check_sorted(source, "source")
+    destination = check_sorted(destination, "destination")
+    src = next(source, None)
+    dst = next(destination, None)
+    while src is not None or dst is not None:
+        if dst is None or (src is not None and src[0] < dst[0]):
+            yield src[0], src[1], None
+            src = next(source, None)
+        elif src is None or dst[0] < src[0]:
+            yield dst[0], None, dst[1]
+            dst = next(destination, None)
+        else:
+            yield src[0], src[1], dst[1]
+            src = next(source, None)
+            dst = next(destination, None)
+
+
+def check_sorted(pairs, side):
+    """ iterates pairs raising ComparisonError if they are not sorted """
+    last = None
+    first = True
+    for pair in pairs:
+        if not first and pair[0] < last:
+            raise ComparisonError(
+                "%s records are not sorted by key (%r after %r): the "
+                "database sorts them in a different order" % (
+                    side, pair[0], last))
+        first = False
+        last = pair[0]
+        yield pair
+
+
+def normalize_row(values):
+    """ returns the values of a record as dialect independent strings """
+    return [checksums.normalize(value) for value in values]
+
+
+def to_json(value):
+    """ json default: returns the values json can't serialize as strings """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time,
+                          decimal.Decimal)):
+        return checksums.normalize(value)
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+
+    return repr(value)
@@ -0,0 +1,157 @@
+"""
+Bounded thread pool used to run many migrations (or migration operations)
+concurrently from a single process.
+"""
+import sys
+import threading
+import Queue
+
+
+class Task(object):
+    """
+    Represent an operation submitted to an Executor. Use wait/result to get
+    the operation outcome.
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+
+    def run(self):
+        """ runs the operation (called by the executor workers) """
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+        with self._lock:
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            callback(self)
+
+
+    def done(self):
+        """ returns True if the operation has finished """
+        return self._event.is_set()
+
+
+    def wait(self, timeout=None):
+        """
+        Waits (at most timeout seconds) for the operation to finish. Returns
+        True if it has finished
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+
+    def result(self, timeout=None):
+        """
+        Waits for the operation to finish and returns its result. Raises the
+        exception raised by the operation (if any)
+        """
+        if not self.wait(timeout):
+            raise RuntimeError("the task did not finish in %s seconds" %
+                               timeout)
+
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+
+        return self._result
+
+
+    def exception(self, timeout=None):
+        """
+        Waits for the operation to finish and returns the exception it
+        raised (None if it did not)
+        """
+        self.wait(timeout)
+        return self._exc_info and self._exc_info[1]
+
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(task) when the operation finishes (immediately if it
+        has already finished)
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+
+class Executor(object):
+    """
+    Runs the submitted operations on a fixed number of worker threads, no
+    matter how many operations (i.e. migrations) are submitted.
+    """
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules func(*args, **kwargs) to be run by a worker and returns its
+        Task
+        """
+        task = Task(func, args, kwargs)
+        with self._lock:
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+        self._queue.put(task)
+        return task
+
+
+    def map(self, func, iterable):
+        """ submits func(item) for every item and returns the Tasks """
+        return [self.submit(func, item) for item in iterable]
+
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the submitted operations are finished. If wait
+        is True it blocks until then
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            task.run()
+
+
+def wait_all(tasks, timeout=None):
+    """
+    Waits for all the tasks to finish and returns their results (in the same
+    order). Raises the first exception raised by a task (if any)
+    """
+    return [task.result(timeout) for task in tasks]
@@ -0,0 +1,525 @@
+"""
+Primary keys existence indexes used by the dbms destination in DIFF mode to
+skip the records that are already in the destination tables.
+
+Loading the destination primary keys in a python set costs more than 50
+bytes per key. The integer primary keys are kept in a sorted array (8 bytes
+per key) searched with binary search and the other keys in a Bloom filter
+(about 10 bits per key with a 1% error rate) whose positives are confirmed
+by the destination database with batched WHERE pk IN (...) queries.
+
+The indexes can be saved to a directory and loaded by the next runs as
+long as the destination table signature (number of records, min and max
+primary keys and the sum of the integer primary keys) did not change
+meanwhile. A table can change and keep its signature so the positives of
+the loaded indexes are always confirmed by the database, like the Bloom
+filter ones.
+"""
+import array
+import bisect
+import decimal
+import hashlib
+import heapq
+import json
+import math
+import os
+import struct
+import threading
+
+import sqlalchemy as sa
+
+from migrations import loaders
+
+
+# keys read at once from the destination database
+BATCH_SIZE = 10000
+# tables with less records than this use a SetIndex (AUTO kind)
+MAX_SET_SIZE = 1000000
+
+
+class ExistenceIndex(object):
+    """
+    Base class of the existence indexes: set like containers of the primary
+    keys of a destination table that are queried in batches
+    """
+    kind = None
+    # False if contains_many may return keys that are not in the index
+    exact = True
+
+    def contains_many(self, keys):
+        """ returns the set of the keys of keys that are in the index """
+        raise NotImplementedError
+
+
+    def add_many(self, keys):
+        """ adds keys (i.e. the primary keys just inserted) to the index """
+        raise NotImplementedError
+
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+    def __contains__(self, key):
+        return bool(self.contains_many([key]))
+
+
+    def get_state(self):
+        """ returns (header dict, data string) to save the index """
+        raise NotImplementedError
+
+
+    def save(self, path, signature):
+        """
+        Saves the index to path. signature is the signature of the table
+        when the index is saved (see get_signature, checked by load_index)
+        """
+        header, data = self.get_state()
+        header.update(kind=self.kind, rows=signature["rows"],
+                      signature=normalize_signature(signature))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(json.dumps(header) + "\n")
+            fp.write(data)
+        os.rename(tmp_path, path)
+
+
+    def __repr__(self):
+        return "<%s: %s keys>" % (self.__class__.__name__, len(self))
+
+
+class SetIndex(ExistenceIndex):
+    """ Keeps the keys in a python set """
+    kind = "SET"
+
+    def __init__(self, keys=()):
+        self._keys = set(keys)
+
+
+    def contains_many(self, keys):
+        return self._keys.intersection(keys)
+
+
+    def add_many(self, keys):
+        self._keys.update(keys)
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def get_state(self):
+        return {}, json.dumps(list(self._keys))
+
+
+class SortedArrayIndex(ExistenceIndex):
+    """
+    Keeps integer keys in a sorted array searched with binary search. The
+    keys added later are kept in a set and merged when the index is saved
+    """
+    kind = "SORTED_ARRAY"
+
+    def __init__(self, keys=()):
+        """
+        keys ::: iterable of integer keys (sorted keys are not sorted
+                    again)
+        """
+        values = array.array("l")
+        is_sorted = True
+        last = None
+        for key in keys:
+            if last is not None and key < last:
+                is_sorted = False
+            values.append(key)
+            last = key
+
+        if not is_sorted:
+            values = array.array("l", sorted(values))
+
+        self._values = values
+        self._added = set()
+
+
+    def _search(self, value):
+        """ returns True if value is in the sorted array """
+        values = self._values
+        i = bisect.bisect_left(values, value)
+        return i < len(values) and values[i] == value
+
+
+    def contains_many(self, keys):
+        added = self._added
+        found = set()
+        for key in keys:
+            value = to_integer(key)
+            if value is not None and (value in added or self._search(value)):
+                found.add(key)
+
+        return found
+
+
+    def add_many(self, keys):
+        for key in keys:
+            value = to_integer(key)
+            if value is not None:
+                self._added.add(value)
+
+
+    def __len__(self):
+        return len(self._values) + len(self._added)
+
+
+    def get_state(self):
+        if self._added:
+            # the keys added are merged into the sorted array
+            added = sorted(value for value in self._added
+                           if not self._search(value))
+            self._values = array.array("l", heapq.merge(self._values, added))
+            self._added = set()
+
+        return {}, self._values.tostring()
+
+
+class BloomIndex(ExistenceIndex):
+    """
+    Bloom filter of the keys. contains_many returns the keys that pass the
+    filter: they have to be confirmed (see IndexBuilder.contains_many) as
+    some of them (error_rate) are false positives
+    """
+    kind = "BLOOM"
+    exact = False
+
+    def __init__(self, capacity, error_rate=0.01, bits=None, hashes=None,
+                 count=0, data=None):
+        """
+        capacity ::: expected number of keys
+
+        error_rate ::: false positives rate at capacity keys
+        """
+        capacity = max(1, capacity)
+        if bits is None:
+            bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                 math.log(2) ** 2))
+        if hashes is None:
+            hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+
+        self.bits = max(8, bits)
+        self.hashes = hashes
+        self._count = count
+        self._data = bytearray(data) if data is not None else \
+            bytearray((self.bits + 7) // 8)
+
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(to_bytes(key)).digest())
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+
+    def may_contain(self, key):
+        """ returns False if key is not in the index (True if it may be) """
+        data = self._data
+        for position in self._positions(key):
+            if not data[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+
+    def contains_many(self, keys):
+        return set(key for key in keys if self.may_contain(key))
+
+
+    def add_many(self, keys):
+        data = self._data
+        for key in keys:
+            for position in self._positions(key):
+                data[position >> 3] |= 1 << (position & 7)
+            self._count += 1
+
+
+    def __len__(self):
+        return self._count
+
+
+    def get_state(self):
+        header = {"bits": self.bits, "hashes": self.hashes,
+                  "count": self._count}
+        return header, str(self._data)
+
+
+def create_index(kind, keys, rows, integer_keys, error_rate=0.01):
+    """
+    Returns a new existence index with keys.
+
+    kind ::: SET, SORTED_ARRAY, BLOOM or AUTO (SORTED_ARRAY for integer
+                keys, SET for tables with up to MAX_SET_SIZE records and
+                BLOOM for the others)
+
+    keys ::: iterable of the table primary keys (sorted if possible)
+
+    rows ::: number of keys (expected)
+
+    integer_keys ::: True if the primary keys are integers
+
+    error_rate ::: see BloomIndex
+    """
+    kind = (kind or "AUTO").upper()
+    if kind == "AUTO":
+        if integer_keys:
+            kind = "SORTED_ARRAY"
+        elif rows <= MAX_SET_SIZE:
+            kind = "SET"
+        else:
+            kind = "BLOOM"
+
+    if kind == "SET":
+        return SetIndex(keys)
+    elif kind == "SORTED_ARRAY":
+        return SortedArrayIndex(keys)
+    elif kind == "BLOOM":
+        index = BloomIndex(rows, error_rate)
+        index.add_many(keys)
+        return index
+
+    raise ValueError("unknown existence index: %s" % kind)
+
+
+def load_index(path, signature):
+    """
+    Returns the index saved in path or None if the file does not exist or
+    the table had a different signature (see get_signature) when it was
+    saved
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as fp:
+        header = json.loads(fp.readline())
+        if header.get("signature") != normalize_signature(signature):
+            return None
+        data = fp.read()
+
+    rows = signature["rows"]
+    kind = header["kind"]
+    if kind == "SET":
+        return SetIndex(json.loads(data))
+    elif kind == "SORTED_ARRAY":
+        index = SortedArrayIndex()
+        index._values.fromstring(data)
+        return index
+    elif kind == "BLOOM":
+        return BloomIndex(rows, bits=header["bits"],
+                          hashes=header["hashes"], count=header["count"],
+                          data=data)
+
+    return None
+
+
+class IndexBuilder(object):
+    """
+    Builds (or loads) the existence indexes of the destination tables
+    reading their primary keys in batches
+    """
+    def __init__(self, kind="AUTO", error_rate=0.01, directory=None,
+                 max_params=None, indexes=None):
+        """
+        kind, error_rate ::: see create_index
+
+        directory ::: directory where the indexes are saved (see save) and
+                    loaded from. If None they are not saved
+
+        max_params ::: maximum number of keys of a confirmation query (the
+                    dialect bound parameters limit if None)
+
+        indexes ::: dict where the indexes are kept: table name -> (index,
+                    table signature, see get_signature)
+        """
+        self.kind = kind
+        self.error_rate = error_rate
+        self.directory = directory
+        self.max_params = max_params
+        self._lock = threading.Lock()
+        self._table_locks = {}  # table name -> lock of its index build
+        self._indexes = indexes if indexes is not None else {}
+        self._loaded = set()  # names of the tables whose index was loaded
+
+
+    def get_path(self, table_name):
+        """ returns the path of the saved index of table_name """
+        return os.path.join(self.directory, "%s.pkindex" % table_name)
+
+
+    def get(self, conn, table, pk_col):
+        """
+        returns the existence index of table (built through conn on the
+        first call)
+        """
+        with self._lock:
+            table_lock = self._table_locks.setdefault(table.name,
+                                                      threading.Lock())
+
+        # the indexes of different tables are built at the same time
+        with table_lock:
+            if table.name in self._indexes:
+                return self._indexes[table.name][0]
+
+            signature = get_signature(conn, table, pk_col)
+
+            index = None
+            if self.directory is not None:
+                index = load_index(self.get_path(table.name), signature)
+
+            with self._lock:
+                if index is not None:
+                    self._loaded.add(table.name)
+                else:
+                    self._loaded.discard(table.name)
+
+            if index is None:
+                index = create_index(
+                    self.kind, iter_keys(conn, pk_col), signature["rows"],
+                    isinstance(pk_col.type, sa.Integer), self.error_rate
+                )
+
+            with self._lock:
+                self._indexes[table.name] = (index, signature)
+            return index
+
+
+    def contains_many(self, conn, table, pk_col, keys):
+        """
+        returns the set of the keys of keys that are in table: the index
+        positives are confirmed by the database through conn if the index is
+        not exact or was loaded (the table may have changed since it was
+        saved)
+        """
+        index = self.get(conn, table, pk_col)
+        found = index.contains_many(keys)
+        if found and (not index.exact or table.name in self._loaded):
+            # the keys are returned as they were given
+            confirmed = set(to_bytes(key)
+                            for key in self.confirm(conn, pk_col, list(found)))
+            found = set(key for key in found if to_bytes(key) in confirmed)
+
+        return found
+
+
+    def add(self, table, keys):
+        """ adds the keys just inserted into table to its index (if any) """
+        with self._lock:
+            if table.name not in self._indexes:
+                return
+            keys = list(keys)
+            index, signature = self._indexes[table.name]
+            index.add_many(keys)
+            update_signature(signature, keys)
+
+
+    def confirm(self, conn, pk_col, keys):
+        """ returns the set of keys that are in the pk_col table """
+        max_params = self.max_params or loaders.MAX_PARAMS.get(
+            conn.dialect.name, loaders.DEFAULT_MAX_PARAMS)
+        found = set()
+        for i in range(0, len(keys), max_params):
+            stmt = sa.select([pk_col]).where(
+                pk_col.in_(keys[i:i + max_params]))
+            found.update(row[0] for row in conn.execute(stmt))
+
+        return found
+
+
+    def save(self):
+        """ saves the indexes (if directory is set) """
+        if self.directory is None:
+            return
+
+        with self._lock:
+            for name, (index, signature) in self._indexes.items():
+                index.save(self.get_path(name), signature)
+
+
+def get_signature(conn, table, pk_col):
+    """
+    Returns the signature (dict) of table: its number of "rows", its
+    "min_pk" and "max_pk" values and the sum of its integer primary keys
+    ("pk_sum", None for other keys)
+    """
+    aggregates = [sa.func.count(), sa.func.min(pk_col), sa.func.max(pk_col)]
+    if isinstance(pk_col.type, sa.Integer):
+        aggregates.append(sa.func.sum(pk_col))
+    else:
+        aggregates.append(sa.null())
+
+    rows, min_pk, max_pk, pk_sum = conn.execute(
+        sa.select(aggregates).select_from(table)
+    ).fetchone()
+    if pk_sum is not None:
+        pk_sum = to_integer(pk_sum)
+    elif isinstance(pk_col.type, sa.Integer):
+        pk_sum = 0  # empty table
+
+    return {"rows": rows, "min_pk": min_pk, "max_pk": max_pk,
+            "pk_sum": pk_sum}
+
+
+def update_signature(signature, keys):
+    """ updates signature (see get_signature) with the keys inserted """
+    keys = [key for key in keys if key is not None]
+    if not keys:
+        return
+
+    signature["rows"] += len(keys)
+    lowest, highest = min(keys), max(keys)
+    if signature["min_pk"] is None or lowest < signature["min_pk"]:
+        signature["min_pk"] = lowest
+    if signature["max_pk"] is None or highest > signature["max_pk"]:
+        signature["max_pk"] = highest
+    if signature["pk_sum"] is not None:
+        signature["pk_sum"] += sum(to_integer(key) or 0 for key in keys)
+
+
+def normalize_signature(signature):
+    """ returns signature as it's saved (dialect independent strings) """
+    out = {}
+    for name, value in signature.items():
+        if value is not None and name != "rows":
+            value = to_bytes(value).decode("utf-8", "replace")
+        out[name] = value
+
+    return out
+
+
+def iter_keys(conn, pk_col):
+    """ iterates the pk_col values of its table in pk order (in batches) """
+    stmt = sa.select([pk_col]).order_by(pk_col)
+    result = conn.execution_options(stream_results=True).execute(stmt)
+    while True:
+        rows = result.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row[0]
+
+
+def to_integer(key):
+    """ returns key as an int/long or None if it's not an integer """
+    if isinstance(key, (int, long)) and not isinstance(key, bool):
+        return key
+
+    if isinstance(key, decimal.Decimal) and key == key.to_integral_value():
+        return int(key)
+
+    return None
+
+
+def to_bytes(key):
+    """ returns a stable string representation of key (for hashing) """
+    value = to_integer(key)
+    if value is not None:
+        return str(value)
+
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+
+    return str(key)
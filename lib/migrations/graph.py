@@ -0,0 +1,178 @@
+"""
+Tables dependencies (foreign keys) graph ordering.
+
+The tables are ordered in dependency levels with Kahn's algorithm: every
+table of a level only links to tables of the previous levels, so the tables
+of the same level can be migrated in parallel. The graph cycles are detected
+explicitly (strongly connected components) and can be broken dropping the
+nullable foreign keys that close them: the records are inserted with those
+columns set to NULL and the columns are back-filled once all the tables have
+been migrated.
+"""
+from collections import deque
+
+
+class CycleError(Exception):
+    """ Raised when the tables graph has cycles that can't be broken """
+    def __init__(self, cycles):
+        self.cycles = cycles
+        Exception.__init__(self, "foreign keys cycles between tables: %s" %
+                           "; ".join(", ".join(cycle) for cycle in cycles))
+
+
+def get_levels(nodes, dependencies):
+    """
+    Sorts nodes in dependency levels (Kahn's algorithm, linear time).
+
+    INPUTS:
+
+    nodes ::: sequence of the nodes (i.e. table names) to sort
+
+    dependencies ::: dictionary that maps a node to the set of the nodes it
+                depends on. Dependencies that are not in nodes (and self
+                dependencies) are ignored
+
+    OUTPUT:
+
+    (levels, left) tuple where levels is a list of lists of nodes (every
+    node only depends on nodes of the previous levels, every level sorted
+    as in nodes) and left is the list of the nodes that could not be sorted
+    because they are in (or depend on) a cycle
+    """
+    position = dict((node, i) for i, node in enumerate(nodes))
+    indegree = dict((node, 0) for node in nodes)
+    children = dict((node, []) for node in nodes)
+    for node in nodes:
+        for parent in set(dependencies.get(node, ())):
+            if parent != node and parent in position:
+                indegree[node] += 1
+                children[parent].append(node)
+
+    levels = []
+    level = [node for node in nodes if not indegree[node]]
+    while level:
+        levels.append(level)
+        next_level = []
+        for node in level:
+            for child in children[node]:
+                indegree[child] -= 1
+                if not indegree[child]:
+                    next_level.append(child)
+
+        level = sorted(next_level, key=position.get)
+
+    left = [node for node in nodes if indegree[node]]
+    return levels, left
+
+
+def find_cycles(nodes, dependencies):
+    """
+    Returns the cycles of the graph as a list of the strongly connected
+    components (lists of nodes) with more than one node (Tarjan's algorithm,
+    iterative so big graphs don't hit the recursion limit)
+    """
+    nodes_set = set(nodes)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    counter = 0
+
+    for root in nodes:
+        if root in index:
+            continue
+
+        work = [(root, iter(sorted(dependencies.get(root, ()))))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, parents = work[-1]
+            for parent in parents:
+                if parent not in nodes_set or parent == node:
+                    continue
+                if parent not in index:
+                    index[parent] = lowlink[parent] = counter
+                    counter += 1
+                    stack.append(parent)
+                    on_stack.add(parent)
+                    work.append((parent,
+                                 iter(sorted(dependencies.get(parent, ())))))
+                    break
+                elif parent in on_stack:
+                    lowlink[node] = min(lowlink[node], index[parent])
+            else:
+                work.pop()
+                if work:
+                    caller = work[-1][0]
+                    lowlink[caller] = min(lowlink[caller], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+
+                    if len(component) > 1:
+                        cycles.append(sorted(component))
+
+    return cycles
+
+
+def break_cycles(nodes, dependencies, breakable):
+    """
+    Removes from the graph the breakable dependencies that close its cycles.
+
+    INPUTS:
+
+    nodes, dependencies ::: graph (see get_levels)
+
+    breakable ::: dictionary that maps a node to the set of its dependencies
+                that can be dropped (i.e. nullable foreign keys)
+
+    OUTPUT:
+
+    (dependencies, dropped) tuple with the new dependencies dictionary and
+    the list of the dropped (node, parent) dependencies. Raises CycleError
+    if some cycles can't be broken
+    """
+    dependencies = dict((node, set(parents))
+                        for node, parents in dependencies.items())
+    dropped = []
+
+    cycles = find_cycles(nodes, dependencies)
+    while cycles:
+        for cycle in cycles:
+            members = set(cycle)
+            # first try to drop the links to the members with more links
+            # inside the cycle (they'll be migrated last) and then any link
+            weights = dict(
+                (node, len(dependencies.get(node, set()) & members))
+                for node in cycle
+            )
+            order = sorted(cycle, key=lambda node: (weights[node], node))
+            position = dict((node, i) for i, node in enumerate(order))
+            removed = []
+            for strict in (True, False):
+                for node in cycle:
+                    for parent in sorted(dependencies.get(node, ()) & members):
+                        if parent in breakable.get(node, ()) and (
+                                not strict or position[parent] > position[node]):
+                            dependencies[node].discard(parent)
+                            removed.append((node, parent))
+                if removed:
+                    break
+
+            if not removed:
+                raise CycleError([cycle])
+
+            dropped.extend(removed)
+
+        cycles = find_cycles(nodes, dependencies)
+
+    return dependencies, dropped
@@ -0,0 +1,412 @@
+"""
+Bulk loaders used by the dbms destination to insert the records of a paquet.
+
+The loader is chosen by the destination dialect (see get_loader): COPY FROM
+STDIN on PostgreSQL (psycopg2), raw executemany on SQLite, multi rows
+INSERT ... VALUES statements (sized to the dialect bound parameters limit)
+on the dialects that support them and the generic sqlalchemy executemany
+everywhere else. The tables with re-mapped primary keys get their new
+primary keys from the RETURNING loader where supported (taken from the
+primary key sequence and inserted with the records) so they don't need to
+be read back.
+"""
+import cStringIO
+import datetime
+
+import sqlalchemy as sa
+
+
+# maximum number of bound parameters of a single statement
+MAX_PARAMS = {
+    "sqlite": 999,
+    "mssql": 2100,
+    "postgresql": 32767,
+    "mysql": 65535,
+}
+DEFAULT_MAX_PARAMS = 1000
+
+
+class GenericLoader(object):
+    """
+    Inserts the records with the sqlalchemy insert statement (executemany).
+    It works with every dialect and it's the fallback of the other loaders.
+    """
+    name = "GENERIC"
+    # True if load returns the new primary keys of the records
+    returns_ids = False
+
+    def __init__(self, conn, table):
+        """
+        conn ::: sqlalchemy Connection to the destination database
+
+        table ::: sqlalchemy table reflected from the destination database
+        """
+        self.conn = conn
+        self.table = table
+        self.insert = table.insert()
+
+
+    @classmethod
+    def supports(cls, conn, table):
+        """ returns True if the loader can be used with conn and table """
+        return True
+
+
+    def load(self, records):
+        """
+        Inserts records (list of dicts, all with the same keys) into the
+        table. Returns the sqlalchemy result (if any)
+        """
+        if not records:
+            return None
+
+        return self.conn.execute(self.insert, records)
+
+
+    def load_paquet(self, paquet):
+        """
+        Inserts the records of a columnar.Paquet (see load). The rows are
+        built only here, as the loader needs them
+        """
+        return self.load(paquet.to_dicts())
+
+
+class MultiValuesLoader(GenericLoader):
+    """
+    Inserts the records with multi rows INSERT ... VALUES statements, as many
+    rows per statement as the dialect bound parameters limit allows.
+    """
+    name = "MULTI_VALUES"
+
+    def __init__(self, conn, table):
+        GenericLoader.__init__(self, conn, table)
+        self.max_params = MAX_PARAMS.get(conn.dialect.name,
+                                         DEFAULT_MAX_PARAMS)
+
+
+    @classmethod
+    def supports(cls, conn, table):
+        return getattr(conn.dialect, "supports_multivalues_insert", False)
+
+
+    def load(self, records):
+        if not records:
+            return None
+
+        rows = max(1, self.max_params // max(1, len(records[0])))
+        for i in range(0, len(records), rows):
+            self.conn.execute(self.insert.values(records[i:i + rows]))
+
+
+class ReturningLoader(MultiValuesLoader):
+    """
+    Inserts the records and returns their new primary keys (in the records
+    order). The rows returned by a multi rows INSERT ... RETURNING are not
+    in a guaranteed order, so the keys are taken from the primary key
+    sequence first and inserted with the records (multi rows INSERT ...
+    VALUES). Without sequence every record is inserted by its own
+    INSERT ... RETURNING pk statement
+    """
+    name = "RETURNING"
+    returns_ids = True
+
+    def __init__(self, conn, table):
+        MultiValuesLoader.__init__(self, conn, table)
+        self.pk_col = list(table.primary_key.columns)[0]
+        self.sequence = get_pk_sequence(conn, table, self.pk_col)
+
+
+    @classmethod
+    def supports(cls, conn, table):
+        # implicit_returning is set by the dialects that support RETURNING
+        # (and the server version does) unless the engine disabled it
+        return bool(MultiValuesLoader.supports(conn, table) and
+                    getattr(conn.dialect, "implicit_returning", False) and
+                    len(table.primary_key.columns) == 1)
+
+
+    def load(self, records):
+        """
+        Inserts records and returns the list of their new primary keys
+        """
+        if not records:
+            return []
+
+        if self.sequence is None:
+            stmt = self.insert.returning(self.pk_col)
+            return [self.conn.execute(stmt, record).scalar()
+                    for record in records]
+
+        ids = [row[0] for row in self.conn.execute(
+            sa.text("SELECT nextval(:sequence) FROM generate_series(1, :n)"),
+            sequence=self.sequence, n=len(records)
+        )]
+        pk_name = self.pk_col.name
+        keyed = []
+        for record, new_id in zip(records, ids):
+            record = dict(record)
+            record[pk_name] = new_id
+            keyed.append(record)
+        MultiValuesLoader.load(self, keyed)
+        return ids
+
+
+class RawLoader(GenericLoader):
+    """
+    Base class of the loaders that bypass sqlalchemy and use the DBAPI
+    connection directly. The records values are converted by the columns
+    types bind processors and the DBAPI errors are raised as sqlalchemy
+    exceptions (like the generic loader does)
+    """
+    def __init__(self, conn, table):
+        GenericLoader.__init__(self, conn, table)
+        dialect = conn.dialect
+        self.processors = {}
+        for col in table.columns:
+            processor = col.type.dialect_impl(dialect).bind_processor(dialect)
+            if processor is not None:
+                self.processors[col.name] = processor
+
+
+    def get_rows(self, keys, records):
+        """ returns records as lists of (processed) values ordered by keys """
+        processors = [self.processors.get(key) for key in keys]
+        rows = []
+        for record in records:
+            rows.append([
+                value if processor is None or value is None
+                else processor(value)
+                for processor, value in zip(processors,
+                                            [record[key] for key in keys])
+            ])
+
+        return rows
+
+
+    def process_column(self, key, values):
+        """ returns the values of the key column (processed) """
+        processor = self.processors.get(key)
+        if processor is None:
+            return values
+
+        return [value if value is None else processor(value)
+                for value in values]
+
+
+    def load(self, records):
+        if not records:
+            return None
+
+        keys = list(records[0].keys())
+        self.load_rows(keys, self.get_rows(keys, records))
+
+
+    def load_paquet(self, paquet):
+        if not len(paquet):
+            return None
+
+        # the values are processed a column at a time
+        keys = paquet.keys
+        columns = [self.process_column(key, paquet[key]) for key in keys]
+        self.load_rows(keys, zip(*columns) if keys else [()] * len(paquet))
+
+
+    def load_rows(self, keys, rows):
+        """ inserts rows (sequences of the keys values) """
+        statement = self.get_statement(keys)
+        raw_conn = self.conn.connection
+        cursor = raw_conn.cursor()
+        try:
+            self.execute(cursor, statement, rows)
+        except self.conn.dialect.dbapi.Error, e:
+            raise sa.exc.DBAPIError.instance(statement, None, e,
+                                             self.conn.dialect.dbapi.Error)
+        finally:
+            cursor.close()
+
+        # out of an explicit transaction the connection is in autocommit mode
+        if not self.conn.in_transaction():
+            raw_conn.commit()
+
+
+    def get_statement(self, keys):
+        raise NotImplementedError
+
+
+    def execute(self, cursor, statement, rows):
+        raise NotImplementedError
+
+
+class SQLiteLoader(RawLoader):
+    """ Inserts the records with sqlite3 executemany """
+    name = "SQLITE"
+
+    @classmethod
+    def supports(cls, conn, table):
+        return conn.dialect.name == "sqlite"
+
+
+    def get_statement(self, keys):
+        preparer = self.conn.dialect.identifier_preparer
+        return "INSERT INTO %s (%s) VALUES (%s)" % (
+            preparer.format_table(self.table),
+            ", ".join(preparer.quote_identifier(key) for key in keys),
+            ", ".join("?" for key in keys)
+        )
+
+
+    def execute(self, cursor, statement, rows):
+        cursor.executemany(statement, rows)
+
+
+class CopyLoader(RawLoader):
+    """
+    Loads the records with PostgreSQL COPY FROM STDIN (psycopg2) streaming
+    them as an in memory CSV buffer. Tables with binary columns are not
+    supported
+    """
+    name = "COPY"
+
+    @classmethod
+    def supports(cls, conn, table):
+        if conn.dialect.name != "postgresql" or \
+                conn.dialect.driver != "psycopg2":
+            return False
+
+        return not any(isinstance(col.type, sa.types._Binary)
+                       for col in table.columns)
+
+
+    def get_statement(self, keys):
+        preparer = self.conn.dialect.identifier_preparer
+        return "COPY %s (%s) FROM STDIN WITH CSV" % (
+            preparer.format_table(self.table),
+            ", ".join(preparer.quote_identifier(key) for key in keys)
+        )
+
+
+    def execute(self, cursor, statement, rows):
+        buf = cStringIO.StringIO()
+        for row in rows:
+            buf.write(",".join(format_csv_value(value) for value in row))
+            buf.write("\n")
+
+        buf.seek(0)
+        cursor.copy_expert(statement, buf)
+
+
+LOADERS = [ReturningLoader, CopyLoader, SQLiteLoader, MultiValuesLoader,
+           GenericLoader]
+
+
+def get_loader(conn, table, name="AUTO", returning=False):
+    """
+    Returns the bulk loader that inserts records into table through conn.
+
+    name ::: name of the loader to use (RETURNING, COPY, SQLITE,
+                MULTI_VALUES or GENERIC). If AUTO the fastest loader
+                supported by the conn dialect is used
+
+    returning ::: if True (and name is AUTO) a loader that returns the new
+                primary keys is preferred (if the dialect supports one)
+    """
+    name = (name or "AUTO").upper()
+    for loader in LOADERS:
+        if name == "AUTO" and loader.returns_ids and not returning:
+            continue
+
+        if name in ("AUTO", loader.name):
+            if loader.supports(conn, table):
+                return loader(conn, table)
+            elif name != "AUTO":
+                raise ValueError("%s loader is not supported by %s" % (
+                    name, conn.dialect.name))
+
+    raise ValueError("unknown bulk loader: %s" % name)
+
+
+def get_pk_sequence(conn, table, pk_col):
+    """
+    returns the name of the sequence that generates the pk_col values of
+    table (SERIAL and IDENTITY columns of PostgreSQL) or None
+    """
+    if conn.dialect.name != "postgresql":
+        return None
+
+    return conn.execute(
+        sa.text("SELECT pg_get_serial_sequence(:table, :column)"),
+        table=conn.dialect.identifier_preparer.format_table(table),
+        column=pk_col.name
+    ).scalar()
+
+
+def get_upsert_statement(conn, table, keys):
+    """
+    Returns the statement that inserts a record with the keys columns values
+    into table or updates the record with the same primary key (the values
+    are bound as :p0, :p1... in the keys order) or None if the conn dialect
+    has no upsert statement
+    """
+    dialect = conn.dialect
+    preparer = dialect.identifier_preparer
+    pk_names = set(col.name for col in table.primary_key.columns)
+    if not pk_names:
+        return None
+
+    quoted = dict((key, preparer.quote_identifier(key)) for key in keys)
+    values = dict((key, ":p%s" % i) for i, key in enumerate(keys))
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % (
+        preparer.format_table(table),
+        ", ".join(quoted[key] for key in keys),
+        ", ".join(values[key] for key in keys)
+    )
+    updated = [key for key in keys if key not in pk_names]
+
+    if dialect.name in ("sqlite", "postgresql"):
+        # PostgreSQL 9.5+, SQLite 3.24+ (INSERT OR REPLACE would delete the
+        # record, running the ON DELETE actions of the tables linked to it)
+        if dialect.name == "sqlite" and getattr(
+                dialect.dbapi, "sqlite_version_info", (0,)) < (3, 24):
+            return None
+        sql = "%s ON CONFLICT (%s) DO " % (insert, ", ".join(
+            preparer.quote_identifier(col.name)
+            for col in table.primary_key.columns))
+        if updated:
+            sql += "UPDATE SET " + ", ".join(
+                "%s = EXCLUDED.%s" % (quoted[key], quoted[key])
+                for key in updated)
+        else:
+            sql += "NOTHING"
+    elif dialect.name == "mysql":
+        updated = updated or [key for key in keys if key in pk_names]
+        sql = "%s ON DUPLICATE KEY UPDATE %s" % (insert, ", ".join(
+            "%s = VALUES(%s)" % (quoted[key], quoted[key])
+            for key in updated))
+    else:
+        return None
+
+    # the values are converted by the columns types
+    return sa.text(sql, bindparams=[
+        sa.bindparam("p%s" % i, type_=table.c[key].type)
+        for i, key in enumerate(keys)
+    ])
+
+
+def format_csv_value(value):
+    """ returns value formatted as a PostgreSQL COPY CSV field """
+    if value is None:
+        return ""  # unquoted empty field is NULL
+
+    if isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif isinstance(value, float):
+        # str keeps only 12 significant digits
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+
+    return '"%s"' % value.replace('"', '""')
@@ -0,0 +1,142 @@
+"""
+Tables fingerprints manifest used to skip the tables that did not change
+since the last migration.
+
+The fingerprint of a table is its number of records, its max primary key
+value, the max value of its "updated at" column (if any) and, optionally,
+the checksum of all its records (see migrations.checksums). The manifest
+file keeps the source and destination fingerprints of every table taken at
+the end of the last migration: a table whose current fingerprints are the
+same on both sides did not change and does not have to be migrated again.
+"""
+import datetime
+import json
+import os
+import threading
+
+import sqlalchemy as sa
+
+from migrations import checksums
+
+
+VERSION = 1
+
+
+def get_fingerprint(conn, table, updated_column=None, checksum=False):
+    """
+    Returns the fingerprint (dict) of table read through conn (sqlalchemy
+    Connection).
+
+    updated_column ::: name of the table column with the last update time
+                (or any value that grows when a record changes) of every
+                record. Ignored if None or if table has no such column
+
+    checksum ::: if True the fingerprint includes the checksum of all the
+                table records (see checksums.get_checksum)
+    """
+    aggregates = [sa.func.count()]
+    pk_cols = list(table.primary_key.columns)
+    if len(pk_cols) == 1:
+        aggregates.append(sa.func.max(pk_cols[0]))
+    else:
+        aggregates.append(sa.null())
+    if updated_column is not None and updated_column in table.c:
+        aggregates.append(sa.func.max(table.c[updated_column]))
+    else:
+        aggregates.append(sa.null())
+
+    rows, max_pk, max_updated = conn.execute(
+        sa.select(aggregates).select_from(table)
+    ).fetchone()
+    fingerprint = {
+        "rows": rows,
+        "max_pk": to_text(max_pk),
+        "max_updated": to_text(max_updated),
+        "checksum": None,
+    }
+    if checksum:
+        fingerprint["checksum"] = str(checksums.get_checksum(
+            conn, table, None).digest)
+
+    return fingerprint
+
+
+class ManifestStore(object):
+    """
+    Manifest JSON file: table name -> source and destination fingerprints.
+    It's safe to use the same store from different threads
+    """
+    def __init__(self, path):
+        """
+        path ::: path of the manifest file (created by save if it does not
+                exist yet)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._tables = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            if data.get("version") == VERSION:
+                self._tables = data.get("tables", {})
+
+
+    def get(self, table_name):
+        """
+        returns the (source, destination) fingerprints of table_name saved
+        by the last migration or None
+        """
+        with self._lock:
+            entry = self._tables.get(table_name)
+
+        if entry is None:
+            return None
+        return entry["source"], entry["destination"]
+
+
+    def is_unchanged(self, table_name, source, destination):
+        """
+        returns True if the source and destination fingerprints of
+        table_name are the saved ones
+        """
+        saved = self.get(table_name)
+        if saved is None:
+            return False
+
+        # the fingerprints are compared as they are saved
+        return saved == (normalize(source), normalize(destination))
+
+
+    def set(self, table_name, source, destination):
+        """ sets the source and destination fingerprints of table_name """
+        with self._lock:
+            self._tables[table_name] = {
+                "source": normalize(source),
+                "destination": normalize(destination),
+                "saved": datetime.datetime.now().isoformat(),
+            }
+
+
+    def save(self):
+        """ writes the manifest to its file """
+        with self._lock:
+            data = json.dumps({"version": VERSION, "tables": self._tables},
+                              indent=1, sort_keys=True)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(data)
+        os.rename(tmp_path, self.path)
+
+
+def normalize(fingerprint):
+    """ returns fingerprint as it's read from the manifest file """
+    return json.loads(json.dumps(fingerprint))
+
+
+def to_text(value):
+    """ returns value as a (dialect independent) unicode string or None """
+    if value is None:
+        return None
+
+    return checksums.normalize(value).decode("utf-8", "replace")
@@ -13,11 +13,15 @@ interface.
 
 import getopt
 import sys
+import time
 import backends
 import importlib
 
 from functools import partial
 
+from migrations import checkpoints
+from migrations import executors
+
 
 def get_migrator(path, **options):
     backend, path = path.split(":::")
@@ -56,7 +60,8 @@ class Migration(object):
             options ::: a set of options that defines and modifies the behaviour
                         of the data migration. Available options:
                         
-                        - transfer_mode  "DIFF"|"FULL"
+                        - transfer_mode  "DIFF"|"FULL"|"DELTA"|"INCREMENTAL"|
+                                         "CAPTURE"
                                 
                                 DIFF -> check the destination and only transfer 
                                         records that are not already present
@@ -64,7 +69,34 @@ class Migration(object):
                                 FULL -> no check is performed and all the source
                                         data records are dumped to the 
                                         destination
+
+                                DELTA -> (dbms to dbms) compare the primary
+                                        keys ranges checksums of both sides
+                                        and only insert, update or delete
+                                        the records of the ranges that differ
+
+                                INCREMENTAL -> (dbms to dbms) only transfer
+                                        (upsert) the records changed since
+                                        the last migration (see the
+                                        "watermark_column" and "watermarks"
+                                        dbms options and Migration.follow)
+
+                                CAPTURE -> (SQLite or PostgreSQL dbms source
+                                        to dbms) triggers log the source
+                                        changes and only the records
+                                        inserted, updated or deleted since
+                                        the last migration are transferred
+                                        (see migrations.capture)
                                         
+                        - checkpoint  path of a file where the migration
+                                progress is saved so it can be resumed (see
+                                Migration.resume)
+
+                        - manifest  (dbms source) path of a file where the
+                                tables fingerprints are saved after every
+                                migration so the next ones skip the tables
+                                that did not change
+
                         
             
         """
@@ -76,7 +108,7 @@ class Migration(object):
         self._last_migration_args = []
 
 
-    def migrate(self, tables=None, paquet=10000, exclude = None):
+    def migrate(self, tables=None, paquet=10000, exclude = None, workers = None):
         """
         Migrates tables data between the source and the destination.
         
@@ -104,22 +136,115 @@ class Migration(object):
                     not be transferred.
                     
                     IF exclude == None no table will be excluded
+
+        workers ::: integer that specifies how many tables can be transferred
+                    at the same time. Every table is started on its own
+                    source and destination connections as soon as all the
+                    tables it links to (through its foreign keys) have been
+                    transferred.
+
+                    IF workers == None the "workers" option will be used
+                    (1 by default, tables are transferred one by one)
         """
-        # set the Migration statistics to the source stats which is already
-        # shared with the destination (if the source and the destination 
-        # objects implement the migration.backends.BaseMigrator interface)
-        self.stats = self.source.stats
-        
         # save last migration arguments if needed later
         self._last_migration_args = {"tables": tables, 
                                      "exclude": exclude,
                                      "paquet": paquet}
         
         # start the migration from source to destination
-        self.source.migrate(self.destination,
-                            tables = tables,
-                            paquet = paquet,
-                            exclude = exclude)
+        try:
+            self.source.migrate(self.destination,
+                                tables = tables,
+                                paquet = paquet,
+                                exclude = exclude,
+                                workers = workers)
+        finally:
+            # set the Migration statistics to the source stats which is
+            # already shared with the destination (if the source and the
+            # destination objects implement the
+            # migration.backends.BaseMigrator interface)
+            self.stats = self.source.stats
+
+
+    def resume(self, workers = None):
+        """
+        Resumes the last migration that did not finish (i.e. the process
+        died) using the checkpoints saved in the file set by the "checkpoint"
+        option. Tables already migrated are skipped and the tables partially
+        migrated continue after the last paquet written so their records are
+        not inserted again. Only the paquet that was being written when the
+        migration stopped may need attention as source and destination
+        writes cannot be committed together.
+
+        The migration arguments (tables, paquet, exclude) are read from the
+        checkpoints file so resume can be called from a new process.
+
+        workers ::: see migrate
+        """
+        path = self.options.get("checkpoint")
+        if not path:
+            raise ValueError("resuming a migration requires the checkpoint "
+                             "option")
+
+        store = checkpoints.CheckpointStore(path)
+        try:
+            args = store.get_migration_args()
+        finally:
+            store.close()
+
+        if args is None:
+            raise ValueError("no migration to resume in %s" % path)
+
+        self._last_migration_args = args
+
+        try:
+            self.source.migrate(self.destination,
+                                workers = workers,
+                                resume = True,
+                                **args)
+        finally:
+            self.stats = self.source.stats
+
+
+    def follow(self, interval=60, tables=None, paquet=10000, exclude=None,
+               workers=None, runs=None, stop_event=None):
+        """
+        Keeps the destination in sync with the source running a new
+        migration every interval seconds (INCREMENTAL, CAPTURE or DELTA
+        transfer modes only, so every run only transfers the records changed
+        since the last one). The migrations errors are raised.
+
+        tables, paquet, exclude, workers ::: see migrate
+
+        runs ::: number of migrations run before returning. IF runs == None
+                    the migrations go on until stop_event is set
+
+        stop_event ::: threading.Event that stops following the source once
+                    it's set (the running migration is completed first)
+
+        Returns the number of migrations run
+        """
+        if self.options.get("transfer_mode") not in ("INCREMENTAL", "CAPTURE",
+                                                     "DELTA"):
+            raise ValueError("following the source requires the INCREMENTAL, "
+                             "CAPTURE or DELTA transfer_mode")
+
+        count = 0
+        while stop_event is None or not stop_event.is_set():
+            self.migrate(tables = tables,
+                         paquet = paquet,
+                         exclude = exclude,
+                         workers = workers)
+            count += 1
+            if runs is not None and count >= runs:
+                break
+
+            if stop_event is not None:
+                stop_event.wait(interval)
+            else:
+                time.sleep(interval)
+
+        return count
 
 
     def report_last_migration(self, filepath, templatepath=None):
@@ -134,12 +259,110 @@ class Migration(object):
     def check_last_migration(self):
         """
         Compares the source and destination migration to check if all the data
-        have been migrated correctly
+        have been migrated correctly. The dbms source returns a summary of the
+        records compared per table (see migrations.comparison)
         """
         return self.source.compare(self.destination, **self._last_migration_args)
 
 
 
+class AsyncMigration(Migration):
+    """
+    Migration whose operations (migrate, resume, check_last_migration) are
+    run on an executor and immediately return a migrations.executors.Task
+    instead of blocking until they finish.
+
+    Many AsyncMigration objects can share the same executor so a single
+    process can migrate many (i.e. small tenant) databases at once using
+    only executor.workers threads:
+
+    >>> executor = Executor(workers=8)
+    >>> tasks = [AsyncMigration(src, dst, executor=executor).migrate()
+    ...          for src, dst in databases]
+    >>> wait_all(tasks)
+
+    The executor created by the AsyncMigration itself (if any) is shut down
+    by close (or at the end of a with block):
+
+    >>> with AsyncMigration(src, dst) as migration:
+    ...     migration.migrate().result()
+    """
+    def __init__(self, source, destination, log_cb = None, executor = None,
+                 **options):
+        """
+        see Migration.__init__
+
+        executor ::: migrations.executors.Executor used to run the migration
+                    operations. IF executor == None a new executor with a
+                    single worker is created (and shut down by close)
+        """
+        Migration.__init__(self, source, destination, log_cb, **options)
+        self._own_executor = executor is None
+        if executor is None:
+            executor = executors.Executor(workers = 1)
+        self.executor = executor
+
+
+    def close(self, wait = True):
+        """
+        Shuts down the executor once the submitted operations are finished
+        if it was created by the AsyncMigration (shared executors are left
+        running). If wait is True it blocks until then
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait = wait)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def migrate(self, tables=None, paquet=10000, exclude = None, workers = None):
+        """ see Migration.migrate. Returns the migration Task """
+        return self.executor.submit(Migration.migrate,
+                                    self,
+                                    tables = tables,
+                                    paquet = paquet,
+                                    exclude = exclude,
+                                    workers = workers)
+
+
+    def resume(self, workers = None):
+        """ see Migration.resume. Returns the migration Task """
+        return self.executor.submit(Migration.resume, self, workers = workers)
+
+
+    def check_last_migration(self):
+        """ see Migration.check_last_migration. Returns the comparison Task """
+        return self.executor.submit(Migration.check_last_migration, self)
+
+
+def migrate_all(migrations, workers=4, **kwargs):
+    """
+    Runs the migrate method of every Migration of migrations using at most
+    workers threads and waits for all of them to finish.
+
+    kwargs ::: arguments of the migrate calls (see Migration.migrate)
+
+    Returns the list of the migrations Tasks (see migrations.executors.Task)
+    so the caller can check which migrations failed
+    """
+    executor = executors.Executor(workers = workers)
+    try:
+        tasks = [executor.submit(Migration.migrate, migration, **kwargs)
+                 for migration in migrations]
+        for task in tasks:
+            task.wait()
+    finally:
+        executor.shutdown()
+
+    return tasks
+
+
 def print_usage():
     args = {"arg":sys.argv[0]}
     print """
@@ -0,0 +1,199 @@
+"""
+Pipelined transfer: the source keeps reading paquets while writer threads
+dump the paquets already read into the destination.
+"""
+import sys
+import threading
+
+
+class Pipeline(object):
+    """
+    Bounded queue of paquets drained by one or more writer threads that
+    deliver them to destination.dump.
+
+    Paquets of the same table are dumped one at a time, in the order they
+    were queued and always by the same writer thread (so the destination
+    sessions and transactions of a table are never shared among threads),
+    and a table paquets are not dumped while paquets of the
+    tables it links to (by foreign keys) are still waiting, so the primary
+    keys mappings are always complete when the linked records are dumped.
+    """
+    def __init__(self, destination, writers=1, max_paquets=4,
+                 max_bytes=64 * 1024 * 1024):
+        """
+        destination ::: Migrator object that receives the paquets
+
+        writers ::: number of writer threads
+
+        max_paquets ::: maximum number of paquets waiting in the queue
+
+        max_bytes ::: maximum (estimated) size of the paquets waiting in the
+                    queue. A paquet bigger than max_bytes is accepted when
+                    the queue is empty
+        """
+        self.destination = destination
+        self.max_paquets = max(1, max_paquets)
+        self.max_bytes = max_bytes
+
+        self._condition = threading.Condition()
+        self._queue = []  # list of (records, table, callback, size)
+        self._queued_bytes = 0
+        self._pending = {}  # table name -> paquets queued or being dumped
+        self._busy = set()  # tables with a paquet being dumped
+        self._owners = {}  # table name -> writer thread that dumps it
+        # table name -> names of the tables that must be dumped before it.
+        # If None the tables foreign keys are used
+        self.dependencies = None
+        self._closed = False
+        self._errors = []
+
+        self._writers = [threading.Thread(target=self._writer)
+                         for i in range(max(1, writers))]
+        for thread in self._writers:
+            thread.daemon = True
+            thread.start()
+
+
+    def put(self, records, table, callback=None):
+        """
+        Queues records to be dumped into table (blocks while the queue is
+        full). If records is None nothing is dumped. callback (if any) is
+        called (by the writer thread) once the records and all the paquets
+        of table queued before them have been dumped
+        """
+        size = get_records_size(records) if records else 0
+        with self._condition:
+            while not self._errors and self._queue and (
+                    len(self._queue) >= self.max_paquets or
+                    self._queued_bytes + size > self.max_bytes):
+                self._condition.wait()
+
+            self._raise_errors()
+
+            self._queue.append((records, table, callback, size))
+            self._queued_bytes += size
+            self._pending[table.name] = self._pending.get(table.name, 0) + 1
+            self._condition.notify_all()
+
+
+    def close(self):
+        """
+        Waits until all the queued paquets have been dumped and stops the
+        writers. Raises the first exception raised by a writer (if any)
+        """
+        with self._condition:
+            while self._queue or self._busy:
+                if self._errors:
+                    break
+                self._condition.wait()
+
+            self._closed = True
+            self._condition.notify_all()
+
+        for thread in self._writers:
+            thread.join()
+
+        with self._condition:
+            self._raise_errors()
+
+
+    def abort(self):
+        """ drops the queued paquets and stops the writers """
+        with self._condition:
+            self._closed = True
+            self._queue = []
+            self._condition.notify_all()
+
+        for thread in self._writers:
+            thread.join()
+
+
+    def _raise_errors(self):
+        if self._errors:
+            exc_type, exc_value, exc_tb = self._errors[0]
+            raise exc_type, exc_value, exc_tb
+
+
+    def _is_ready(self, table):
+        if table.name in self._busy:
+            return False
+
+        owner = self._owners.get(table.name)
+        if owner is not None and owner != threading.current_thread().ident:
+            return False
+
+        if self.dependencies is not None:
+            parents = self.dependencies.get(table.name, ())
+        else:
+            parents = [fk.column.table.name
+                       for fk in getattr(table, "foreign_keys", ())]
+
+        for parent in parents:
+            if parent != table.name and self._pending.get(parent):
+                return False
+
+        return True
+
+
+    def _next(self):
+        """ returns the next queued paquet that can be dumped (or None) """
+        with self._condition:
+            while True:
+                if self._closed or self._errors:
+                    return None
+
+                seen = set()
+                for i, item in enumerate(self._queue):
+                    table = item[1]
+                    # paquets of the same table must be dumped in order
+                    if table.name not in seen and self._is_ready(table):
+                        self._queue.pop(i)
+                        self._queued_bytes -= item[3]
+                        self._busy.add(table.name)
+                        self._owners.setdefault(
+                            table.name, threading.current_thread().ident
+                        )
+                        self._condition.notify_all()
+                        return item
+                    seen.add(table.name)
+
+                self._condition.wait()
+
+
+    def _writer(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+
+            records, table, callback, size = item
+            try:
+                if records is not None:
+                    self.destination.dump(records, table)
+                if callback is not None:
+                    callback()
+            except Exception:
+                with self._condition:
+                    self._errors.append(sys.exc_info())
+            finally:
+                with self._condition:
+                    self._busy.discard(table.name)
+                    self._pending[table.name] -= 1
+                    self._condition.notify_all()
+
+
+def get_records_size(records):
+    """
+    Returns a (rough) estimation of the memory size in bytes of the records
+    values (strings count their length, any other value 8 bytes)
+    """
+    size = 0
+    for record in records:
+        values = record.values() if isinstance(record, dict) else record
+        for value in values:
+            if isinstance(value, basestring):
+                size += len(value)
+            else:
+                size += 8
+
+    return size
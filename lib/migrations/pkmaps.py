@@ -0,0 +1,483 @@
+"""
+Primary keys mapping stores (old pk -> new pk) of the tables whose
+autoincrement primary keys are re-mapped by the dbms destination.
+
+A plain dict costs more than 100 bytes per record, too much for tables with
+hundreds of millions of records. Dense integer primary keys are kept in a
+compact array (8 bytes per key) and the maps that are not dense or that grow
+bigger than a memory limit spill to a SQLite file, so a single table map can
+be bigger than the memory available.
+"""
+import array
+import decimal
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+# pairs written at once
+BATCH_SIZE = 10000
+INTEGERS = (int, long)
+# maximum number of bound parameters of a SQLite statement
+SQLITE_MAX_PARAMS = 999
+
+
+class NotDense(Exception):
+    """ Raised when the keys don't fit in an ArrayPKMap """
+
+
+class PKMap(object):
+    """
+    Base class of the primary keys maps. They work like a dict of old pk ->
+    new pk but the keys should be read and written in batches with get_many
+    and set_many.
+    """
+    def get_many(self, keys):
+        """ returns a dict with the new pk of every key of keys in the map """
+        raise NotImplementedError
+
+
+    def set_many(self, pairs):
+        """ adds the (old_pk, new_pk) pairs to the map """
+        raise NotImplementedError
+
+
+    def items(self):
+        """ returns an iterator of the (old_pk, new_pk) pairs of the map """
+        raise NotImplementedError
+
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+    def close(self):
+        """ releases the resources of the map """
+        pass
+
+
+    def reserve(self, lower, upper, count):
+        """
+        Tells the map that about count keys between lower and upper (both
+        included) will be written, in any order
+        """
+        pass
+
+
+    def update(self, pairs):
+        """ adds the pairs (a dict or a (old_pk, new_pk) iterable) """
+        if hasattr(pairs, "items"):
+            pairs = pairs.items()
+
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= BATCH_SIZE:
+                self.set_many(batch)
+                batch = []
+
+        if batch:
+            self.set_many(batch)
+
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+
+    def __getitem__(self, key):
+        found = self.get_many([key])
+        if key not in found:
+            raise KeyError(key)
+
+        return found[key]
+
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+
+    def __contains__(self, key):
+        return key in self.get_many([key])
+
+
+    def __eq__(self, other):
+        if not hasattr(other, "items"):
+            return False
+
+        return dict(self.items()) == dict(other.items())
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __repr__(self):
+        return "<%s: %s keys>" % (self.__class__.__name__, len(self))
+
+
+class DictPKMap(PKMap):
+    """ Keeps the map in a dict """
+    def __init__(self):
+        self._map = {}
+
+
+    def get_many(self, keys):
+        _map = self._map
+        return dict((key, _map[key]) for key in keys if key in _map)
+
+
+    def set_many(self, pairs):
+        self._map.update(pairs)
+
+
+    def items(self):
+        return self._map.iteritems()
+
+
+    def __len__(self):
+        return len(self._map)
+
+
+    def __repr__(self):
+        return repr(self._map)
+
+
+class ArrayPKMap(PKMap):
+    """
+    Keeps the map of dense non negative integer keys in an array indexed by
+    the key minus the lowest key written (0 means missing so the new pks
+    must be positive integers). The keys can be written in any order (i.e.
+    by the primary key ranges of a partitioned table): the array grows on
+    both sides, reserve preallocates it for a known keys range. set_many
+    raises NotDense (and adds nothing) when the keys are not integers or
+    are too sparse
+    """
+    def __init__(self, density=0.25, min_size=1024 * 1024):
+        """
+        density ::: minimum keys / array size ratio
+
+        min_size ::: array size allowed whatever the density
+        """
+        self.density = density
+        self.min_size = min_size
+        self._values = array.array("l")
+        self._count = 0
+        self._offset = None
+        # number of keys expected in the reserved range (see reserve)
+        self._expected = 0
+
+
+    def get_many(self, keys):
+        values = self._values
+        size = len(values)
+        offset = self._offset or 0
+        out = {}
+        for key in keys:
+            index = key if type(key) in INTEGERS else to_index(key)
+            if index is None:
+                continue
+
+            index -= offset
+            if 0 <= index < size:
+                value = values[index]
+                if value:
+                    out[key] = value
+
+        return out
+
+
+    def set_many(self, pairs):
+        indexes = []
+        news = []
+        for key, value in pairs:
+            index = key if type(key) in INTEGERS else to_index(key)
+            if type(value) not in INTEGERS:
+                value = to_index(value)
+            if index is None or index < 0 or not value or value < 0:
+                raise NotDense()
+            indexes.append(index)
+            news.append(value)
+
+        if not indexes:
+            return
+
+        self.fit(min(indexes), max(indexes), self._count + len(indexes))
+        values = self._values
+        offset = self._offset
+        for index, value in zip(indexes, news):
+            index -= offset
+            if not values[index]:
+                self._count += 1
+            values[index] = value
+
+
+    def reserve(self, lower, upper, count):
+        """
+        see PKMap.reserve. Allocates the array for the keys range at once.
+        Raises NotDense if the keys range is too sparse
+        """
+        lower, upper = to_index(lower), to_index(upper)
+        if lower is None or upper is None:
+            raise NotDense()
+
+        self.fit(lower, upper, self._count + count)
+        self._expected = max(self._expected, count)
+
+
+    def fit(self, lower, upper, count):
+        """
+        Grows the array so it has room for the keys from lower to upper.
+        Raises NotDense if it would have less than count keys per density
+        """
+        offset = self._offset
+        if offset is None:
+            offset = lower
+        start = min(offset, lower)
+        size = max(offset + len(self._values), upper + 1) - start
+        if size > self.min_size and \
+                size * self.density > max(count, self._expected):
+            raise NotDense()
+
+        values = self._values
+        if start < offset:
+            values = array.array("l", [0]) * (offset - start) + values
+        if size > len(values):
+            values.extend(array.array("l", [0]) * (size - len(values)))
+        self._values = values
+        self._offset = start
+
+
+    def items(self):
+        offset = self._offset
+        for index, value in enumerate(self._values):
+            if value:
+                yield index + offset, value
+
+
+    def __len__(self):
+        return self._count
+
+
+class SQLitePKMap(PKMap):
+    """
+    Keeps the map in a SQLite file (a temporary file removed on close if
+    path is None)
+    """
+    def __init__(self, path=None, directory=None):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".pkmap", dir=directory)
+            os.close(fd)
+
+        self.path = path
+        self._closed_len = None
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._conn.execute("PRAGMA journal_mode = OFF")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pk_map "
+                "(old_pk PRIMARY KEY, new_pk)"
+            )
+            self._conn.commit()
+
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        out = {}
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+                chunk = keys[i:i + SQLITE_MAX_PARAMS]
+                normalized = dict((to_sqlite(key), key) for key in chunk)
+                rows = self._conn.execute(
+                    "SELECT old_pk, new_pk FROM pk_map WHERE old_pk IN (%s)" %
+                    ", ".join("?" * len(normalized)),
+                    normalized.keys()
+                )
+                for old_pk, new_pk in rows:
+                    out[normalized.get(old_pk, old_pk)] = new_pk
+
+        return out
+
+
+    def set_many(self, pairs):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pk_map (old_pk, new_pk) VALUES (?, ?)",
+                [(to_sqlite(key), to_sqlite(value)) for key, value in pairs]
+            )
+            self._conn.commit()
+
+
+    def items(self):
+        # read in rowid batches so the map can be written meanwhile
+        last = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT rowid, old_pk, new_pk FROM pk_map WHERE rowid > ? "
+                    "ORDER BY rowid LIMIT ?", (last, BATCH_SIZE)
+                ).fetchall()
+
+            if not rows:
+                return
+
+            for rowid, old_pk, new_pk in rows:
+                yield old_pk, new_pk
+            last = rows[-1][0]
+
+
+    def __len__(self):
+        if self._closed_len is not None:
+            return self._closed_len
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM pk_map").fetchone()[0]
+
+
+    def close(self):
+        with self._lock:
+            # the stats reports still show the map size
+            self._closed_len = len(self)
+            self._conn.close()
+            if self.temporary and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class AutoPKMap(PKMap):
+    """
+    Starts as an ArrayPKMap and spills to a SQLitePKMap as soon as the keys
+    are not dense or the map has more than max_memory keys
+    """
+    def __init__(self, max_memory=10000000, directory=None):
+        """
+        max_memory ::: maximum number of keys kept in memory (None means no
+                    limit)
+
+        directory ::: directory of the SQLite file (the system temporary
+                    directory if None)
+        """
+        self.max_memory = max_memory
+        self.directory = directory
+        self._lock = threading.RLock()
+        self._store = ArrayPKMap()
+
+
+    @property
+    def store(self):
+        """ returns the map that currently keeps the keys """
+        return self._store
+
+
+    def get_many(self, keys):
+        return self._store.get_many(keys)
+
+
+    def set_many(self, pairs):
+        pairs = list(pairs)
+        with self._lock:
+            if isinstance(self._store, ArrayPKMap):
+                try:
+                    if self.max_memory is not None and \
+                            len(self._store) + len(pairs) > self.max_memory:
+                        raise NotDense()
+                    self._store.set_many(pairs)
+                    return
+                except NotDense:
+                    self.spill()
+
+            self._store.set_many(pairs)
+
+
+    def reserve(self, lower, upper, count):
+        with self._lock:
+            if not isinstance(self._store, ArrayPKMap):
+                return
+
+            try:
+                if self.max_memory is not None and \
+                        len(self._store) + count > self.max_memory:
+                    raise NotDense()
+                self._store.reserve(lower, upper, count)
+            except NotDense:
+                self.spill()
+
+
+    def spill(self):
+        """ moves the keys from memory to a SQLitePKMap """
+        with self._lock:
+            disk = SQLitePKMap(directory=self.directory)
+            disk.update(self._store.items())
+            self._store = disk
+
+
+    def items(self):
+        return self._store.items()
+
+
+    def __len__(self):
+        return len(self._store)
+
+
+    def close(self):
+        self._store.close()
+
+
+    def __repr__(self):
+        return "<%s (%s): %s keys>" % (self.__class__.__name__,
+                                       self._store.__class__.__name__,
+                                       len(self))
+
+
+def create_pk_map(store="AUTO", max_memory=10000000, directory=None):
+    """
+    Returns a new primary keys map.
+
+    store ::: DICT (DictPKMap), SQLITE (SQLitePKMap) or AUTO (AutoPKMap)
+
+    max_memory, directory ::: see AutoPKMap
+    """
+    store = (store or "AUTO").upper()
+    if store == "DICT":
+        return DictPKMap()
+    elif store == "SQLITE":
+        return SQLitePKMap(directory=directory)
+    elif store == "AUTO":
+        return AutoPKMap(max_memory, directory)
+
+    raise ValueError("unknown primary keys map store: %s" % store)
+
+
+def to_index(key):
+    """ returns key as an array index or None if it can't be one """
+    if isinstance(key, (int, long)) and not isinstance(key, bool):
+        return key if key >= 0 else None
+
+    if isinstance(key, decimal.Decimal) and key == key.to_integral_value():
+        return to_index(int(key))
+
+    return None
+
+
+def to_sqlite(value):
+    """ returns value as a type SQLite can store """
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        return str(value)
+
+    return value
+
+
+def get_many(pk_map, keys):
+    """
+    Returns a dict with the new pk of every key of keys in pk_map (a PKMap
+    or a plain dict)
+    """
+    if isinstance(pk_map, PKMap):
+        return pk_map.get_many(keys)
+
+    return dict((key, pk_map[key]) for key in keys if key in pk_map)
@@ -0,0 +1,134 @@
+"""
+Database schema reflection cache shared by the dbms migrators (source and
+destination) of a migration.
+"""
+import os
+import threading
+import cPickle as pickle
+
+import sqlalchemy as sa
+from sqlalchemy import MetaData
+
+
+class ReflectionCache(object):
+    """
+    Caches the tables reflected from every database (engine) so each table
+    is reflected only once per migration instead of once per paquet.
+
+    The tables of a database are reflected in bulk: the database tables
+    names are read once with an Inspector and all the requested tables are
+    reflected at once with MetaData.reflect.
+
+    If path is specified the reflected tables are saved to (and loaded from)
+    that file so the next migrations can start without querying the
+    databases catalogs. Use it only when the databases schemas do not change
+    between migrations (or remove the file when they do).
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        # database key (see get_engine_key) -> MetaData of reflected tables
+        self._metadatas = {}
+        # database key -> set of the database table names
+        self._table_names = {}
+
+        if path and os.path.exists(path):
+            with open(path, "rb") as fin:
+                self._metadatas = pickle.load(fin)
+
+
+    def save(self):
+        """ saves the reflected tables to self.path (if any) """
+        if not self.path:
+            return
+
+        with self._lock:
+            with open(self.path, "wb") as fout:
+                pickle.dump(self._metadatas, fout, 2)
+
+
+    def get_metadata(self, engine):
+        """ returns the MetaData with the tables reflected from engine """
+        key = get_engine_key(engine)
+        with self._lock:
+            if key not in self._metadatas:
+                self._metadatas[key] = MetaData()
+
+            return self._metadatas[key]
+
+
+    def get_table_names(self, engine):
+        """ returns the set of the table names of the engine database """
+        key = get_engine_key(engine)
+        with self._lock:
+            if key not in self._table_names:
+                inspector = sa.inspect(engine)
+                self._table_names[key] = set(inspector.get_table_names())
+
+            return self._table_names[key]
+
+
+    def has_table(self, engine, table_name):
+        """ returns True if the engine database has a table named table_name """
+        return table_name in self.get_table_names(engine)
+
+
+    def reflect(self, engine, table_names=None):
+        """
+        Reflects (in bulk) all the table_names tables (all the database tables
+        if None) that are not in the cache yet
+        """
+        with self._lock:
+            existing = self.get_table_names(engine)
+            if table_names is None:
+                table_names = existing
+
+            meta = self.get_metadata(engine)
+            missing = [name for name in table_names
+                       if name not in meta.tables and name in existing]
+            if missing:
+                meta.reflect(bind=engine, only=missing)
+
+
+    def get_table(self, engine, table_name):
+        """
+        Returns the sqlalchemy Table named table_name reflected from the
+        engine database. Raises sqlalchemy.exc.NoSuchTableError if the
+        table does not exist
+        """
+        with self._lock:
+            meta = self.get_metadata(engine)
+            if table_name not in meta.tables:
+                if not self.has_table(engine, table_name):
+                    raise sa.exc.NoSuchTableError(table_name)
+
+                self.reflect(engine, [table_name])
+
+            return meta.tables[table_name]
+
+
+    def invalidate(self, engine, table_name=None):
+        """
+        Removes table_name (or all the tables if None) of the engine database
+        from the cache. Must be called when the database schema changes (i.e.
+        when a table is created)
+        """
+        key = get_engine_key(engine)
+        with self._lock:
+            self._table_names.pop(key, None)
+            meta = self._metadatas.get(key)
+            if meta is None:
+                return
+
+            if table_name is None:
+                self._metadatas.pop(key)
+            elif table_name in meta.tables:
+                meta.remove(meta.tables[table_name])
+
+
+def get_engine_key(engine):
+    """
+    Returns the cache key of the engine database (its url without the
+    password so it's never saved to the cache file)
+    """
+    return repr(engine.url)
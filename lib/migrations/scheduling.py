@@ -0,0 +1,115 @@
+"""
+Helpers to run the tables migration tasks in parallel respecting the tables
+dependencies (foreign keys) graph.
+"""
+
+import sys
+import threading
+
+
+def get_tables_dependencies(tables_order, tables_fks):
+    """
+    Builds the tables dependencies graph (DAG) from the tables foreign keys
+    information collected by the dbms Migrator.get_tables_dump_order method.
+
+    INPUTS:
+
+    tables_order ::: list of the table names (strings) in a safe dump order
+
+    tables_fks ::: dictionary that maps a table name to its foreign keys links
+                    ({column: (linked_table, linked_column)})
+
+    OUTPUT:
+
+    dictionary that maps every table name to the set of the table names that
+    must be dumped before it. Only tables that come before a table in
+    tables_order are considered as dependencies so the FKs cycles that
+    get_tables_dump_order already had to break cannot lock the graph
+    """
+    position = dict((name, i) for i, name in enumerate(tables_order))
+    dependencies = {}
+    for table_name in tables_order:
+        parents = set()
+        for lnk_table, lnk_column in tables_fks.get(table_name, {}).values():
+            if position.get(lnk_table, sys.maxint) < position[table_name]:
+                parents.add(lnk_table)
+
+        dependencies[table_name] = parents
+
+    return dependencies
+
+
+def run_dependency_graph(nodes, dependencies, task, workers=1):
+    """
+    Calls task(node) for every node using at most workers threads. A node is
+    only started when all its dependencies are done. If a task raises an
+    exception no other node is started and the first exception is raised
+    again once the running tasks have finished.
+
+    INPUTS:
+
+    nodes ::: list of the nodes (i.e. table names) in the preferred start order
+
+    dependencies ::: dictionary that maps every node to the set of nodes that
+                    must be completed before it can start
+
+    task ::: callable that receives a node and runs its job
+
+    workers ::: maximum number of tasks running at the same time
+    """
+    workers = max(1, workers)
+    pending = list(nodes)
+    done = set()
+    running = set()
+    errors = []
+    condition = threading.Condition()
+
+    def is_ready(node):
+        return not dependencies.get(node, set()).difference(done)
+
+    def worker():
+        while True:
+            with condition:
+                node = None
+                while node is None:
+                    if errors or not pending:
+                        return
+
+                    for candidate in pending:
+                        if is_ready(candidate):
+                            node = candidate
+                            break
+                    else:
+                        if not running:
+                            # nothing can be started anymore and nothing is
+                            # running: the remaining nodes can never be
+                            # released so we start the first one anyway
+                            node = pending[0]
+                        else:
+                            condition.wait()
+
+                pending.remove(node)
+                running.add(node)
+
+            try:
+                task(node)
+            except Exception:
+                with condition:
+                    errors.append(sys.exc_info())
+            finally:
+                with condition:
+                    running.discard(node)
+                    done.add(node)
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
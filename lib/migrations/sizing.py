@@ -0,0 +1,71 @@
+"""
+Adaptive paquet sizing: the number of records transferred at once is tuned
+for every table measuring the paquets transfer latency and records size.
+"""
+
+
+class PaquetSizer(object):
+    """
+    Keeps the size of the next paquet of a table. int(sizer) returns the
+    current size so a sizer can be used wherever a paquet size is expected.
+
+    After every paquet call update with the paquet measures: the size grows
+    (at most doubling at every paquet) while the paquets are transferred
+    faster than target_seconds and shrinks as soon as they are slower or
+    bigger than max_bytes.
+    """
+    def __init__(self, paquet, target_seconds=1.0, max_bytes=32 * 1024 * 1024,
+                 min_size=100, max_size=1000000, adaptive=True):
+        """
+        paquet ::: initial paquet size
+
+        target_seconds ::: target time to fetch and dump a paquet
+
+        max_bytes ::: maximum (estimated) size in bytes of a paquet
+
+        min_size, max_size ::: limits of the paquet size
+
+        adaptive ::: if False the paquet size never changes
+        """
+        self.size = int(paquet)
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.min_size = min(min_size, self.size)
+        self.max_size = max(max_size, self.size)
+        self.adaptive = adaptive
+
+
+    def __int__(self):
+        return self.size
+
+
+    def update(self, records, size, fetch_seconds, dump_seconds):
+        """
+        Computes the next paquet size.
+
+        records ::: number of records of the last paquet
+
+        size ::: (estimated) size in bytes of the last paquet records
+
+        fetch_seconds, dump_seconds ::: time spent fetching the last paquet
+                    from the source and dumping it to the destination
+
+        Returns the new paquet size
+        """
+        if not self.adaptive or not records:
+            return self.size
+
+        seconds = fetch_seconds + dump_seconds
+        if seconds > 0:
+            by_time = int(records * self.target_seconds / seconds)
+        else:
+            by_time = self.max_size
+
+        if size > 0:
+            by_bytes = int(records * self.max_bytes / float(size))
+        else:
+            by_bytes = self.max_size
+
+        new_size = min(by_time, by_bytes, self.size * 2, self.max_size)
+        self.size = max(new_size, self.min_size)
+        return self.size
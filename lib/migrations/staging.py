@@ -0,0 +1,181 @@
+"""
+Staging tables used by the dbms destination to compare the records of a
+paquet with the records already in a destination table set-wise.
+
+The paquet is bulk loaded into a temporary table (with the same columns as
+the destination table and no constraints) and the database itself computes
+the anti-join: the staged records that are not in the destination table
+are inserted with a single INSERT ... SELECT ... WHERE NOT EXISTS statement
+per paquet (see StagingTable.insert_missing) instead of looking every record
+up with its own SELECT.
+
+The records are compared as sets: a record is not inserted if a record with
+the same values is in the destination table or comes before it in the
+paquet, so the duplicated records are inserted once whether they come in
+the same paquet or not.
+"""
+import sqlalchemy as sa
+
+from migrations import loaders
+
+
+# column of the staging tables with the position of the records in their
+# paquet
+ORDER_COLUMN = "migrations_order"
+
+# dialect name -> operator that compares two values matching the NULLs
+NULL_SAFE_OPERATORS = {
+    "postgresql": "IS NOT DISTINCT FROM",
+    "sqlite": "IS",
+    "mysql": "<=>",
+}
+
+
+class StagingTable(object):
+    """
+    Temporary table of the destination connection where the paquets of a
+    table are staged, one paquet at a time
+    """
+    def __init__(self, conn, table, loader="AUTO"):
+        """
+        conn ::: sqlalchemy Connection to the destination database. The
+                    temporary table only exists for this connection
+
+        table ::: sqlalchemy table reflected from the destination database
+
+        loader ::: name of the bulk loader used to stage the records (see
+                    loaders.get_loader)
+        """
+        self.conn = conn
+        self.target = table
+        self.table = sa.Table(
+            get_staging_name(conn.dialect, table.name), sa.MetaData(),
+            *([sa.Column(col.name, col.type, nullable=col.nullable)
+               for col in table.columns] +
+              [sa.Column(ORDER_COLUMN, sa.Integer)]),
+            prefixes = ["TEMPORARY"]
+        )
+        # a staging table left on the (pooled) connection is replaced
+        self.drop()
+        self.table.create(conn)
+        self.loader = loaders.get_loader(conn, self.table, loader)
+
+
+    def load(self, paquet):
+        """ replaces the staged records with the columnar.Paquet records """
+        self.conn.execute(self.table.delete())
+        staged = paquet.project(list(paquet.keys))
+        staged[ORDER_COLUMN] = range(len(paquet))
+        self.loader.load_paquet(staged)
+
+
+    def get_missing(self, keys):
+        """
+        returns the select of the staged records whose keys values (None
+        values match) are not in the destination table nor in a record
+        staged before them
+        """
+        staged, target = self.table, self.target
+        previous = staged.alias("previous")
+        dialect = self.conn.dialect
+        exists = sa.exists(
+            sa.select([sa.literal_column("1")]).select_from(target).where(
+                match_clause(target, staged, keys, dialect))
+        )
+        duplicated = sa.exists(
+            sa.select([sa.literal_column("1")]).select_from(previous).where(
+                sa.and_(previous.c[ORDER_COLUMN] < staged.c[ORDER_COLUMN],
+                        match_clause(previous, staged, keys, dialect)))
+        )
+        return sa.select([staged.c[col.name] for col in target.columns]
+                         ).where(sa.and_(~exists, ~duplicated))
+
+
+    def select_missing(self, keys):
+        """
+        returns the staged records (dicts) whose keys values are not in the
+        destination table
+        """
+        return [dict(row) for row in self.conn.execute(self.get_missing(keys))]
+
+
+    def insert_missing(self, insert_keys, keys):
+        """
+        Inserts into the destination table the insert_keys columns of the
+        staged records whose keys values are not there yet. Returns the
+        number of records inserted
+        """
+        missing = self.get_missing(keys).alias("missing")
+        stmt = self.target.insert().from_select(
+            insert_keys, sa.select([missing.c[key] for key in insert_keys]))
+        return self.conn.execute(stmt).rowcount
+
+
+    def get_pk_pairs(self, pk_name, keys):
+        """
+        returns the (staged pk, destination pk) pairs of the staged records
+        and the destination records with the same keys values
+        """
+        staged, target = self.table, self.target
+        stmt = sa.select([staged.c[pk_name], target.c[pk_name]]).where(
+            match_clause(target, staged, keys, self.conn.dialect))
+        return [tuple(row) for row in self.conn.execute(stmt)]
+
+
+    def drop(self):
+        """ drops the temporary table (if it exists) """
+        stmt = get_drop_statement(self.conn.dialect, self.table)
+        if stmt is None:
+            self.table.drop(self.conn, checkfirst=True)
+        else:
+            self.conn.execute(stmt)
+
+
+def match_clause(left, right, keys, dialect=None):
+    """
+    returns the clause that matches the left and right tables records with
+    the same keys values (NULL values match each other). The NOT NULL
+    columns are compared with plain equality and the others with the
+    dialect NULL-safe comparison (if any), so the databases can still join
+    the tables with hash or merge joins
+    """
+    name = getattr(dialect, "name", None)
+    clauses = []
+    for key in keys:
+        lcol, rcol = left.c[key], right.c[key]
+        if not (lcol.nullable or rcol.nullable):
+            clauses.append(lcol == rcol)
+        elif name in NULL_SAFE_OPERATORS:
+            clauses.append(lcol.op(NULL_SAFE_OPERATORS[name])(rcol))
+        else:
+            clauses.append(sa.or_(lcol == rcol,
+                                  sa.and_(lcol == None, rcol == None)))
+
+    return sa.and_(*clauses)
+
+
+def get_drop_statement(dialect, table):
+    """
+    returns the statement that drops the temporary table if it exists or
+    None if the dialect has none. The sqlalchemy has_table checks (i.e.
+    drop(checkfirst=True)) don't find the temporary tables on PostgreSQL
+    (they only look in the current schema, not in pg_temp)
+    """
+    name = dialect.identifier_preparer.format_table(table)
+    if dialect.name in ("sqlite", "postgresql", "mysql"):
+        return "DROP TABLE IF EXISTS %s" % name
+    if dialect.name == "mssql":
+        return "IF OBJECT_ID('tempdb..%s') IS NOT NULL DROP TABLE %s" % (
+            table.name.replace("'", "''"), name)
+
+    return None
+
+
+def get_staging_name(dialect, table_name):
+    """ returns the name of the staging table of table_name """
+    name = "migrations_staging_%s" % table_name
+    if dialect.name == "mssql":
+        # mssql temporary tables are the ones named #name
+        return "#%s" % name
+
+    return name
@@ -0,0 +1,109 @@
+"""
+High-water marks store of the INCREMENTAL transfer mode.
+
+The watermark of a table is the max value of its watermark column (a last
+update timestamp or a monotonic id) among the records already migrated: the
+next migrations only read the records whose watermark column value is not
+lower than it. The marks are kept in memory and, if the store has a path,
+saved to a JSON file (with their types so they are read back as they were
+read from the database).
+"""
+import datetime
+import decimal
+import json
+import os
+import threading
+
+
+DATETIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]
+
+
+class WatermarkStore(object):
+    """
+    High-water marks of the tables: table name -> watermark value. It's
+    safe to use the same store from different threads
+    """
+    def __init__(self, path=None):
+        """
+        path ::: path of the JSON file where the marks are saved (and read
+                from if it exists). If None they are only kept in memory
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._marks = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as fp:
+                self._marks = dict((name, decode(mark))
+                                   for name, mark in json.load(fp).items())
+
+
+    def get(self, table_name):
+        """ returns the watermark of table_name or None """
+        with self._lock:
+            return self._marks.get(table_name)
+
+
+    def set(self, table_name, value):
+        """ sets the watermark of table_name """
+        with self._lock:
+            self._marks[table_name] = value
+
+
+    def save(self):
+        """ writes the marks to the store file (if any) """
+        if self.path is None:
+            return
+
+        with self._lock:
+            data = json.dumps(dict((name, encode(mark))
+                                   for name, mark in self._marks.items()),
+                              indent=1, sort_keys=True)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(data)
+        os.rename(tmp_path, self.path)
+
+
+def encode(value):
+    """ returns value as a {"type": type name, "value": value} dict """
+    if isinstance(value, bool) or value is None:
+        raise ValueError("invalid watermark: %r" % value)
+    if isinstance(value, (int, long)):
+        return {"type": "int", "value": value}
+    if isinstance(value, float):
+        return {"type": "float", "value": value}
+    if isinstance(value, decimal.Decimal):
+        return {"type": "decimal", "value": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"type": "datetime", "value": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"type": "date", "value": value.isoformat()}
+    if isinstance(value, basestring):
+        return {"type": "text", "value": value}
+
+    raise ValueError("unsupported watermark type: %r" % value)
+
+
+def decode(mark):
+    """ returns the value of an encoded mark (see encode) """
+    kind, value = mark["type"], mark["value"]
+    if kind == "int":
+        return int(value)
+    elif kind == "float":
+        return float(value)
+    elif kind == "decimal":
+        return decimal.Decimal(value)
+    elif kind == "datetime":
+        for fmt in DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError("invalid datetime watermark: %s" % value)
+    elif kind == "date":
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    elif kind == "text":
+        return value
+
+    raise ValueError("unknown watermark type: %s" % kind)
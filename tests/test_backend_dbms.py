@@ -1,5 +1,12 @@
+import threading
+
+import pytest
 from mock import Mock
 
+from migrations import graph
+from migrations import loaders
+from migrations import migrator
+from migrations import pkmaps
 from migrations.backends import base, dbms
 import sqlalchemy as sa
 import test_backends_base
@@ -84,8 +91,28 @@ class TestMigrator:
     # CUSTOM DBMS MIGRATOR METHODS TESTS
     #
     #************************************************    
-    def test_get_tables_dump_order(self, monkeypatch):
-        raise NotImplementedError
+    def test_get_tables_dump_order(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        for name, links in [("D", ["B", "C"]), ("C", ["A"]), ("B", ["A"]),
+                            ("A", []), ("E", [])]:
+            sa.Table(name, meta,
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     *[sa.Column("%s_id" % link, sa.Integer,
+                                 sa.ForeignKey("%s.id" % link))
+                       for link in links])
+        meta.create_all(engine)
+
+        migrator = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"))
+        migrator.init_migration(Mock())
+        assert migrator.get_tables_dump_order(None) == ["A", "E", "B", "C", "D"]
+        assert migrator.stats["tables_graph"]["levels"] == [["A", "E"],
+                                                            ["B", "C"],
+                                                            ["D"]]
+        assert migrator.stats["tables_graph"]["fks"]["D"] == {
+            "B_id": ("B", "id"), "C_id": ("C", "id")
+        }
+        assert migrator.get_tables_dump_order(["D", "B"]) == ["B", "D"]
     
     
     def test_check_table(self, monkeypatch):
@@ -109,11 +136,75 @@ class TestMigrator:
 
 
     def test_skip_records(self, monkeypatch):
-        raise NotImplementedError
+        engine = sa.create_engine("sqlite://")
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True,
+                                   autoincrement=False),
+                         sa.Column("name", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": 1, "name": u"n1"},
+                                        {"id": 3, "name": u"n2"}])
+        records = [{"id": i, "name": u"n%s" % i} for i in range(5)] + [{}]
+
+        for compare_mode, expected, skipped in [("FULL", [0, 2, 3, 4], 1),
+                                                ("FULL_NO_PK", [0, 3, 4], 2),
+                                                ("OTHER", range(5), 0)]:
+            tab_stats = {"records_skipped": 0}
+            res = dbms.skip_records(records, table, table.c.id, compare_mode,
+                                    "DIFF", tab_stats, engine.connect())
+            assert sorted(record["id"] for record in res) == expected
+            assert tab_stats["records_skipped"] == skipped
 
 
     def test_skip_records_pk(self, monkeypatch):
-        raise NotImplementedError
+        engine = sa.create_engine("sqlite://")
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("name", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": 1, "name": u"a"},
+                                        {"id": 3, "name": u"c"}])
+        records = [{"id": i, "name": u"n%s" % i} for i in range(5)] + [{}]
+        tab_stats = {"records_skipped": 0}
+
+        for kind in ("SORTED_ARRAY", "BLOOM"):
+            builder = dbms.existence.IndexBuilder(kind)
+            res = dbms.skip_records(records, table, table.c.id, "PK",
+                                    "DIFF", tab_stats, engine.connect(),
+                                    builder)
+            assert [record["id"] for record in res] == [0, 2, 4]
+
+        assert tab_stats["records_skipped"] == 4
+
+
+    def test_reseed_table(self, monkeypatch):
+        from sqlalchemy.dialects import postgresql
+        migrator = get_migrator(self.path, monkeypatch)
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True))
+        conn = Mock(dialect=postgresql.dialect())
+        conn.execute.return_value.scalar.return_value = "A_id_seq"
+        migrator.engine = Mock(dialect=conn.dialect)
+        migrator.engine.connect.return_value = conn
+
+        migrator.reseed_table(table)
+        stmt, params = conn.execute.call_args
+        assert stmt[0].text == 'SELECT setval(:sequence, GREATEST(MAX("id"), '\
+            'nextval(:sequence))) FROM "A"'
+        assert params == {"sequence": "A_id_seq"}
+        assert conn.close.called
+
+        # the copied primary keys only need it
+        conn.reset_mock()
+        for name in ("sqlite", "mysql"):
+            migrator.engine.dialect = Mock()
+            migrator.engine.dialect.name = name
+            migrator.reseed_table(table)
+        migrator.engine.dialect = conn.dialect
+        migrator.reseed_table(sa.Table(
+            "B", sa.MetaData(), sa.Column("id", sa.Unicode(10),
+                                          primary_key=True)))
+        assert not conn.execute.called
 
 
     def test_mssql_creator_factory(self, monkeypatch):
@@ -171,3 +262,593 @@ class TestMigrator:
 
         assert res == record
 
+
+    def test_get_minmax_limits(self, monkeypatch):
+        assert dbms.get_minmax_limits(1, 100, 4) == [26, 51, 76]
+        assert dbms.get_minmax_limits(1, 2, 4) == [2]
+        assert dbms.get_minmax_limits(None, None, 4) == []
+        assert dbms.get_minmax_limits(0.0, 9.0, 2) == [5.0]
+
+    def test_read_paquets(self, monkeypatch):
+        migrator = get_migrator(self.path, monkeypatch)
+        migrator.options["stream_fetch_size"] = 2
+
+        rows = range(11)
+        result = Mock()
+        result.fetchmany.side_effect = lambda size: [
+            rows.pop(0) for i in range(min(size, len(rows)))
+        ]
+        conn = Mock()
+        conn.execute.return_value = result
+        stmt = Mock()
+
+        paquets = list(migrator.read_paquets(conn, stmt, 4))
+
+        assert paquets == [[0, 1], [2, 3, 4, 5], [6, 7, 8, 9], [10]]
+        stmt.execution_options.assert_called_once_with(stream_results=True)
+        conn.execute.assert_called_once_with(stmt.execution_options.return_value)
+        assert result.close.call_count == 1
+
+    def test_read_paquets_keyset(self, monkeypatch):
+        migrator = get_migrator(self.path, monkeypatch)
+        engine = sa.create_engine("sqlite://")
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Integer))
+        table.create(engine)
+        engine.execute(table.insert(),
+                       [{"id": i, "value": i * 10} for i in (9, 3, 7, 1, 5)])
+
+        conn = engine.connect()
+        paquets = migrator.read_paquets_keyset(conn, table, table.c.id, 2)
+        assert [[row.id for row in paq] for paq in paquets] == [[1, 3], [5, 7], [9]]
+
+        paquets = migrator.read_paquets_keyset(conn, table, table.c.id, 2,
+                                               lower=3, upper=9)
+        assert [[row.id for row in paq] for paq in paquets] == [[3, 5], [7]]
+
+        paquets = migrator.read_paquets_keyset(conn, table, table.c.id, 2,
+                                               last=5)
+        assert [[row.id for row in paq] for paq in paquets] == [[7, 9]]
+
+    def test_dump_table_writer_session(self, tmpdir):
+        migrator = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        migrator.init_migration(Mock())
+        source_table = sa.Table("A", sa.MetaData(),
+                                sa.Column("id", sa.Integer, primary_key=True),
+                                sa.Column("value", sa.Unicode(10)))
+
+        migrator.dump([{"id": 5, "value": u"a"}, {"id": 9, "value": u"b"}],
+                      source_table)
+        writer = migrator.get_table_writer(source_table)
+        migrator.dump([{"id": 12, "value": u"c"}], source_table)
+
+        # the same session is used for all the table paquets
+        assert migrator.get_table_writer(source_table) is writer
+        assert writer.remap_pk
+        assert migrator.get_table_stats("A")["pk_map"] == {5: 1, 9: 2, 12: 3}
+        assert migrator.get_table_stats("A")["records_transferred"] == 3
+
+        migrator.finish_table(source_table)
+        assert writer.conn.closed
+        assert migrator.get_table_writer(source_table) is not writer
+        migrator.finish_migration()
+
+
+    def test_deferred_indexes(self, tmpdir):
+        migrator = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"),
+                                 deferred_indexes=True)
+        migrator.init_migration(Mock())
+        source_table = sa.Table("A", sa.MetaData(),
+                                sa.Column("id", sa.Integer, primary_key=True),
+                                sa.Column("value", sa.Unicode(10)),
+                                sa.Index("ix_a_value", "value"))
+
+        migrator.dump([{"id": 5, "value": u"a"}], source_table)
+        inspector = sa.inspect(migrator.engine)
+        assert inspector.get_indexes("A") == []
+
+        migrator.complete_migration()
+        inspector = sa.inspect(migrator.engine)
+        assert [ix["name"] for ix in inspector.get_indexes("A")] == ["ix_a_value"]
+        assert migrator.get_table_stats("A")["indexes"].keys() == ["ix_a_value"]
+        migrator.finish_migration()
+
+
+    def test_migrate_fk_cycles(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        table_a = sa.Table("a", meta,
+                           sa.Column("id", sa.Integer, primary_key=True),
+                           sa.Column("b_id", sa.Integer, sa.ForeignKey("b.id"),
+                                     nullable=True))
+        table_b = sa.Table("b", meta,
+                           sa.Column("id", sa.Integer, primary_key=True),
+                           sa.Column("a_id", sa.Integer, sa.ForeignKey("a.id"),
+                                     nullable=False))
+        table_a.create(engine)
+        table_b.create(engine)
+        engine.execute(table_a.insert(), [{"id": 10, "b_id": 21},
+                                          {"id": 11, "b_id": None}])
+        engine.execute(table_b.insert(), [{"id": 20, "a_id": 11},
+                                          {"id": 21, "a_id": 10}])
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"),
+                               fk_cycles="NULLIFY")
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        source.migrate(destination)
+
+        graph_stats = source.stats["tables_graph"]
+        assert graph_stats["cycles"] == [["a", "b"]]
+        assert graph_stats["levels"] == [["a"], ["b"]]
+        assert graph_stats["deferred_fks"] == {"a": {"b_id": ("b", "id")}}
+        assert destination.get_table_stats("a")["backfilled"] == 1
+
+        # a (10 -> 1, 11 -> 2) links to b 21 -> 2 and b links to a
+        rows = destination.engine.execute(
+            "SELECT id, b_id FROM a ORDER BY id").fetchall()
+        assert map(tuple, rows) == [(1, 2), (2, None)]
+        rows = destination.engine.execute(
+            "SELECT id, a_id FROM b ORDER BY id").fetchall()
+        assert map(tuple, rows) == [(1, 2), (2, 1)]
+
+        source.options["fk_cycles"] = "RAISE"
+        with pytest.raises(graph.CycleError):
+            source.get_tables_dump_order(None)
+
+
+    def test_parse_commit_every(self):
+        assert dbms.parse_commit_every(None) is None
+        assert dbms.parse_commit_every(10) == (10, "paquets")
+        assert dbms.parse_commit_every("5000 rows") == (5000, "records")
+        assert dbms.parse_commit_every("30 seconds") == (30, "seconds")
+        with pytest.raises(ValueError):
+            dbms.parse_commit_every("30 minutes")
+
+
+    def test_dump_commit_every(self, tmpdir):
+        migrator = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"),
+                                 commit_every="3 rows")
+        migrator.init_migration(Mock())
+        source_table = sa.Table("A", sa.MetaData(),
+                                sa.Column("id", sa.Integer, primary_key=True),
+                                sa.Column("value", sa.Unicode(10)))
+
+        for i in range(4):
+            migrator.dump([{"id": i * 2, "value": u"a"},
+                           {"id": i * 2 + 1, "value": u"b"}], source_table)
+
+        # a commit every 2 paquets (4 records) and the last paquets pending
+        tab_stats = migrator.get_table_stats("A")
+        assert tab_stats["commits"] == 1
+        writer = migrator.get_table_writer(source_table)
+        assert writer.transaction is not None
+
+        migrator.flush_table(source_table)
+        assert tab_stats["commits"] == 2
+        assert writer.conn.closed
+        count = migrator.engine.execute("SELECT COUNT(*) FROM A").scalar()
+        assert count == 8
+        migrator.finish_migration()
+
+
+    def test_migrate_workers(self, tmpdir, monkeypatch):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        for name in ("A", "B"):
+            sa.Table(name, meta, sa.Column("id", sa.Integer, primary_key=True))
+        meta.create_all(engine)
+
+        graphs = []
+        def run_dependency_graph(nodes, dependencies, function, workers):
+            graphs.append(workers)
+            for node in nodes:
+                function(node)
+        monkeypatch.setattr(dbms.scheduling, "run_dependency_graph",
+                            run_dependency_graph)
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"))
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        source.migrate(destination, workers=4)
+        assert graphs == [4]
+        # the next migrations are sequential again
+        source.migrate(destination)
+        assert graphs == [4]
+        assert source.options["workers"] == 1
+
+
+    def test_migrate_partitions_pk_map(self, tmpdir, monkeypatch):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                        for i in range(1, 101)])
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"),
+                               partitions=4)
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        # the ranges are written in reverse order
+        monkeypatch.setattr(
+            dbms.scheduling, "run_dependency_graph",
+            lambda nodes, dependencies, function, workers: [
+                function(node) for node in reversed(nodes)])
+        source.migrate(destination, paquet=10)
+
+        pk_map = destination.get_table_stats("A")["pk_map"]
+        assert isinstance(pk_map.store, pkmaps.ArrayPKMap)
+        assert len(pk_map) == 100
+
+
+    def test_migrate_delta(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                        for i in range(1, 101)])
+
+        def migrate(**options):
+            source = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("source.db"),
+                transfer_mode="DELTA", delta_split=4, **options)
+            destination = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("dest.db"),
+                transfer_mode="DELTA")
+            source.migrate(destination, paquet=10)
+            rows = destination.engine.execute(
+                "SELECT id, value FROM A ORDER BY id").fetchall()
+            assert rows == engine.execute(
+                "SELECT id, value FROM A ORDER BY id").fetchall()
+            return source.get_table_stats("A")["delta"]
+
+        # the primary keys are copied
+        assert migrate()["inserted"] == 100
+        delta = migrate()
+        assert delta["ranges"] == delta["ranges_equal"] == 1
+
+        engine.execute(table.update().where(table.c.id == 50).values(
+            value=u"changed"))
+        engine.execute(table.delete().where(table.c.id == 7))
+        engine.execute(table.insert(), [{"id": 500, "value": u"new"}])
+        for i, options in enumerate(({}, {"delta_server_checksums": False})):
+            delta = migrate(**options)
+            assert (delta["inserted"], delta["updated"], delta["deleted"]) == \
+                (1, 1, 1)
+            engine.execute(table.update().where(table.c.id == 50).values(
+                value=u"again"))
+            engine.execute(table.delete().where(table.c.id == 8 + i))
+            engine.execute(table.insert(), [{"id": 501 + i, "value": u"new"}])
+
+        assert migrate()["ranges"] > 1
+        assert migrate()["ranges_equal"] == 1
+
+
+    @pytest.mark.parametrize("upsert", [True, False])
+    def test_migrate_incremental(self, tmpdir, monkeypatch, upsert):
+        if not upsert:
+            # the records are updated or inserted by TableWriter.write_upsert
+            monkeypatch.setattr(loaders, "get_upsert_statement",
+                                Mock(return_value=None))
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        table = sa.Table("A", meta,
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)),
+                         sa.Column("updated", sa.Integer))
+        sa.Table("B", meta, sa.Column("value", sa.Unicode(10)))
+        meta.create_all(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i,
+                                         "updated": 1} for i in range(1, 51)])
+
+        source = dbms.Migrator(
+            "sqlite:///%s" % tmpdir.join("source.db"),
+            transfer_mode="INCREMENTAL", watermark_column="updated",
+            watermarks=str(tmpdir.join("watermarks")))
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"),
+                                    transfer_mode="INCREMENTAL")
+
+        def migrate():
+            source.migrate(destination, tables=["A"], paquet=7)
+            rows = destination.engine.execute(
+                "SELECT * FROM A ORDER BY id").fetchall()
+            assert rows == engine.execute(
+                "SELECT * FROM A ORDER BY id").fetchall()
+            return source.get_table_stats("A")["watermark"]
+
+        mark = migrate()
+        assert (mark["from"], mark["to"], mark["records"]) == (None, 1, 50)
+
+        engine.execute(table.update().where(table.c.id == 5).values(
+            value=u"changed", updated=2))
+        engine.execute(table.insert(), [{"id": 60, "value": u"new",
+                                         "updated": 2}])
+        mark = migrate()
+        # the records with the last mark are read again
+        assert (mark["from"], mark["to"], mark["records"]) == (1, 2, 51)
+        assert migrate()["records"] == 2
+
+        # the marks are saved
+        source = dbms.Migrator(
+            "sqlite:///%s" % tmpdir.join("source.db"),
+            transfer_mode="INCREMENTAL", watermark_column="updated",
+            watermarks=str(tmpdir.join("watermarks")))
+        assert migrate()["from"] == 2
+
+        # tables without watermark column are upserted whole
+        engine.execute("INSERT INTO B VALUES ('a')")
+        source.migrate(destination, tables=["B"])
+        assert source.get_table_stats("B")["watermark"]["column"] is None
+
+        # following the source
+        migration = migrator.Migration(
+            "dbms:::sqlite:///%s" % tmpdir.join("source.db"),
+            "dbms:::sqlite:///%s" % tmpdir.join("dest.db"),
+            transfer_mode="INCREMENTAL", watermark_column="updated")
+        assert migration.follow(0, tables=["A"], runs=2) == 2
+        stop = threading.Event()
+        stop.set()
+        assert migration.follow(0, stop_event=stop) == 0
+        with pytest.raises(ValueError):
+            migrator.Migration(
+                "dbms:::sqlite:///%s" % tmpdir.join("source.db"),
+                "dbms:::sqlite:///%s" % tmpdir.join("dest.db")).follow()
+
+
+    def test_migrate_capture(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                        for i in range(1, 51)])
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"),
+                               transfer_mode="CAPTURE")
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"),
+                                    transfer_mode="CAPTURE")
+
+        def migrate():
+            source.migrate(destination, paquet=3)
+            rows = destination.engine.execute(
+                "SELECT id, value FROM A ORDER BY id").fetchall()
+            assert rows == engine.execute(
+                "SELECT id, value FROM A ORDER BY id").fetchall()
+            return source.get_table_stats("A")["capture"]
+
+        # the change table is not migrated
+        assert migrate()["initial"]
+        assert source.stats["tables"].keys() == ["A"]
+        assert migrate() == {"initial": False, "changed": 0, "upserted": 0,
+                             "deleted": 0}
+
+        engine.execute(table.update().where(table.c.id == 5).values(
+            value=u"changed"))
+        engine.execute(table.update().where(table.c.id == 6).values(id=60))
+        engine.execute(table.delete().where(table.c.id.in_([7, 8])))
+        engine.execute(table.insert(), [{"id": 100 + i, "value": u"new"}
+                                        for i in range(5)])
+        stats = migrate()
+        assert (stats["changed"], stats["upserted"], stats["deleted"]) == \
+            (10, 7, 3)
+
+        # the changes applied are removed from the log
+        assert engine.execute("SELECT COUNT(*) FROM migrations_changes"
+                              ).scalar() == 0
+        assert migrate()["changed"] == 0
+
+
+    def test_compare(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        table = sa.Table("A", meta,
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        sa.Table("B", meta, sa.Column("value", sa.Unicode(10)))
+        meta.create_all(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                        for i in range(1, 21)])
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"),
+                               compare_diff_file=str(tmpdir.join("diff")))
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        source.migrate(destination, tables=["A"], paquet=7)
+        destination.engine.execute("DELETE FROM A WHERE id = 3")
+
+        out = source.compare(destination, ["A", "B"], paquet=7)
+        assert out["A"] == {"source": 20, "destination": 19, "equal": 19,
+                            "missing": 1, "extra": 0, "changed": 0}
+        assert out["B"]["source"] == 0
+        assert source.get_table_stats("A")["compare"] == out["A"]
+        assert len(tmpdir.join("diff").readlines()) == 1
+
+
+    def test_compare_checksums(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        table = sa.Table("A", meta,
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        sa.Table("B", meta, sa.Column("value", sa.Unicode(10)))
+        meta.create_all(engine)
+        engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                        for i in range(1, 101)])
+        engine.execute("INSERT INTO B (value) VALUES ('a')")
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"),
+                               compare_method="CHECKSUM", delta_split=4,
+                               compare_diff_file=str(tmpdir.join("diff")))
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        source.migrate(destination, paquet=10)
+
+        out = source.compare(destination, ["A", "B"], paquet=10)
+        assert out["A"]["ranges"] == out["A"]["ranges_equal"] == 1
+        assert out["A"]["equal"] == 100
+
+        destination.engine.execute("UPDATE A SET value = 'x' WHERE id = 50")
+        destination.engine.execute("INSERT INTO B (value) VALUES ('b')")
+        for server in (True, False):
+            source.options["delta_server_checksums"] = server
+            out = source.compare(destination, ["A", "B"], paquet=10)
+            assert out["A"]["changed"] == 1
+            assert out["A"]["equal"] == 99
+            # only the records of the ranges that differ are compared
+            assert 1 < out["A"]["ranges"] and out["A"]["ranges_equal"] > 1
+            assert out["B"]["extra"] == 1
+
+        assert len(tmpdir.join("diff").readlines()) == 2
+
+
+    def test_compare_remapped_pk(self, tmpdir):
+        # the destination primary keys (and the foreign keys linking to
+        # them) are re-mapped: 1, 2, 3...
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        parent = sa.Table("A", meta,
+                          sa.Column("id", sa.Integer, primary_key=True),
+                          sa.Column("value", sa.Unicode(10)))
+        child = sa.Table("B", meta,
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("parent_id", sa.Integer,
+                                   sa.ForeignKey("A.id")))
+        meta.create_all(engine)
+        engine.execute(parent.insert(), [{"id": i * 3, "value": u"v%s" % i}
+                                         for i in range(1, 31)])
+        engine.execute(child.insert(), [{"id": i * 7, "parent_id": i * 3}
+                                        for i in range(1, 31)])
+
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"))
+        destination = dbms.Migrator("sqlite:///%s" % tmpdir.join("dest.db"))
+        source.migrate(destination, paquet=7)
+        assert destination.engine.execute("SELECT MAX(id) FROM A"
+                                          ).scalar() == 30
+
+        for method in ("ROWS", "CHECKSUM"):
+            source.options["compare_method"] = method
+            out = source.compare(destination, ["A", "B"], paquet=7)
+            for name in ("A", "B"):
+                assert (out[name]["equal"], out[name]["missing"],
+                        out[name]["extra"], out[name]["changed"]) == \
+                    (30, 0, 0, 0)
+
+        destination.engine.execute("UPDATE B SET parent_id = 1 WHERE id = 2")
+        out = source.compare(destination, ["B"], paquet=7)
+        assert (out["B"]["equal"], out["B"]["changed"]) == (29, 1)
+
+        # without the maps the records can't be compared by key
+        source = dbms.Migrator("sqlite:///%s" % tmpdir.join("source.db"))
+        destination.engine.execute("UPDATE A SET value = 'x' WHERE id = 2")
+        out = source.compare(destination, ["A", "B"], paquet=7)
+        assert not out["A"]["comparable"] and not out["B"]["comparable"]
+        assert (out["A"]["equal"], out["A"]["source"]) == (0, 30)
+        # B has no other columns: only the records count is compared
+        assert out["B"]["equal"] == 30
+
+
+    def test_migrate_diff_remapped_pk(self, tmpdir):
+        # the destination primary keys are re-mapped (1, 2, 3...): the
+        # records already migrated are found through the primary keys map
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        table = sa.Table("A", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("value", sa.Unicode(10)))
+        table.create(engine)
+        engine.execute(table.insert(), [{"id": i * 3, "value": u"v%s" % i}
+                                        for i in range(1, 31)])
+        directory = str(tmpdir.mkdir("indexes"))
+
+        def get_migrators(**options):
+            source = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("source.db"),
+                transfer_mode="DIFF")
+            destination = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("dest.db"), transfer_mode="DIFF",
+                **options)
+            return source, destination
+
+        def migrate(source, destination):
+            source.migrate(destination, paquet=7)
+            dest = sa.create_engine("sqlite:///%s" % tmpdir.join("dest.db"))
+            assert dest.execute("SELECT value FROM A ORDER BY value"
+                                ).fetchall() == engine.execute(
+                "SELECT value FROM A ORDER BY value").fetchall()
+            return source.get_table_stats("A")["records_transferred"]
+
+        source, destination = get_migrators(
+            existence_index_directory=directory)
+        assert migrate(source, destination) == 30
+        engine.execute(table.insert(), {"id": 1000, "value": u"new"})
+        assert migrate(source, destination) == 1
+        assert migrate(source, destination) == 0
+
+        # the map is saved for the next runs
+        assert migrate(*get_migrators(
+            existence_index_directory=directory)) == 0
+
+        # without map the records can't be compared
+        with pytest.raises(ValueError):
+            migrate(*get_migrators())
+
+
+    def test_migrate_manifest(self, tmpdir):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join("source.db"))
+        meta = sa.MetaData()
+        tables = [sa.Table(name, meta,
+                           sa.Column("id", sa.Integer, primary_key=True),
+                           sa.Column("value", sa.Unicode(10)))
+                  for name in ("A", "B")]
+        meta.create_all(engine)
+        for table in tables:
+            engine.execute(table.insert(), [{"id": i, "value": u"v%s" % i}
+                                            for i in range(1, 11)])
+
+        def migrate():
+            source = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("source.db"),
+                transfer_mode="DIFF", manifest=str(tmpdir.join("manifest")))
+            destination = dbms.Migrator(
+                "sqlite:///%s" % tmpdir.join("dest.db"), transfer_mode="DIFF",
+                existence_index_directory=str(tmpdir))
+            source.migrate(destination, paquet=4)
+            return dict((name, source.get_table_stats(name))
+                        for name in ("A", "B"))
+
+        stats = migrate()
+        assert stats["A"]["records_transferred"] == 10
+        assert not stats["A"]["skipped"]
+
+        engine.execute(tables[1].insert(), {"id": 11, "value": u"new"})
+        stats = migrate()
+        assert stats["A"]["skipped"]
+        assert stats["A"]["messages"] == [
+            "skipped table A   unchanged since the last migration (manifest)"]
+        assert not stats["B"]["skipped"]
+        assert stats["B"]["records_transferred"] == 1
+
+        assert migrate()["B"]["skipped"]
+
+        # records written to A while B is migrated (after A was transferred)
+        # are migrated by the next run
+        def log_cb(msg):
+            if msg == "\n\nmigrating B":
+                engine.execute(tables[0].insert(), {"id": 12, "value": u"x"})
+        for table in tables:
+            engine.execute(table.insert(), {"id": 13, "value": u"new"})
+        source = dbms.Migrator(
+            "sqlite:///%s" % tmpdir.join("source.db"), log_cb=log_cb,
+            transfer_mode="DIFF", manifest=str(tmpdir.join("manifest")))
+        destination = dbms.Migrator(
+            "sqlite:///%s" % tmpdir.join("dest.db"), transfer_mode="DIFF",
+            existence_index_directory=str(tmpdir))
+        source.migrate(destination, paquet=4)
+        assert source.get_table_stats("A")["records_transferred"] == 1
+
+        stats = migrate()
+        assert not stats["A"]["skipped"]
+        dest = sa.create_engine("sqlite:///%s" % tmpdir.join("dest.db"))
+        assert dest.execute("SELECT COUNT(*) FROM A WHERE value = 'x'"
+                            ).scalar() == 1
+        assert migrate()["A"]["skipped"]
@@ -0,0 +1,48 @@
+import sqlalchemy as sa
+
+from migrations import capture
+
+
+def get_table():
+    engine = sa.create_engine("sqlite://")
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("name", sa.Unicode(10)))
+    table.create(engine)
+    conn = engine.connect()
+    conn.execute(table.insert(), [{"id": i, "name": u"n%s" % i}
+                                  for i in range(1, 6)])
+    return conn, table
+
+
+def test_install():
+    conn, table = get_table()
+    assert not capture.is_installed(conn, table)
+    capture.install(conn, table)
+    capture.install(conn, table)
+    assert capture.is_installed(conn, table)
+
+    conn.execute(table.insert(), [{"id": 10, "name": u"new"}])
+    conn.execute(table.update().where(table.c.id == 2).values(name=u"x"))
+    conn.execute(table.update().where(table.c.id == 3).values(id=30))
+    conn.execute(table.delete().where(table.c.id == 4))
+
+    changes = capture.get_change_table()
+    rows = conn.execute(sa.select([changes.c.operation, changes.c.pk])
+                        .order_by(changes.c.id)).fetchall()
+    assert rows == [("I", "10"), ("U", "2"), ("U", "30"), ("D", "3"),
+                    ("D", "4")]
+
+    last = capture.get_last_change(conn, changes, "A")
+    stmt = capture.get_changed_pks(conn, changes, table.c.id, "A", last)
+    assert [row["pk"] for row in conn.execute(stmt)] == [2, 3, 4, 10, 30]
+
+    capture.delete_changes(conn, changes, "A", last - 1)
+    assert capture.get_last_change(conn, changes, "A") == last
+    capture.delete_changes(conn, changes, "A", last)
+    assert capture.get_last_change(conn, changes, "A") is None
+
+    capture.uninstall(conn, table)
+    assert not capture.is_installed(conn, table)
+    conn.execute(table.delete())
+    assert capture.get_last_change(conn, changes, "A") is None
@@ -0,0 +1,82 @@
+import datetime
+
+from migrations import checkpoints
+
+
+def test_checkpoint_store(tmpdir):
+    path = str(tmpdir.join("checkpoints.db"))
+    store = checkpoints.CheckpointStore(path)
+    store.reset(tables=["A", "B"], paquet=10, exclude=None)
+
+    assert store.get_migration_args() == {
+        "tables": ["A", "B"], "paquet": 10, "exclude": None
+    }
+    assert store.get_progress("A", (None, None)) == (None, 0)
+    assert store.get_pk_ranges("A") is None
+    assert not store.is_done("A")
+
+    ranges = [(None, datetime.date(2013, 1, 1)), (datetime.date(2013, 1, 1), None)]
+    store.save_pk_ranges("A", ranges)
+    store.save_progress("A", ranges[0], datetime.date(2012, 5, 1), 20)
+    store.save_progress("B", (None, None), 7, 10, [(5, 1), (7, 2)])
+    store.save_progress("B", (None, None), 9, 12, [(9, 3)])
+    store.table_done("B")
+    store.close()
+
+    # checkpoints survive the store (process) lifetime
+    store = checkpoints.CheckpointStore(path)
+    assert store.get_pk_ranges("A") == ranges
+    assert store.get_progress("A", ranges[0]) == (datetime.date(2012, 5, 1), 20)
+    assert store.get_progress("A", ranges[1]) == (None, 0)
+    assert store.get_progress("B", (None, None)) == (9, 12)
+    assert store.get_pk_map("B") == {5: 1, 7: 2, 9: 3}
+    assert list(store.iter_pk_map("B", batch=2)) == [(5, 1), (7, 2), (9, 3)]
+    assert store.is_done("B")
+    assert not store.is_done("A")
+
+    store.reset(tables=None, paquet=5, exclude=["C"])
+    assert store.get_pk_map("B") == {}
+    assert not store.is_done("B")
+    store.close()
+
+
+def test_checkpoint_store_transactions(tmpdir):
+    store = checkpoints.CheckpointStore(str(tmpdir.join("checkpoints.db")))
+    store.reset(tables=None, paquet=10, exclude=None)
+
+    store.begin("A")
+    store.save_progress("A", (None, None), 7, 10, [(5, 1), (7, 2)])
+    # nothing is saved until the destination transaction is committed
+    assert store.get_progress("A", (None, None)) == (None, 0)
+    store.commit("A")
+    assert store.get_progress("A", (None, None)) == (7, 10)
+    assert store.get_pk_map("A") == {5: 1, 7: 2}
+
+    store.begin("A")
+    store.save_progress("A", (None, None), 9, 12, [(9, 3)])
+    store.rollback("A")
+    assert store.get_progress("A", (None, None)) == (7, 10)
+    assert store.get_pk_map("A") == {5: 1, 7: 2}
+
+    # without transaction the progress is saved at once
+    store.save_progress("A", (None, None), 9, 12, [(9, 3)])
+    assert store.get_progress("A", (None, None)) == (9, 12)
+    store.close()
+
+
+def test_checkpoint_store_deferred_ddl(tmpdir):
+    store = checkpoints.CheckpointStore(str(tmpdir.join("checkpoints.db")))
+    store.reset(tables=None, paquet=10, exclude=None)
+
+    store.save_deferred_ddl("A", [("ix_a", "index", "CREATE INDEX ix_a ...")])
+    store.save_deferred_ddl("B", [("ix_b", "index", "CREATE INDEX ix_b ..."),
+                                  ("fk_b", "constraint", "ALTER TABLE B ...")])
+    store.deferred_ddl_done("B", "ix_b")
+    assert store.get_deferred_ddl() == {
+        "A": [("ix_a", "index", "CREATE INDEX ix_a ...")],
+        "B": [("fk_b", "constraint", "ALTER TABLE B ...")],
+    }
+
+    store.reset(tables=None, paquet=10, exclude=None)
+    assert store.get_deferred_ddl() == {}
+    store.close()
@@ -0,0 +1,81 @@
+import datetime
+import decimal
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from migrations import checksums
+
+
+def get_table(tmpdir, name):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join(name))
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("value", sa.Unicode(10)),
+                     sa.Column("created", sa.DateTime))
+    table.create(engine)
+    engine.execute(table.insert(), [
+        {"id": i, "value": u"v%s" % i,
+         "created": datetime.datetime(2013, 1, 1, 0, 0, i % 60)}
+        for i in range(1, 101)
+    ])
+    return engine, table
+
+
+def test_normalize():
+    assert checksums.normalize(None) == "\\N"
+    assert checksums.normalize(True) == "1"
+    assert checksums.normalize(10L) == checksums.normalize(10) == \
+        checksums.normalize(10.0) == checksums.normalize(
+            decimal.Decimal("10.00")) == "10"
+    assert checksums.normalize(decimal.Decimal("1.50")) == \
+        checksums.normalize(1.5) == "1.5"
+    assert checksums.normalize(u"\xe0") == "\xc3\xa0"
+    assert checksums.normalize(datetime.date(2013, 1, 2)) == "2013-01-02"
+    assert checksums.hash_row([1, u"a"]) == checksums.hash_row([1L, "a"])
+    assert checksums.hash_row([1, None]) != checksums.hash_row([1, ""])
+
+
+@pytest.mark.parametrize("server", [True, False])
+def test_get_checksum(tmpdir, server):
+    engine_a, table = get_table(tmpdir, "a.db")
+    engine_b, table = get_table(tmpdir, "b.db")
+    conn_a, conn_b = engine_a.connect(), engine_b.connect()
+
+    checksum = checksums.get_checksum(conn_a, table, table.c.id, 10, 20,
+                                      server=server)
+    assert checksum[:3] == (10, 10, 19)
+    assert checksum == checksums.get_checksum(conn_b, table, table.c.id, 10,
+                                              20, server=server)
+
+    conn_b.execute(table.update().where(table.c.id == 15).values(value=None))
+    assert checksum != checksums.get_checksum(conn_b, table, table.c.id, 10,
+                                              20, server=server)
+    # the other ranges (and the records order) do not matter
+    assert checksums.get_checksum(conn_a, table, table.c.id, 20, None,
+                                  server=server) == \
+        checksums.get_checksum(conn_b, table, table.c.id, 20, None,
+                               server=server)
+
+    whole = checksums.get_checksum(conn_a, table, None, server=server)
+    assert whole[:3] == (100, None, None)
+
+    hashes = checksums.get_row_hashes(conn_b, table, table.c.id, 10, 20)
+    assert sorted(hashes) == range(10, 20)
+    row = conn_b.execute(table.select().where(table.c.id == 15)).fetchone()
+    assert hashes[15] == checksums.hash_row(row)
+
+
+def test_server_expression():
+    assert checksums.use_server_checksums(postgresql.dialect(),
+                                          postgresql.dialect())
+    sqlite = sa.create_engine("sqlite://").dialect
+    assert not checksums.use_server_checksums(postgresql.dialect(), sqlite)
+
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True))
+    conn = type("Conn", (object,), {"dialect": postgresql.dialect()})()
+    assert checksums.get_server_expression(conn, list(table.columns)) == (
+        "COALESCE(SUM(('x' || SUBSTR(MD5(CAST(ROW(\"id\") AS TEXT)), 1, 16))"
+        "::BIT(64)::BIGINT), 0)")
@@ -0,0 +1,37 @@
+from migrations import columnar
+from migrations import pkmaps
+
+
+def get_paquet():
+    records = [{"id": 1, "parent": 10, "name": u"a"}, {},
+               {"id": 2, "parent": None, "name": u"b"},
+               {"id": 3, "parent": 11, "name": u"c"}]
+    return columnar.Paquet.from_records(records, ["id", "parent", "name"])
+
+
+def test_paquet():
+    paquet = get_paquet()
+    # empty records are skipped
+    assert len(paquet) == 3
+    assert paquet["parent"] == [10, None, 11]
+    assert "name" in paquet and "other" not in paquet
+    assert paquet.rows(["id", "name"]) == [(1, u"a"), (2, u"b"), (3, u"c")]
+    assert paquet.to_dicts()[0] == {"id": 1, "parent": 10, "name": u"a"}
+
+    projected = paquet.project(["name"])
+    assert projected.keys == ["name"] and len(projected) == 3
+    assert list(projected) == [{"name": u"a"}, {"name": u"b"}, {"name": u"c"}]
+    assert columnar.Paquet.from_records([{}], []).rows() == []
+    assert columnar.Paquet([], {}, 2).rows() == [(), ()]
+
+
+def test_paquet_remap():
+    for pk_map in ({10: 100}, pkmaps.create_pk_map("DICT"),
+                   pkmaps.create_pk_map("SQLITE")):
+        pk_map.update({10: 100})
+        paquet = get_paquet()
+        paquet.remap("parent", pk_map)
+        # values missing from the map (and NULLs) are kept
+        assert paquet["parent"] == [100, None, 11]
+        if isinstance(pk_map, pkmaps.PKMap):
+            pk_map.close()
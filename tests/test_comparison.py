@@ -0,0 +1,135 @@
+import json
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from migrations import comparison
+
+
+def get_table(tmpdir, name, records):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join(name))
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Unicode(10), primary_key=True),
+                     sa.Column("value", sa.Integer, nullable=True))
+    table.create(engine)
+    engine.execute(table.insert(), records)
+    return engine.connect(), table
+
+
+def test_merge_join():
+    source = [(1, "a"), (2, "b"), (4, "d")]
+    destination = [(2, "B"), (3, "c"), (4, "d"), (5, "e")]
+    assert list(comparison.merge_join(iter(source), iter(destination))) == [
+        (1, "a", None), (2, "b", "B"), (3, None, "c"), (4, "d", "d"),
+        (5, None, "e")
+    ]
+
+    with pytest.raises(comparison.ComparisonError):
+        list(comparison.merge_join(iter([(2, "b"), (1, "a")]), iter([])))
+
+
+def test_compare_tables(tmpdir):
+    records = [{"id": u"r%03d" % i, "value": i if i % 3 else None}
+               for i in range(100)]
+    source_conn, source_table = get_table(tmpdir, "source.db", records)
+    dest_conn, dest_table = get_table(tmpdir, "dest.db", records[10:])
+    dest_conn.execute(dest_table.update().where(
+        dest_table.c.id == u"r050").values(value=None))
+    dest_conn.execute(dest_table.insert(), [{"id": u"X", "value": 1},
+                                            {"id": u"z", "value": 2}])
+
+    path = str(tmpdir.join("diff.jsonl"))
+    diff_writer = comparison.DiffWriter(path)
+    summary = comparison.compare_tables(source_conn, source_table, dest_conn,
+                                        dest_table, diff_writer, batch_size=7)
+    diff_writer.close()
+    assert summary == {"source": 100, "destination": 92, "equal": 89,
+                       "missing": 10, "extra": 2, "changed": 1}
+
+    lines = [json.loads(line) for line in open(path)]
+    assert [(line["type"], line["pk"]) for line in lines] == \
+        [("extra", "X")] + [("missing", "r%03d" % i) for i in range(10)] + \
+        [("changed", "r050"), ("extra", "z")]
+    assert lines[11]["source"] == {"id": "r050", "value": 50}
+    assert lines[11]["destination"] == {"id": "r050", "value": None}
+
+    # a missing destination table
+    assert comparison.compare_tables(source_conn, source_table, None,
+                                     None)["missing"] == 100
+
+
+def test_get_order_by():
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Unicode(10), primary_key=True),
+                     sa.Column("value", sa.Integer, nullable=True))
+    dialect = postgresql.dialect()
+    stmt = sa.select([table.c.id]).order_by(
+        comparison.get_order_by(dialect, table.c.id),
+        comparison.get_order_by(dialect, table.c.value))
+    assert str(stmt.compile(dialect=dialect)).endswith(
+        'ORDER BY "A".id COLLATE "C", "A".value ASC NULLS FIRST')
+
+
+def test_compare_tables_range(tmpdir):
+    records = [{"id": u"r%03d" % i, "value": i} for i in range(100)]
+    source_conn, source_table = get_table(tmpdir, "source.db", records)
+    dest_conn, dest_table = get_table(tmpdir, "dest.db", records[10:])
+
+    summary = comparison.compare_tables(source_conn, source_table, dest_conn,
+                                        dest_table, pk_range=(u"r005", u"r020"))
+    assert summary == {"source": 15, "destination": 10, "equal": 10,
+                       "missing": 5, "extra": 0, "changed": 0}
+    assert comparison.add_summary(summary, {"missing": 1, "ranges": 1}) == \
+        {"source": 15, "destination": 10, "equal": 10, "missing": 6,
+         "extra": 0, "changed": 0, "ranges": 1}
+
+
+def test_compare_tables_key_maps(tmpdir):
+    # integer keys re-mapped by the migration (source id -> destination id)
+    def get_int_table(name, records):
+        engine = sa.create_engine("sqlite:///%s" % tmpdir.join(name))
+        table = sa.Table("B", sa.MetaData(),
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("parent", sa.Integer, nullable=True),
+                         sa.Column("value", sa.Integer))
+        table.create(engine)
+        engine.execute(table.insert(), records)
+        return engine.connect(), table
+
+    source_conn, source_table = get_int_table("source.db", [
+        {"id": i * 10, "parent": i * 10 if i % 2 else None, "value": i}
+        for i in range(1, 21)])
+    # the last record was not migrated and the destination has an extra one
+    pk_map = dict((i * 10, 21 - i) for i in range(1, 20))
+    dest_conn, dest_table = get_int_table("dest.db", [
+        {"id": 21 - i, "parent": 21 - i if i % 2 else None, "value": i}
+        for i in range(1, 20)] + [{"id": 100, "parent": None, "value": 0}])
+    dest_conn.execute(dest_table.update().where(dest_table.c.id == 20).values(
+        value=-1))
+
+    path = str(tmpdir.join("diff.jsonl"))
+    diff_writer = comparison.DiffWriter(path)
+    summary = comparison.compare_tables(
+        source_conn, source_table, dest_conn, dest_table, diff_writer,
+        batch_size=7, key_maps={"id": pk_map, "parent": pk_map})
+    diff_writer.close()
+    assert summary == {"source": 20, "destination": 20, "equal": 18,
+                       "missing": 1, "extra": 1, "changed": 1}
+    lines = [json.loads(line) for line in open(path)]
+    assert [(line["type"], line["pk"]) for line in lines] == \
+        [("changed", 20), ("missing", None)]
+    assert lines[0]["source"] == {"id": 20, "parent": 20, "value": 1}
+    assert lines[1]["source"]["id"] == 200
+
+    # without map only the counts and checksums are compared
+    summary = comparison.compare_checksums_only(
+        source_conn, source_table, dest_conn, dest_table, ["id", "parent"])
+    assert (summary["comparable"], summary["equal"]) == (False, 0)
+    dest_conn.execute(dest_table.delete().where(dest_table.c.id == 100))
+    dest_conn.execute(dest_table.update().where(dest_table.c.id == 20).values(
+        value=1))
+    dest_conn.execute(dest_table.insert(), {"id": 1, "value": 20})
+    summary = comparison.compare_checksums_only(
+        source_conn, source_table, dest_conn, dest_table, ["id", "parent"])
+    assert (summary["comparable"], summary["equal"]) == (False, 20)
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from migrations import executors
+
+
+def test_executor():
+    executor = executors.Executor(workers=2)
+    threads = set()
+
+    def job(i):
+        threads.add(threading.current_thread())
+        return i * 2
+
+    tasks = executor.map(job, range(20))
+    assert executors.wait_all(tasks) == [i * 2 for i in range(20)]
+    # the jobs only ran on the executor workers
+    assert len(threads) <= 2
+
+    executor.shutdown()
+
+
+def test_task_errors_and_callbacks():
+    executor = executors.Executor(workers=1)
+    finished = []
+
+    def fail():
+        raise ValueError("boom")
+
+    task = executor.submit(fail)
+    task.add_done_callback(finished.append)
+
+    with pytest.raises(ValueError):
+        task.result()
+    assert isinstance(task.exception(), ValueError)
+    assert finished == [task]
+
+    # callbacks added after the task finished are called immediately
+    task.add_done_callback(finished.append)
+    assert finished == [task, task]
+
+    executor.shutdown()
+
+
+def test_async_migration_close(tmpdir):
+    from migrations import migrator
+    source = "dbms:::sqlite:///%s" % tmpdir.join("source.db")
+    destination = "dbms:::sqlite:///%s" % tmpdir.join("dest.db")
+
+    with migrator.AsyncMigration(source, destination) as migration:
+        migration.migrate().result()
+        assert len(migration.executor._threads) == 1
+    # the executor created by the migration is shut down
+    assert migration.executor._threads == []
+
+    # shared executors are left running
+    executor = executors.Executor(workers=1)
+    migration = migrator.AsyncMigration(source, destination,
+                                        executor=executor)
+    migration.migrate().result()
+    migration.close()
+    assert len(executor._threads) == 1
+    executor.shutdown()
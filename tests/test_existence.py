@@ -0,0 +1,129 @@
+import decimal
+
+import pytest
+import sqlalchemy as sa
+
+from migrations import existence
+
+
+def get_table(tmpdir, keys, key_type=sa.Integer):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join("dest.db"))
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", key_type, primary_key=True,
+                               autoincrement=False))
+    table.create(engine)
+    engine.execute(table.insert(), [{"id": key} for key in keys])
+    return engine, table
+
+
+@pytest.mark.parametrize("kind", ["SET", "SORTED_ARRAY", "BLOOM"])
+def test_indexes(kind):
+    index = existence.create_index(kind, range(0, 1000, 2), 500, True)
+    assert index.kind == kind
+    assert len(index) == 500
+
+    found = index.contains_many(range(10) + [decimal.Decimal(4)])
+    if index.exact:
+        assert found == set([0, 2, 4, 6, 8, decimal.Decimal(4)])
+    else:
+        # the Bloom filter may have false positives only
+        assert set([0, 2, 4, 6, 8]) <= found
+
+    index.add_many([1001])
+    assert 1001 in index and len(index) == 501
+
+
+def test_sorted_array_index():
+    # unsorted keys are sorted
+    index = existence.SortedArrayIndex([5, 3, 9, 1])
+    assert index.contains_many([1, 2, 3, 9, 10, u"3", None]) == set([1, 3, 9])
+    index.add_many([4, 3])
+    header, data = index.get_state()
+    assert list(index._values) == [1, 3, 4, 5, 9]
+
+
+def test_bloom_index():
+    index = existence.BloomIndex(10000, 0.01)
+    index.add_many(u"key%s" % i for i in range(10000))
+    assert index.contains_many(u"key%s" % i for i in range(10000)) == \
+        set(u"key%s" % i for i in range(10000))
+
+    positives = index.contains_many(u"other%s" % i for i in range(10000))
+    assert len(positives) < 300
+
+
+@pytest.mark.parametrize("kind", ["SET", "SORTED_ARRAY", "BLOOM"])
+def test_index_builder(tmpdir, kind):
+    engine, table = get_table(tmpdir, range(0, 100, 2))
+    conn = engine.connect()
+    directory = tmpdir.mkdir("indexes")
+    builder = existence.IndexBuilder(kind, directory=str(directory),
+                                     max_params=7)
+    keys = range(20) + [200]
+    assert builder.contains_many(conn, table, table.c.id, keys) == \
+        set(range(0, 20, 2))
+    index = builder.get(conn, table, table.c.id)
+    assert index.kind == kind and len(index) == 50
+
+    # the keys inserted are added to the index
+    conn.execute(table.insert(), [{"id": 200}])
+    builder.add(table, [200])
+    assert 200 in builder.contains_many(conn, table, table.c.id, keys)
+
+    # the saved index is loaded by the next runs if the table did not change
+    builder.save()
+    assert directory.join("A.pkindex").check()
+    signature = existence.get_signature(conn, table, table.c.id)
+    assert signature == {"rows": 51, "min_pk": 0, "max_pk": 200,
+                         "pk_sum": sum(range(0, 100, 2)) + 200}
+    saved = existence.load_index(builder.get_path("A"), signature)
+    assert saved.kind == kind and len(saved) == 51
+    assert existence.load_index(builder.get_path("A"),
+                                dict(signature, rows=52)) is None
+    assert existence.load_index(builder.get_path("B"), signature) is None
+
+    builder = existence.IndexBuilder(kind, directory=str(directory))
+    assert builder.contains_many(conn, table, table.c.id, keys) == \
+        set(range(0, 20, 2) + [200])
+    conn.close()
+
+
+@pytest.mark.parametrize("kind", ["SET", "SORTED_ARRAY"])
+def test_index_builder_changed(tmpdir, kind):
+    engine, table = get_table(tmpdir, range(10))
+    conn = engine.connect()
+    directory = str(tmpdir.mkdir("indexes"))
+    builder = existence.IndexBuilder(kind, directory=directory)
+    builder.get(conn, table, table.c.id)
+    builder.save()
+
+    # same number of records: the changed signature is not loaded
+    conn.execute(table.delete().where(table.c.id == 3))
+    conn.execute(table.insert(), [{"id": 20}])
+    builder = existence.IndexBuilder(kind, directory=directory)
+    assert builder.contains_many(conn, table, table.c.id, [3, 20]) == \
+        set([20])
+    builder.save()
+
+    # same signature (count, min, max and sum): the positives of the loaded
+    # index are confirmed by the database
+    conn.execute(table.delete().where(table.c.id.in_([4, 9])))
+    conn.execute(table.insert(), [{"id": 3}, {"id": 10}])
+    builder = existence.IndexBuilder(kind, directory=directory)
+    found = builder.contains_many(conn, table, table.c.id, [4, 5])
+    assert "A" in builder._loaded
+    assert found == set([5])
+    conn.close()
+
+
+def test_index_builder_auto(tmpdir):
+    engine, table = get_table(tmpdir, [u"a", u"b"], sa.Unicode(10))
+    builder = existence.IndexBuilder()
+    conn = engine.connect()
+    assert builder.contains_many(conn, table, table.c.id, [u"a", u"c"]) == \
+        set([u"a"])
+    assert builder.get(conn, table, table.c.id).kind == "SET"
+
+    with pytest.raises(ValueError):
+        existence.create_index("UNKNOWN", [], 0, True)
+    conn.close()
@@ -0,0 +1,46 @@
+import pytest
+
+from migrations import graph
+
+
+def test_get_levels():
+    nodes = ["A", "B", "C", "D", "E"]
+    dependencies = {"B": set(["A"]), "C": set(["A", "B", "C", "X"]),
+                    "D": set(["A"])}
+
+    levels, left = graph.get_levels(nodes, dependencies)
+    assert levels == [["A", "E"], ["B", "D"], ["C"]]
+    assert left == []
+
+    dependencies["A"] = set(["C"])
+    levels, left = graph.get_levels(nodes, dependencies)
+    assert levels == [["E"]]
+    assert left == ["A", "B", "C", "D"]
+
+
+def test_find_cycles():
+    nodes = ["A", "B", "C", "D", "E", "F"]
+    dependencies = {"A": set(["B"]), "B": set(["C"]), "C": set(["A"]),
+                    "D": set(["E", "D"]), "E": set(["D"]), "F": set(["A"])}
+
+    assert graph.find_cycles(nodes, dependencies) == [["A", "B", "C"],
+                                                      ["D", "E"]]
+    assert graph.find_cycles(nodes, {"A": set(["A"])}) == []
+
+
+def test_break_cycles():
+    nodes = ["A", "B", "C"]
+    dependencies = {"A": set(["B"]), "B": set(["A"]), "C": set(["B"])}
+
+    new_dependencies, dropped = graph.break_cycles(
+        nodes, dependencies, {"A": set(["B"])}
+    )
+    assert dropped == [("A", "B")]
+    assert graph.get_levels(nodes, new_dependencies) == ([["A"], ["B"], ["C"]],
+                                                         [])
+    # the original graph is not modified
+    assert dependencies["A"] == set(["B"])
+
+    with pytest.raises(graph.CycleError) as exc:
+        graph.break_cycles(nodes, dependencies, {"C": set(["B"])})
+    assert exc.value.cycles == [["A", "B"]]
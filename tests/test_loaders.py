@@ -0,0 +1,185 @@
+import datetime
+
+import pytest
+from mock import Mock
+import sqlalchemy as sa
+
+from migrations import columnar
+from migrations import loaders
+
+
+def get_table(tmpdir):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join("dest.db"))
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("name", sa.Unicode(10)),
+                     sa.Column("created", sa.DateTime))
+    table.create(engine)
+    return engine, table
+
+
+def get_records(start, stop):
+    return [{"id": i, "name": u"n%s" % i,
+             "created": datetime.datetime(2013, 1, 1, 0, 0, i % 60)}
+            for i in range(start, stop)]
+
+
+@pytest.mark.parametrize("name", ["SQLITE", "MULTI_VALUES", "GENERIC"])
+def test_loaders(tmpdir, name):
+    engine, table = get_table(tmpdir)
+    conn = engine.connect()
+    loader = loaders.get_loader(conn, table, name)
+    assert loader.name == name
+
+    # many statements are needed to insert all the records at once
+    loader.max_params = 30
+    loader.load(get_records(0, 25))
+    # inside an explicit transaction the loader does not commit
+    trans = conn.begin()
+    loader.load(get_records(25, 50))
+    trans.rollback()
+
+    rows = engine.execute(table.select().order_by(table.c.id)).fetchall()
+    assert [dict(row) for row in rows] == get_records(0, 25)
+
+    # columnar paquets are loaded as well
+    keys = ["id", "name", "created"]
+    loader.load_paquet(columnar.Paquet.from_records(get_records(25, 50), keys))
+    loader.load_paquet(columnar.Paquet.from_records([], keys))
+    rows = engine.execute(table.select().order_by(table.c.id)).fetchall()
+    assert [dict(row) for row in rows] == get_records(0, 50)
+    conn.close()
+
+
+def test_get_loader(tmpdir):
+    engine, table = get_table(tmpdir)
+    conn = engine.connect()
+    assert isinstance(loaders.get_loader(conn, table), loaders.SQLiteLoader)
+    with pytest.raises(ValueError):
+        loaders.get_loader(conn, table, "COPY")
+    with pytest.raises(ValueError):
+        loaders.get_loader(conn, table, "UNKNOWN")
+
+    loader = loaders.get_loader(conn, table)
+    with pytest.raises(sa.exc.IntegrityError):
+        loader.load(get_records(0, 2) + get_records(1, 2))
+    conn.close()
+
+
+def test_returning_loader(tmpdir):
+    engine, table = get_table(tmpdir)
+    conn = engine.connect()
+    # sqlite has no RETURNING: the AUTO loader is the same with returning
+    assert not loaders.ReturningLoader.supports(conn, table)
+    assert isinstance(loaders.get_loader(conn, table, returning=True),
+                      loaders.SQLiteLoader)
+    with pytest.raises(ValueError):
+        loaders.get_loader(conn, table, "RETURNING")
+    conn.close()
+
+    # PostgreSQL like connection: the new ids are taken from the primary key
+    # sequence and inserted with the records
+    from sqlalchemy.dialects import postgresql
+    dialect = postgresql.dialect()
+    dialect.implicit_returning = True
+    conn = Mock(dialect=dialect)
+
+    def execute(stmt, *args, **params):
+        sql = getattr(stmt, "text", "")
+        if "pg_get_serial_sequence" in sql:
+            assert params == {"table": '"A"', "column": "id"}
+            return Mock(scalar=Mock(return_value="A_id_seq"))
+        if "nextval" in sql:
+            assert params == {"sequence": "A_id_seq", "n": 25}
+            return [(i,) for i in range(200, 225)]
+        return Mock()
+    conn.execute.side_effect = execute
+
+    assert loaders.get_loader(conn, table).name == "COPY"
+    loader = loaders.get_loader(conn, table, returning=True)
+    assert loader.name == "RETURNING"
+
+    loader.max_params = 30
+    records = [dict(name=r["name"], created=r["created"])
+               for r in get_records(0, 25)]
+    conn.execute.reset_mock()
+    assert loader.load(records) == range(200, 225)
+    # nextval and 3 INSERT ... VALUES of 10 rows
+    assert conn.execute.call_count == 4
+    stmt = conn.execute.call_args[0][0]
+    assert [row["id"] for row in stmt.parameters] == range(220, 225)
+    assert [row["name"] for row in stmt.parameters] == \
+        [r["name"] for r in records[20:]]
+    # the records are not changed
+    assert "id" not in records[0]
+
+    # without sequence: one INSERT ... RETURNING per record
+    loader.sequence = None
+    conn.execute.reset_mock()
+    conn.execute.side_effect = lambda stmt, params: Mock(
+        scalar=Mock(return_value=params["name"]))
+    assert loader.load(records) == [r["name"] for r in records]
+    assert conn.execute.call_count == 25
+    stmt = conn.execute.call_args[0][0]
+    assert str(stmt.compile(dialect=dialect)).endswith("RETURNING \"A\".id")
+
+
+def test_format_csv_value():
+    assert loaders.format_csv_value(None) == ''
+    assert loaders.format_csv_value(u'a "b"') == '"a ""b"""'
+    assert loaders.format_csv_value(True) == '"t"'
+    assert loaders.format_csv_value(datetime.date(2013, 1, 2)) == '"2013-01-02"'
+    assert loaders.format_csv_value(1.5) == '"1.5"'
+
+
+def test_format_csv_value_float():
+    # the values are not rounded
+    for value in (0.1 + 0.2, 1234567.891234567, 1e-20, -2.0 / 3):
+        assert float(loaders.format_csv_value(value).strip('"')) == value
+
+
+def test_get_upsert_statement(tmpdir):
+    engine, table = get_table(tmpdir)
+    conn = engine.connect()
+    keys = ["id", "name", "created"]
+    stmt = loaders.get_upsert_statement(conn, table, keys)
+    assert str(stmt).endswith(
+        'ON CONFLICT ("id") DO UPDATE SET "name" = EXCLUDED."name", '
+        '"created" = EXCLUDED."created"')
+    conn.execute(stmt, [{"p0": 1, "p1": u"a", "p2": None},
+                        {"p0": 1, "p1": u"b", "p2": None}])
+    assert conn.execute(sa.select([table.c.name])).fetchall() == [(u"b",)]
+    conn.close()
+
+    from sqlalchemy.dialects import mysql, postgresql
+    conn = Mock(dialect=postgresql.dialect())
+    assert str(loaders.get_upsert_statement(conn, table, keys)).endswith(
+        'ON CONFLICT ("id") DO UPDATE SET "name" = EXCLUDED."name", '
+        '"created" = EXCLUDED."created"')
+    conn = Mock(dialect=mysql.dialect())
+    assert str(loaders.get_upsert_statement(conn, table, keys)).endswith(
+        'ON DUPLICATE KEY UPDATE `name` = VALUES(`name`), '
+        '`created` = VALUES(`created`)')
+
+
+def test_get_upsert_statement_foreign_keys(tmpdir):
+    # the upserted records are not deleted: the records linked to them keep
+    # their values
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join("dest.db"))
+    conn = engine.connect()
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY, name TEXT, "
+                 "note TEXT)")
+    conn.execute("CREATE TABLE child (id INTEGER PRIMARY KEY, parent_id "
+                 "INTEGER REFERENCES parent (id) ON DELETE CASCADE)")
+    conn.execute("INSERT INTO parent VALUES (1, 'a', 'kept')")
+    conn.execute("INSERT INTO child VALUES (1, 1)")
+
+    table = sa.Table("parent", sa.MetaData(), autoload=True,
+                     autoload_with=conn)
+    stmt = loaders.get_upsert_statement(conn, table, ["id", "name"])
+    conn.execute(stmt, [{"p0": 1, "p1": u"b"}, {"p0": 2, "p1": u"c"}])
+    assert conn.execute("SELECT * FROM parent ORDER BY id").fetchall() == \
+        [(1, u"b", u"kept"), (2, u"c", None)]
+    assert conn.execute("SELECT * FROM child").fetchall() == [(1, 1)]
+    conn.close()
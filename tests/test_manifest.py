@@ -0,0 +1,59 @@
+import datetime
+
+import sqlalchemy as sa
+
+from migrations import manifest
+
+
+def get_table():
+    engine = sa.create_engine("sqlite://")
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("name", sa.Unicode(10)),
+                     sa.Column("updated", sa.DateTime))
+    table.create(engine)
+    conn = engine.connect()
+    conn.execute(table.insert(), [
+        {"id": i, "name": u"n%s" % i,
+         "updated": datetime.datetime(2013, 1, i)}
+        for i in range(1, 11)
+    ])
+    return conn, table
+
+
+def test_get_fingerprint():
+    conn, table = get_table()
+    assert manifest.get_fingerprint(conn, table) == {
+        "rows": 10, "max_pk": u"10", "max_updated": None, "checksum": None}
+
+    fingerprint = manifest.get_fingerprint(conn, table, "updated", True)
+    assert fingerprint["max_updated"] == u"2013-01-10T00:00:00"
+    assert fingerprint["checksum"] is not None
+
+    # a change that only the checksum sees
+    conn.execute(table.update().where(table.c.id == 2).values(name=u"x"))
+    changed = manifest.get_fingerprint(conn, table, "updated", True)
+    assert changed["checksum"] != fingerprint["checksum"]
+    del changed["checksum"], fingerprint["checksum"]
+    assert changed == fingerprint
+
+
+def test_manifest_store(tmpdir):
+    path = str(tmpdir.join("manifest.json"))
+    conn, table = get_table()
+    source = manifest.get_fingerprint(conn, table, "updated")
+
+    store = manifest.ManifestStore(path)
+    assert store.get("A") is None
+    assert not store.is_unchanged("A", source, None)
+
+    store.set("A", source, None)
+    store.save()
+
+    store = manifest.ManifestStore(path)
+    assert store.is_unchanged("A", source, None)
+    assert not store.is_unchanged("A", source, source)
+
+    conn.execute(table.insert(), {"id": 11, "name": u"new"})
+    assert not store.is_unchanged(
+        "A", manifest.get_fingerprint(conn, table, "updated"), None)
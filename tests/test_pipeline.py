@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+from mock import Mock
+
+from migrations import pipeline
+
+
+def make_table(name, parents=()):
+    table = Mock()
+    table.name = name
+    table.foreign_keys = []
+    for parent in parents:
+        fk = Mock()
+        fk.column.table = parent
+        table.foreign_keys.append(fk)
+    return table
+
+
+class FakeDestination(object):
+    def __init__(self):
+        self.dumped = []
+        self.lock = threading.Lock()
+
+    def dump(self, records, table):
+        time.sleep(0.01)
+        with self.lock:
+            self.dumped.append((table.name, records))
+
+
+def test_pipeline_order():
+    parent = make_table("parent")
+    child = make_table("child", [parent])
+    destination = FakeDestination()
+    done = []
+
+    pipe = pipeline.Pipeline(destination, writers=3, max_paquets=2)
+    for i in range(3):
+        pipe.put([{"id": i}], parent)
+    pipe.put([{"id": 10}], child, lambda: done.append("child"))
+    pipe.put(None, parent, lambda: done.append("parent"))
+    pipe.close()
+
+    # the parent paquets are dumped in order and before the child ones
+    assert destination.dumped == [
+        ("parent", [{"id": 0}]),
+        ("parent", [{"id": 1}]),
+        ("parent", [{"id": 2}]),
+        ("child", [{"id": 10}]),
+    ]
+    assert sorted(done) == ["child", "parent"]
+
+
+def test_pipeline_errors():
+    destination = Mock()
+    destination.dump.side_effect = ValueError("boom")
+
+    pipe = pipeline.Pipeline(destination, writers=1)
+    pipe.put([{"id": 1}], make_table("A"))
+    with pytest.raises(ValueError):
+        pipe.close()
+
+
+def test_get_records_size():
+    assert pipeline.get_records_size([{"a": "abc", "b": 1}, ("xy", None)]) == 21
@@ -0,0 +1,95 @@
+import decimal
+
+import pytest
+
+from migrations import pkmaps
+
+
+@pytest.mark.parametrize("store", ["DICT", "SQLITE", "AUTO"])
+def test_pk_maps(tmpdir, store):
+    pk_map = pkmaps.create_pk_map(store, directory=str(tmpdir))
+    pk_map.update({5: 1, 9: 2})
+    pk_map.set_many([(12, 3)])
+    pk_map[13] = 4
+
+    assert len(pk_map) == 4
+    assert pk_map.get_many([5, 12, 99]) == {5: 1, 12: 3}
+    assert pk_map[9] == 2
+    assert pk_map.get(99, 99) == 99
+    assert 13 in pk_map and 99 not in pk_map
+    assert pk_map == {5: 1, 9: 2, 12: 3, 13: 4}
+    with pytest.raises(KeyError):
+        pk_map[99]
+
+    pk_map.close()
+    assert tmpdir.listdir() == []
+
+
+def test_array_pk_map():
+    pk_map = pkmaps.ArrayPKMap(min_size=100)
+    pk_map.update([(1000 + i, i + 1) for i in range(50)])
+    assert pk_map.get_many([1000, decimal.Decimal(1049), 1050, 5]) == {
+        1000: 1, decimal.Decimal(1049): 50
+    }
+
+    # too sparse or not integers
+    for pairs in [[(5000, 1)], [(u"a", 1)], [(1100, 0)]]:
+        with pytest.raises(pkmaps.NotDense):
+            pk_map.set_many(pairs)
+    assert len(pk_map) == 50
+
+    # keys lower than the first one
+    pk_map.set_many([(990, 100)])
+    assert pk_map.get_many([990, 995, 1000, 1049]) == {990: 100, 1000: 1,
+                                                        1049: 50}
+    assert sorted(pk_map.items())[:2] == [(990, 100), (1000, 1)]
+
+
+def test_array_pk_map_partitions():
+    # the partitions of a table write their keys in any order
+    pk_map = pkmaps.ArrayPKMap(min_size=100)
+    for lower in (750, 500, 0, 250):
+        pk_map.update([(i, i + 1) for i in range(lower, lower + 250)])
+    assert len(pk_map) == 1000
+    assert dict(pk_map.items()) == dict((i, i + 1) for i in range(1000))
+
+    # the first partition written alone is too sparse for a reserved range
+    pk_map = pkmaps.ArrayPKMap(min_size=100)
+    with pytest.raises(pkmaps.NotDense):
+        pk_map.set_many([(0, 1), (999, 2)])
+    pk_map.reserve(0, 999, 1000)
+    pk_map.set_many([(0, 1), (999, 2)])
+    assert len(pk_map) == 2
+    with pytest.raises(pkmaps.NotDense):
+        pk_map.reserve(0, 10 ** 6, 1000)
+
+    pk_map = pkmaps.AutoPKMap()
+    pk_map.reserve(1, 10, 10)
+    pk_map.update([(10, 1), (1, 2)])
+    assert isinstance(pk_map.store, pkmaps.ArrayPKMap)
+    pk_map.reserve(1, 10 ** 9, 10)
+    assert isinstance(pk_map.store, pkmaps.SQLitePKMap)
+    assert sorted(pk_map.items()) == [(1, 2), (10, 1)]
+    pk_map.close()
+
+
+def test_auto_pk_map_spill(tmpdir):
+    pk_map = pkmaps.AutoPKMap(max_memory=3, directory=str(tmpdir))
+    pk_map.update([(1, 10), (2, 20)])
+    assert isinstance(pk_map.store, pkmaps.ArrayPKMap)
+
+    pk_map.update([(3, 30), (4, 40)])
+    assert isinstance(pk_map.store, pkmaps.SQLitePKMap)
+    assert sorted(pk_map.items()) == [(1, 10), (2, 20), (3, 30), (4, 40)]
+
+    pk_map = pkmaps.AutoPKMap(directory=str(tmpdir))
+    pk_map.update([(u"a", 1)])
+    assert isinstance(pk_map.store, pkmaps.SQLitePKMap)
+    assert pk_map.get_many([u"a", u"b"]) == {u"a": 1}
+    pk_map.close()
+
+
+def test_get_many():
+    assert pkmaps.get_many({1: 2, 3: 4}, [1, 5]) == {1: 2}
+    with pytest.raises(ValueError):
+        pkmaps.create_pk_map("UNKNOWN")
@@ -0,0 +1,50 @@
+import pytest
+import sqlalchemy as sa
+
+from migrations import reflection
+
+
+def create_tables(engine):
+    meta = sa.MetaData()
+    sa.Table("A", meta, sa.Column("id", sa.Integer, primary_key=True))
+    sa.Table("B", meta,
+             sa.Column("id", sa.Integer, primary_key=True),
+             sa.Column("a_id", sa.Integer, sa.ForeignKey("A.id")))
+    meta.create_all(engine)
+
+
+def test_reflection_cache(tmpdir):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join("test.db"))
+    create_tables(engine)
+
+    cache = reflection.ReflectionCache()
+    assert cache.get_table_names(engine) == set(["A", "B"])
+
+    cache.reflect(engine)
+    table = cache.get_table(engine, "B")
+    assert [col.name for col in table.columns] == ["id", "a_id"]
+    # tables are reflected only once
+    assert cache.get_table(engine, "B") is table
+
+    with pytest.raises(sa.exc.NoSuchTableError):
+        cache.get_table(engine, "C")
+
+    sa.Table("C", sa.MetaData(), sa.Column("id", sa.Integer)).create(engine)
+    assert not cache.has_table(engine, "C")
+    cache.invalidate(engine, "C")
+    assert cache.has_table(engine, "C")
+    assert cache.get_table(engine, "C").name == "C"
+
+
+def test_reflection_cache_persistence(tmpdir):
+    engine = sa.create_engine("sqlite:///%s" % tmpdir.join("test.db"))
+    create_tables(engine)
+    path = str(tmpdir.join("cache.pkl"))
+
+    cache = reflection.ReflectionCache(path)
+    cache.reflect(engine)
+    cache.save()
+
+    cache = reflection.ReflectionCache(path)
+    meta = cache.get_metadata(engine)
+    assert sorted(meta.tables) == ["A", "B"]
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from migrations import scheduling
+
+
+def test_get_tables_dependencies():
+    tables_order = ["A", "B", "C", "D"]
+    tables_fks = {
+        "B": {"a_id": ("A", "id")},
+        "C": {"a_id": ("A", "id"), "b_id": ("B", "id"), "c_id": ("C", "id")},
+        # D <-> A cycle: only the link to the table that comes first counts
+        "A": {"d_id": ("D", "id")},
+        "D": {"a_id": ("A", "id")},
+    }
+    dependencies = scheduling.get_tables_dependencies(tables_order, tables_fks)
+
+    assert dependencies == {
+        "A": set(),
+        "B": set(["A"]),
+        "C": set(["A", "B"]),
+        "D": set(["A"]),
+    }
+
+
+def test_run_dependency_graph_respects_dependencies():
+    nodes = ["A", "B", "C", "D", "E"]
+    dependencies = {
+        "A": set(),
+        "B": set(),
+        "C": set(["A"]),
+        "D": set(["A", "B"]),
+        "E": set(["D"]),
+    }
+    finished = []
+    lock = threading.Lock()
+
+    def task(node):
+        with lock:
+            for parent in dependencies[node]:
+                assert parent in finished
+        time.sleep(0.01)
+        with lock:
+            finished.append(node)
+
+    scheduling.run_dependency_graph(nodes, dependencies, task, workers=3)
+
+    assert sorted(finished) == nodes
+
+
+def test_run_dependency_graph_raises_errors():
+    started = []
+
+    def task(node):
+        started.append(node)
+        if node == "A":
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        scheduling.run_dependency_graph(
+            ["A", "B"], {"A": set(), "B": set(["A"])}, task, workers=2
+        )
+
+    assert started == ["A"]
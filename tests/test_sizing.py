@@ -0,0 +1,27 @@
+from migrations import sizing
+
+
+def test_paquet_sizer_grows_and_shrinks():
+    sizer = sizing.PaquetSizer(1000, target_seconds=1.0, max_bytes=1000000,
+                               min_size=100, max_size=5000)
+    assert int(sizer) == 1000
+
+    # fast paquets: the size doubles at most
+    assert sizer.update(1000, 1000, 0.01, 0.01) == 2000
+    assert sizer.update(2000, 2000, 0.01, 0.01) == 4000
+    assert sizer.update(4000, 4000, 0.01, 0.01) == 5000
+
+    # slow paquets: size to hit the target time
+    assert sizer.update(5000, 5000, 1.0, 1.5) == 2000
+
+    # wide records: size limited by max_bytes
+    assert sizer.update(2000, 10000000, 0.01, 0.01) == 200
+
+    # never below min_size
+    assert sizer.update(200, 200, 100.0, 0) == 100
+
+
+def test_paquet_sizer_not_adaptive():
+    sizer = sizing.PaquetSizer(1000, adaptive=False)
+    assert sizer.update(1000, 1000, 10.0, 10.0) == 1000
+    assert int(sizer) == 1000
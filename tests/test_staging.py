@@ -0,0 +1,131 @@
+import sqlalchemy as sa
+
+from migrations import columnar
+from migrations import staging
+
+
+def get_table():
+    engine = sa.create_engine("sqlite://")
+    table = sa.Table("A", sa.MetaData(),
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("name", sa.Unicode(10)),
+                     sa.Column("value", sa.Integer, nullable=True))
+    table.create(engine)
+    conn = engine.connect()
+    conn.execute(table.insert(), [{"id": 1, "name": u"a", "value": None},
+                                  {"id": 2, "name": u"b", "value": 2}])
+    return conn, table
+
+
+def get_paquet():
+    return columnar.Paquet.from_records([
+        {"id": 10, "name": u"a", "value": None},
+        {"id": 11, "name": u"b", "value": 3},
+        {"id": 12, "name": u"c", "value": None},
+        {},
+    ], ["id", "name", "value"])
+
+
+def test_staging_table():
+    conn, table = get_table()
+    staging_table = staging.StagingTable(conn, table)
+    assert staging_table.table.name == "migrations_staging_A"
+
+    staging_table.load(get_paquet())
+    # NULL values match each other
+    missing = staging_table.select_missing(["name", "value"])
+    assert sorted(record["id"] for record in missing) == [11, 12]
+    assert [record["id"] for record in
+            staging_table.select_missing(["id", "name", "value"])] == \
+        [10, 11, 12]
+
+    assert staging_table.insert_missing(["name", "value"],
+                                        ["name", "value"]) == 2
+    assert sorted(staging_table.get_pk_pairs("id", ["name", "value"])) == \
+        [(10, 1), (11, 3), (12, 4)]
+    assert staging_table.select_missing(["name", "value"]) == []
+
+    # the previous paquet is replaced
+    staging_table.load(columnar.Paquet.from_records(
+        [{"id": 20, "name": u"d", "value": 1}], ["id", "name", "value"]))
+    assert staging_table.insert_missing(["id", "name", "value"],
+                                        ["name", "value"]) == 1
+    assert conn.execute(sa.select([sa.func.count()]).select_from(table)
+                        ).scalar() == 5
+
+    staging_table.drop()
+    assert not conn.dialect.has_table(conn, staging_table.table.name)
+
+
+def test_get_staging_name():
+    dialect = sa.create_engine("sqlite://").dialect
+    assert staging.get_staging_name(dialect, "A") == "migrations_staging_A"
+
+    dialect.name = "mssql"
+    assert staging.get_staging_name(dialect, "A") == "#migrations_staging_A"
+
+
+def test_staging_table_recreate():
+    # the staging table of a table can be created again on the same
+    # connection, dropped or not (on PostgreSQL the sqlalchemy has_table
+    # checks don't see the temporary tables so they must be dropped with
+    # DROP TABLE IF EXISTS, see get_drop_statement)
+    conn, table = get_table()
+    for i in range(2):
+        staging_table = staging.StagingTable(conn, table)
+        staging_table.load(get_paquet())
+        staging_table.drop()
+        staging_table.drop()
+    staging.StagingTable(conn, table).load(get_paquet())
+    staging_table = staging.StagingTable(conn, table)
+    assert staging_table.select_missing(["id"]) == []
+
+    from sqlalchemy.dialects import mssql, postgresql
+    assert staging.get_drop_statement(postgresql.dialect(),
+                                      staging_table.table) == \
+        'DROP TABLE IF EXISTS "migrations_staging_A"'
+    mssql_table = sa.Table("#migrations_staging_A", sa.MetaData())
+    assert staging.get_drop_statement(mssql.dialect(), mssql_table) == \
+        "IF OBJECT_ID('tempdb..#migrations_staging_A') IS NOT NULL " \
+        "DROP TABLE [#migrations_staging_A]"
+
+
+def test_staging_table_duplicates():
+    # the records with the same values are inserted once, in the same
+    # paquet or not
+    conn, table = get_table()
+    staging_table = staging.StagingTable(conn, table)
+    records = [{"id": i, "name": u"d", "value": None} for i in range(10, 14)]
+    for paquet in (records[:3], records[3:]):
+        staging_table.load(columnar.Paquet.from_records(
+            paquet, ["id", "name", "value"]))
+        staging_table.insert_missing(["name", "value"], ["name", "value"])
+    assert conn.execute(sa.select([table.c.id]).where(table.c.name == u"d")
+                        ).fetchall() == [(3,)]
+
+    # the first of the duplicated records is the missing one
+    staging_table.load(columnar.Paquet.from_records(
+        [{"id": 20, "name": u"e", "value": 1},
+         {"id": 21, "name": u"e", "value": 1},
+         {"id": 22, "name": u"d", "value": None}], ["id", "name", "value"]))
+    assert [record["id"] for record in
+            staging_table.select_missing(["name", "value"])] == [20]
+
+
+def test_match_clause():
+    from sqlalchemy.dialects import mssql, postgresql
+    conn, table = get_table()
+    other = table.alias("other")
+
+    def compile(dialect):
+        clause = staging.match_clause(table, other, ["id", "value"], dialect)
+        return str(clause.compile(dialect=dialect))
+
+    # the NOT NULL columns are compared with plain equality
+    assert compile(postgresql.dialect()) == \
+        '"A".id = other.id AND ("A".value IS NOT DISTINCT FROM other.value)'
+    assert compile(conn.dialect) == \
+        '"A".id = other.id AND ("A".value IS other.value)'
+    assert compile(mssql.dialect()) == \
+        "[A].id = other.id AND ([A].value = other.value OR " \
+        "[A].value IS NULL AND other.value IS NULL)"
@@ -0,0 +1,45 @@
+import datetime
+import decimal
+
+import pytest
+
+from migrations import watermarks
+
+
+@pytest.mark.parametrize("value", [
+    5, 2 ** 40, 1.5, decimal.Decimal("12.50"), u"b\xe9",
+    datetime.datetime(2013, 1, 2, 3, 4, 5),
+    datetime.datetime(2013, 1, 2, 3, 4, 5, 6),
+    datetime.date(2013, 1, 2),
+])
+def test_encode(value):
+    decoded = watermarks.decode(watermarks.encode(value))
+    assert decoded == value
+    assert type(decoded) == type(value) or isinstance(value, long)
+
+
+def test_encode_invalid():
+    for value in (None, True, object()):
+        with pytest.raises(ValueError):
+            watermarks.encode(value)
+    with pytest.raises(ValueError):
+        watermarks.decode({"type": "unknown", "value": 1})
+
+
+def test_store(tmpdir):
+    path = str(tmpdir.join("watermarks"))
+    store = watermarks.WatermarkStore(path)
+    assert store.get("A") is None
+    store.set("A", datetime.datetime(2013, 1, 2))
+    store.set("B", 10)
+    store.save()
+
+    store = watermarks.WatermarkStore(path)
+    assert store.get("A") == datetime.datetime(2013, 1, 2)
+    assert store.get("B") == 10
+
+    # in memory only
+    store = watermarks.WatermarkStore()
+    store.set("A", 1)
+    store.save()
+    assert store.get("A") == 1